@@ -0,0 +1,247 @@
+import os
+import csv
+import json
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+# Agrega el directorio raíz del proyecto al sys.path para importar
+import sys
+from pathlib import Path
+directorio_raiz = Path(__file__).resolve().parent.parent
+sys.path.append(str(directorio_raiz))
+
+from procesamiento.coverage_heatmap import get_or_create_heatmap, get_heatmap_key, get_image_shape
+from procesamiento.convert_tiff_to_png import get_source_signature
+from tree_identification import detect_trees_from_heatmap
+from reuse_shapefile_for_heatmap import create_ground_truth_tree_positions
+from evaluate import load_coordinates_from_json, match_detections_to_ground_truth
+
+REPORT_COLUMNS = ["finca", "num_detections", "num_ground_truth", "true_positives", "false_positives", "false_negatives",
+                  "precision", "recall", "rmse", "wall_time_s"]
+
+def get_finca_paths(finca, data_dir="data"):
+    """
+    Devuelve las rutas de entrada y salida de una finca siguiendo la estructura de main.py.
+
+    Parameters:
+    finca (str): Identificador de la finca (ejemplo: 'P9').
+    data_dir (str): Directorio raíz de los datos. Default: 'data'.
+    """
+    return {
+        "tiff_dir": os.path.join(data_dir, finca, "1cm_maxint"),
+        "shapefile_dir": os.path.join(data_dir, "manual_selection", finca),
+        "detections": os.path.join(data_dir, finca, "detections", "remapped_detections.npz"),
+        "image_dir": os.path.join(data_dir, finca, "volume"),
+        "heatmap_dir": os.path.join(data_dir, finca, "heatmaps"),
+        "tree_centers": os.path.join(data_dir, finca, "results", "tree_centers.json"),
+        "ground_truth": os.path.join(data_dir, finca, "results", "tree_centers_ground_truth.json"),
+    }
+
+def get_missing_inputs(paths):
+    """
+    Devuelve los nombres de las entradas de una finca que no existen en disco (ver get_finca_paths).
+
+    Parameters:
+    paths (dict): Rutas de la finca.
+    """
+    return [name for name in ("tiff_dir", "shapefile_dir", "detections", "image_dir") if not os.path.exists(paths[name])]
+
+def get_result_parameters_path(result_path):
+    """
+    Devuelve la ruta del archivo lateral con los parámetros con los que se generó un resultado.
+    """
+    return f"{os.path.splitext(result_path)[0]}.params.json"
+
+def is_result_up_to_date(result_path, parameters):
+    """
+    Indica si un resultado existe y se generó con los mismos parámetros y entradas (ver save_result_parameters).
+
+    Parameters:
+    result_path (str): Ruta del resultado (JSON de centros).
+    parameters (dict): Parámetros y firmas de las entradas del resultado.
+    """
+    parameters_path = get_result_parameters_path(result_path)
+    if not (os.path.exists(result_path) and os.path.exists(parameters_path)):
+        return False
+    with open(parameters_path, 'r') as f:
+        saved = json.load(f)
+    return saved == json.loads(json.dumps(parameters, default=str))
+
+def save_result_parameters(result_path, parameters):
+    """
+    Guarda junto al resultado los parámetros y firmas de las entradas con los que se generó.
+    """
+    with open(get_result_parameters_path(result_path), 'w') as f:
+        json.dump(parameters, f, indent=4, default=str)
+
+def evaluate_finca(finca, data_dir="data", min_level=100, max_level=250, max_distance=25, matching_method='greedy',
+                   detection_params=None, ground_truth_params=None):
+    """
+    Evalúa una finca: genera (o reutiliza si ya existen) los centros de árboles del ground truth y de las
+    detecciones, los empareja uno a uno y calcula sus métricas. Se ejecuta en los procesos del pool.
+    Cada resultado guarda en un archivo lateral '.params.json' su rango de niveles, sus parámetros y la firma
+    de sus entradas (shapefiles o detecciones); solo se reutiliza si coinciden con los de la evaluación actual.
+
+    Parameters:
+    finca (str): Identificador de la finca.
+    data_dir (str): Directorio raíz de los datos.
+    min_level (int): Nivel mínimo para generar los centros.
+    max_level (int): Nivel máximo para generar los centros.
+    max_distance (float): Distancia máxima para asociar una detección con el ground truth.
+    matching_method (str): Emparejamiento uno a uno, 'greedy' u 'optimal'.
+    detection_params (dict, optional): Parámetros adicionales para detect_trees_from_heatmap.
+    ground_truth_params (dict, optional): Parámetros adicionales para create_ground_truth_tree_positions.
+
+    Returns:
+    dict: Fila del informe de la finca, más la suma de errores cuadráticos para las métricas agregadas, o None
+          si faltan entradas de la finca (se omite y se informa de ello).
+    """
+    start_time = time.perf_counter()
+    paths = get_finca_paths(finca, data_dir)
+
+    # Omitir la finca si falta alguna de sus entradas (por ejemplo, sin anotaciones manuales)
+    missing_inputs = get_missing_inputs(paths)
+    if missing_inputs:
+        print(f"Finca {finca} omitida, faltan entradas: " + ", ".join(f"{name} ({paths[name]})" for name in missing_inputs))
+        return None
+
+    os.makedirs(os.path.dirname(paths["tree_centers"]), exist_ok=True)
+
+    # Parámetros y firmas de las entradas de cada resultado: si cambian, el resultado se regenera
+    shapefiles = sorted(f for f in os.listdir(paths["shapefile_dir"]) if f.endswith(('.shp', '.prj')))
+    ground_truth_parameters = {
+        "min_level": min_level,
+        "max_level": max_level,
+        "params": ground_truth_params or {},
+        "shapefiles": [[f] + get_source_signature(os.path.join(paths["shapefile_dir"], f)) for f in shapefiles],
+    }
+    detection_parameters = {
+        "min_level": min_level,
+        "max_level": max_level,
+        "params": detection_params or {},
+        "detections_key": get_heatmap_key(paths["detections"], get_image_shape(paths["image_dir"]), min_level, max_level),
+    }
+
+    # Generar el ground truth si no existe o se generó con otros parámetros
+    if not is_result_up_to_date(paths["ground_truth"], ground_truth_parameters):
+        create_ground_truth_tree_positions(paths["tiff_dir"], paths["shapefile_dir"], output_path=paths["ground_truth"],
+                                           min_level=min_level, max_level=max_level, **(ground_truth_params or {}))
+        save_result_parameters(paths["ground_truth"], ground_truth_parameters)
+
+    # Generar los centros detectados si no existen o se generaron con otros parámetros o detecciones,
+    # a partir del heatmap persistido
+    if not is_result_up_to_date(paths["tree_centers"], detection_parameters):
+        heatmap = get_or_create_heatmap(paths["detections"], paths["image_dir"], paths["heatmap_dir"], min_level=min_level, max_level=max_level)
+        detect_trees_from_heatmap(paths["detections"], paths["image_dir"], paths["tree_centers"], min_level=min_level,
+                                  max_level=max_level, heatmap=heatmap, **(detection_params or {}))
+        save_result_parameters(paths["tree_centers"], detection_parameters)
+
+    # Emparejar detecciones y ground truth
+    detections = np.array(load_coordinates_from_json(paths["tree_centers"]), dtype=float).reshape(-1, 2)
+    ground_truth = np.array(load_coordinates_from_json(paths["ground_truth"]), dtype=float).reshape(-1, 2)
+    match = match_detections_to_ground_truth(detections, ground_truth, max_distance, matching_method)
+
+    errors = detections[match["detection_indices"]] - ground_truth[match["ground_truth_indices"]]
+    squared_error = float(np.sum(errors ** 2))
+    row = _metrics_row(finca, len(detections), len(ground_truth), len(match["detection_indices"]), squared_error)
+    row["wall_time_s"] = round(time.perf_counter() - start_time, 3)
+    row["squared_error"] = squared_error
+    return row
+
+def _metrics_row(name, num_detections, num_ground_truth, true_positives, squared_error):
+    """
+    Calcula precisión, recall y RMSE (igual que calculate_metrics) a partir de los recuentos de una finca
+    o de la suma de varias.
+    """
+    false_positives = num_detections - true_positives
+    false_negatives = num_ground_truth - true_positives
+    return {
+        "finca": name,
+        "num_detections": num_detections,
+        "num_ground_truth": num_ground_truth,
+        "true_positives": true_positives,
+        "false_positives": false_positives,
+        "false_negatives": false_negatives,
+        "precision": true_positives / num_detections if num_detections > 0 else 0,
+        "recall": true_positives / num_ground_truth if num_ground_truth > 0 else 0,
+        "rmse": float(np.sqrt(squared_error / (2 * true_positives))) if true_positives > 0 else None,
+    }
+
+def run_batch_evaluation(fincas, output_csv, data_dir="data", min_level=100, max_level=250, max_distance=25,
+                         matching_method='greedy', detection_params=None, ground_truth_params=None, num_workers=1):
+    """
+    Evalúa varias fincas en paralelo (un proceso por finca) y guarda un informe CSV con las métricas de cada
+    finca, las métricas agregadas de todas ellas ('pooled', calculadas sumando los recuentos y errores de cada
+    finca) y el tiempo de ejecución de cada finca. En la fila 'pooled' el tiempo es el real de toda la evaluación,
+    no la suma de los tiempos de las fincas (que se solapan con varios procesos). Las fincas a las que les falta
+    alguna entrada se omiten del informe y se indican al final.
+
+    Parameters:
+    fincas (list): Identificadores de las fincas (ejemplo: ['P7', 'P9']).
+    output_csv (str): Ruta del CSV del informe.
+    data_dir (str): Directorio raíz de los datos. Default: 'data'.
+    min_level (int): Nivel mínimo para generar los centros. Default: 100.
+    max_level (int): Nivel máximo para generar los centros. Default: 250.
+    max_distance (float): Distancia máxima para asociar una detección con el ground truth. Default: 25.
+    matching_method (str): Emparejamiento uno a uno, 'greedy' u 'optimal'. Default: 'greedy'.
+    detection_params (dict, optional): Parámetros adicionales para detect_trees_from_heatmap.
+    ground_truth_params (dict, optional): Parámetros adicionales para create_ground_truth_tree_positions.
+    num_workers (int): Número de procesos. Default: 1.
+
+    Returns:
+    list: Filas del informe (una por finca evaluada y la fila 'pooled' al final).
+    """
+    start_time = time.perf_counter()
+    os.makedirs(os.path.dirname(output_csv) or ".", exist_ok=True)
+    arguments = (data_dir, min_level, max_level, max_distance, matching_method, detection_params, ground_truth_params)
+
+    # Evaluar cada finca, en paralelo si se indica
+    rows = {}
+    if num_workers > 1 and len(fincas) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(evaluate_finca, finca, *arguments): finca for finca in fincas}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluando fincas", unit="finca"):
+                rows[futures[future]] = future.result()
+    else:
+        for finca in tqdm(fincas, desc="Evaluando fincas", unit="finca"):
+            rows[finca] = evaluate_finca(finca, *arguments)
+    skipped = [finca for finca in fincas if rows[finca] is None]
+    rows = [rows[finca] for finca in fincas if rows[finca] is not None]
+
+    # Métricas agregadas de todas las fincas
+    pooled = _metrics_row("pooled", sum(r["num_detections"] for r in rows), sum(r["num_ground_truth"] for r in rows),
+                          sum(r["true_positives"] for r in rows), sum(r["squared_error"] for r in rows))
+    pooled["wall_time_s"] = round(time.perf_counter() - start_time, 3)
+    rows.append(pooled)
+
+    # Guardar y mostrar el informe
+    with open(output_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    for row in rows:
+        rmse = f"{row['rmse']:.2f}" if row["rmse"] is not None else "-"
+        print(f"{row['finca']}: Precision={row['precision']:.3f} Recall={row['recall']:.3f} RMSE={rmse} Tiempo={row['wall_time_s']:.1f}s")
+    if skipped:
+        print(f"Fincas omitidas por falta de entradas: {', '.join(skipped)}")
+    print(f"Informe de evaluación guardado en: {output_csv}")
+    return rows
+
+if __name__ == "__main__":
+    # Fincas a evaluar: las indicadas en la línea de comandos o, por defecto, P7 y P9
+    # Ejemplo de uso: python evaluacion/batch_evaluation.py P7 P9 P28
+    fincas = sys.argv[1:] or ['P7', 'P9']
+
+    run_batch_evaluation(
+        fincas,
+        output_csv="data/evaluation_report.csv",
+        min_level=100,
+        max_level=250,
+        max_distance=25,
+        detection_params={"min_percentage": 0.105, "dbscan_eps": 50, "dbscan_min_samples": 200},
+        ground_truth_params={"point_size": 20, "min_percentage": 0.105, "dbscan_eps": 50, "dbscan_min_samples": 200},
+        num_workers=4
+    )
@@ -1,6 +1,9 @@
 import json
 import numpy as np
 from scipy.spatial import KDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
@@ -9,31 +12,125 @@ def load_coordinates_from_json(file_path):
         data = json.load(file)
     return [(coord[0], coord[1]) for coord in data]
 
-def associate_detections_with_ground_truth(detection_json, ground_truth_json, max_distance=20):
+def associate_detections_with_ground_truth(detection_json, ground_truth_json, max_distance=20, method='greedy'):
     detections = load_coordinates_from_json(detection_json)
     ground_truth = load_coordinates_from_json(ground_truth_json)
+    return associate_coordinates_with_ground_truth(detections, ground_truth, max_distance, method)
 
-    # KDTree for efficient nearest neighbor search
-    gt_tree = KDTree(ground_truth)
+def match_detections_to_ground_truth(detections, ground_truth, max_distance=20, method='greedy'):
+    """
+    Empareja uno a uno detecciones y ground truth. Calcula con una sola consulta entre dos KDTree
+    (sparse_distance_matrix) todos los pares a menos de max_distance y los asigna de forma que cada árbol del
+    ground truth se asocia como mucho con una detección y viceversa.
+
+    Parameters:
+    detections (array-like): Coordenadas (x, y) de los centros detectados, de forma (n, 2).
+    ground_truth (array-like): Coordenadas (x, y) del ground truth, de forma (m, 2).
+    max_distance (float): Distancia máxima (estricta) para considerar un par.
+    method (str): 'greedy' asigna primero los pares más cercanos; 'optimal' maximiza el número de pares y,
+                  con ese número, minimiza la distancia total (linear_sum_assignment por componente conexa).
+
+    Returns:
+    dict: Arrays de índices 'detection_indices' y 'ground_truth_indices' de los pares (ordenados por
+          detección), 'distances' de cada par, 'false_positive_indices' y 'false_negative_indices'.
+    """
+    detections = np.asarray(detections, dtype=float).reshape(-1, 2)
+    ground_truth = np.asarray(ground_truth, dtype=float).reshape(-1, 2)
+
+    # Todos los pares candidatos en una sola consulta
+    if len(detections) and len(ground_truth):
+        pairs = KDTree(detections).sparse_distance_matrix(KDTree(ground_truth), max_distance, output_type='ndarray')
+        pairs = pairs[pairs['v'] < max_distance]
+        det_candidates, gt_candidates, distances = pairs['i'].astype(int), pairs['j'].astype(int), pairs['v']
+    else:
+        det_candidates = gt_candidates = np.zeros(0, dtype=int)
+        distances = np.zeros(0)
+
+    if method == 'greedy':
+        # Recorrer los pares de menor a mayor distancia quedándose con los que no reutilizan ningún punto
+        order = np.lexsort((gt_candidates, det_candidates, distances))
+        det_used = np.zeros(len(detections), dtype=bool)
+        gt_used = np.zeros(len(ground_truth), dtype=bool)
+        selected = []
+        for pair in order.tolist():
+            det_index, gt_index = det_candidates[pair], gt_candidates[pair]
+            if not det_used[det_index] and not gt_used[gt_index]:
+                det_used[det_index] = gt_used[gt_index] = True
+                selected.append(pair)
+        selected = np.array(selected, dtype=int)
+    elif method == 'optimal':
+        selected = _optimal_assignment(det_candidates, gt_candidates, distances, len(detections), len(ground_truth))
+    else:
+        raise ValueError(f"Método de emparejamiento no válido: {method}. Use 'greedy' u 'optimal'.")
 
-    matches = []
-    false_positives = []
-    false_negatives = list(ground_truth)  # Start with all ground truth as unmatched
+    # Ordenar los pares por índice de detección
+    selected = selected[np.argsort(det_candidates[selected], kind='stable')]
+    detection_indices = det_candidates[selected]
+    ground_truth_indices = gt_candidates[selected]
 
-    for detection in detections:
-        distance, index = gt_tree.query(detection, distance_upper_bound=max_distance)
-        if distance < max_distance:
-            match = ground_truth[index]
-            matches.append((detection, match))
-            if match in false_negatives:
-                false_negatives.remove(match)
-        else:
-            false_positives.append(detection)
+    return {
+        'detection_indices': detection_indices,
+        'ground_truth_indices': ground_truth_indices,
+        'distances': distances[selected],
+        'false_positive_indices': np.setdiff1d(np.arange(len(detections)), detection_indices),
+        'false_negative_indices': np.setdiff1d(np.arange(len(ground_truth)), ground_truth_indices),
+    }
+
+def _optimal_assignment(det_candidates, gt_candidates, distances, num_detections, num_ground_truth):
+    """
+    Asignación óptima de los pares candidatos. El grafo bipartito se separa en componentes conexas y cada una
+    se resuelve con linear_sum_assignment; los pares inexistentes tienen un coste mayor que la suma de todas
+    las distancias, de forma que primero se maximiza el número de pares.
+    """
+    if len(distances) == 0:
+        return np.zeros(0, dtype=int)
+
+    # Componentes conexas del grafo bipartito (detecciones seguidas de ground truth)
+    graph = coo_matrix((np.ones(len(distances)), (det_candidates, num_detections + gt_candidates)),
+                       shape=(num_detections + num_ground_truth,) * 2)
+    _, components = connected_components(graph, directed=False)
+    pair_components = components[det_candidates]
+
+    # Las componentes con un único par candidato se asignan directamente
+    single = np.bincount(pair_components)[pair_components] == 1
+    selected = np.flatnonzero(single).tolist()
+
+    missing_cost = distances.sum() + 1
+    order = np.flatnonzero(~single)
+    order = order[np.argsort(pair_components[order], kind='stable')]
+    starts = np.flatnonzero(np.diff(pair_components[order]) != 0) + 1
+    for pairs in np.split(order, starts) if len(order) else []:
+        # Resolver la componente con una matriz de costes densa y pequeña
+        det_ids, det_local = np.unique(det_candidates[pairs], return_inverse=True)
+        gt_ids, gt_local = np.unique(gt_candidates[pairs], return_inverse=True)
+        cost = np.full((len(det_ids), len(gt_ids)), missing_cost)
+        pair_lookup = np.full((len(det_ids), len(gt_ids)), -1)
+        cost[det_local, gt_local] = distances[pairs]
+        pair_lookup[det_local, gt_local] = pairs
+        rows, cols = linear_sum_assignment(cost)
+        chosen = pair_lookup[rows, cols]
+        selected.extend(chosen[chosen >= 0].tolist())
+    return np.array(selected, dtype=int)
+
+def associate_coordinates_with_ground_truth(detections, ground_truth, max_distance=20, method='greedy'):
+    """
+    Asocia uno a uno detecciones y ground truth ya cargados como listas de coordenadas (x, y), sin pasar por
+    JSON (ver match_detections_to_ground_truth), y devuelve el formato de listas de calculate_metrics.
+
+    Parameters:
+    detections (list): Coordenadas (x, y) de los centros detectados.
+    ground_truth (list): Coordenadas (x, y) del ground truth.
+    max_distance (float): Distancia máxima para considerar una detección asociada.
+    method (str): Método de emparejamiento, 'greedy' u 'optimal'. Default: 'greedy'.
+    """
+    detections = [tuple(detection) for detection in detections]
+    ground_truth = [tuple(point) for point in ground_truth]
+    match = match_detections_to_ground_truth(detections, ground_truth, max_distance, method)
 
     return {
-    'matches': matches,
-    'false_positives': false_positives,
-    'false_negatives': false_negatives
+    'matches': [(detections[i], ground_truth[j]) for i, j in zip(match['detection_indices'].tolist(), match['ground_truth_indices'].tolist())],
+    'false_positives': [detections[i] for i in match['false_positive_indices'].tolist()],
+    'false_negatives': [ground_truth[j] for j in match['false_negative_indices'].tolist()]
     }
 
 
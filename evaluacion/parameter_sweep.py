@@ -0,0 +1,163 @@
+import os
+import csv
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+# Agrega el directorio raíz del proyecto al sys.path para importar
+import sys
+from pathlib import Path
+directorio_raiz = Path(__file__).resolve().parent.parent
+sys.path.append(str(directorio_raiz))
+
+from procesamiento.coverage_heatmap import get_image_shape, get_heatmap_path, get_or_create_heatmap, load_heatmap
+from tree_identification import filter_heatmap, apply_dbscan, apply_grid_clustering, calculate_cluster_centers
+from evaluate import load_coordinates_from_json, associate_coordinates_with_ground_truth, calculate_metrics
+
+# Valores por defecto de cada parámetro del barrido (los mismos que detect_trees_from_heatmap)
+DEFAULT_PARAMETERS = {
+    "level_range": [(None, None)],
+    "min_percentage": [0.105],
+    "dbscan_eps": [50],
+    "dbscan_min_samples": [200],
+    "clustering_method": ["dbscan"],
+}
+
+SWEEP_COLUMNS = ["min_level", "max_level", "min_percentage", "clustering_method", "dbscan_eps", "dbscan_min_samples",
+                 "num_trees", "true_positives", "precision", "recall", "rmse", "runtime_s"]
+
+# Heatmaps ya cargados en cada proceso del pool, por ruta
+_heatmap_cache = {}
+
+def _get_cached_heatmap(heatmap_path):
+    """
+    Carga un heatmap persistido una sola vez por proceso.
+    """
+    if heatmap_path not in _heatmap_cache:
+        _heatmap_cache[heatmap_path] = load_heatmap(heatmap_path)
+    return _heatmap_cache[heatmap_path]
+
+def evaluate_configuration(heatmap_path, config, ground_truth, max_distance=25, matching_method='greedy'):
+    """
+    Ejecuta filtrado, clustering, cálculo de centros y evaluación contra el ground truth para una configuración.
+    Se ejecuta en los procesos del pool.
+
+    Parameters:
+    heatmap_path (str): Ruta del heatmap persistido del rango de niveles de la configuración.
+    config (dict): Configuración (level_range, min_percentage, dbscan_eps, dbscan_min_samples, clustering_method).
+    ground_truth (list): Coordenadas (x, y) del ground truth.
+    max_distance (float): Distancia máxima para asociar una detección con el ground truth.
+    matching_method (str): Emparejamiento uno a uno, 'greedy' u 'optimal' (ver match_detections_to_ground_truth).
+
+    Returns:
+    dict: Fila de resultados con los parámetros, las métricas y el tiempo de ejecución.
+    """
+    heatmap = _get_cached_heatmap(heatmap_path)
+
+    # Medir solo el filtrado, el clustering y la evaluación, sin la carga del heatmap en cada proceso
+    start_time = time.perf_counter()
+
+    filtered_heatmap = filter_heatmap(heatmap, min_percentage=config["min_percentage"])
+    clustering = apply_grid_clustering if config["clustering_method"] == 'grid' else apply_dbscan
+    non_zero_coords, labels = clustering(filtered_heatmap, eps=config["dbscan_eps"], min_samples=config["dbscan_min_samples"])
+    centers = calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels)
+
+    association_data = associate_coordinates_with_ground_truth(centers, ground_truth, max_distance, matching_method)
+    metrics = calculate_metrics(association_data)
+
+    min_level, max_level = config["level_range"]
+    return {
+        "min_level": min_level,
+        "max_level": max_level,
+        "min_percentage": config["min_percentage"],
+        "clustering_method": config["clustering_method"],
+        "dbscan_eps": config["dbscan_eps"],
+        "dbscan_min_samples": config["dbscan_min_samples"],
+        "num_trees": len(centers),
+        "true_positives": len(association_data["matches"]),
+        "precision": metrics["precision"],
+        "recall": metrics["recall"],
+        "rmse": metrics["rmse"],
+        "runtime_s": round(time.perf_counter() - start_time, 3),
+    }
+
+def run_parameter_sweep(json_dir, image_dir, ground_truth_json, output_csv, param_grid, heatmap_dir=None, max_distance=25, num_workers=1, matching_method='greedy'):
+    """
+    Barrido de parámetros de la identificación de árboles contra el ground truth. Construye (o carga) una sola
+    vez el heatmap de cada rango de niveles distinto, reparte las combinaciones de filtrado/clustering/evaluación
+    entre un pool de procesos y guarda una tabla CSV con precisión, recall, RMSE y tiempo por configuración.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_dir (str): Directorio de imágenes o volumen de niveles para determinar el tamaño del heatmap.
+    ground_truth_json (str): Ruta del JSON con las posiciones de árboles del ground truth.
+    output_csv (str): Ruta del CSV de resultados.
+    param_grid (dict): Listas de valores por parámetro: 'level_range' (tuplas (min_level, max_level)),
+                       'min_percentage', 'dbscan_eps', 'dbscan_min_samples' y 'clustering_method' ('dbscan' o
+                       'grid'). Los parámetros que falten toman los valores por defecto de detect_trees_from_heatmap.
+    heatmap_dir (str, optional): Directorio de los heatmaps persistidos. Si es None, 'heatmaps' junto al CSV.
+    max_distance (float): Distancia máxima para asociar una detección con el ground truth. Default: 25.
+    num_workers (int): Número de procesos para evaluar las configuraciones. Default: 1.
+    matching_method (str): Emparejamiento uno a uno detección/ground truth, 'greedy' u 'optimal'. Default: 'greedy'.
+
+    Returns:
+    list: Filas de resultados (una por configuración), en el orden del CSV.
+    """
+    os.makedirs(os.path.dirname(output_csv) or ".", exist_ok=True)
+    heatmap_dir = heatmap_dir or os.path.join(os.path.dirname(output_csv), "heatmaps")
+    ground_truth = load_coordinates_from_json(ground_truth_json)
+
+    # Expandir la rejilla de parámetros en configuraciones
+    parameters = {**DEFAULT_PARAMETERS, **param_grid}
+    names = list(DEFAULT_PARAMETERS)
+    configs = [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+
+    # Construir una sola vez el heatmap de cada rango de niveles distinto
+    image_shape = get_image_shape(image_dir)
+    heatmap_paths = {}
+    for min_level, max_level in dict.fromkeys(tuple(level_range) for level_range in parameters["level_range"]):
+        get_or_create_heatmap(json_dir, image_dir, heatmap_dir, min_level=min_level, max_level=max_level)
+        heatmap_paths[(min_level, max_level)] = get_heatmap_path(json_dir, image_shape, heatmap_dir, min_level, max_level)
+
+    # Evaluar las configuraciones, en paralelo si se indica
+    rows = [None] * len(configs)
+    if num_workers > 1 and len(configs) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                executor.submit(evaluate_configuration, heatmap_paths[tuple(config["level_range"])], config, ground_truth, max_distance, matching_method): position
+                for position, config in enumerate(configs)
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Barrido de parámetros", unit="configuración"):
+                rows[futures[future]] = future.result()
+    else:
+        for position, config in enumerate(tqdm(configs, desc="Barrido de parámetros", unit="configuración")):
+            rows[position] = evaluate_configuration(heatmap_paths[tuple(config["level_range"])], config, ground_truth, max_distance, matching_method)
+
+    # Guardar la tabla de resultados
+    with open(output_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"Resultados del barrido guardados en: {output_csv} ({len(rows)} configuraciones)")
+    return rows
+
+if __name__ == "__main__":
+    finca = 'P9'
+
+    # Ejemplo de uso
+    run_parameter_sweep(
+        json_dir=f"data/{finca}/detections/remapped_detections.npz",
+        image_dir=f"data/{finca}/volume",
+        ground_truth_json=f"data/{finca}/results/tree_centers_ground_truth.json",
+        output_csv=f"data/{finca}/results/parameter_sweep.csv",
+        param_grid={
+            "level_range": [(75, 185), (100, 250)],
+            "min_percentage": [0.08, 0.105, 0.13],
+            "dbscan_eps": [30, 50],
+            "dbscan_min_samples": [100, 200],
+        },
+        max_distance=25,
+        num_workers=4
+    )
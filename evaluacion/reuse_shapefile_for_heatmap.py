@@ -1,57 +1,91 @@
 import os
 import numpy as np
 import rasterio
-import geopandas as gpd
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import json
+from concurrent.futures import ProcessPoolExecutor
+
+# Agrega el directorio raíz del proyecto al sys.path para importar
+import sys
+from pathlib import Path
+directorio_raiz = Path(__file__).resolve().parent.parent
+sys.path.append(str(directorio_raiz))
+
 from tree_identification import filter_heatmap, apply_dbscan, calculate_cluster_centers
+from procesamiento.shapefile_points import read_georeference, shapefile_to_pixel_coords, convert_shapefiles_to_pixel_coords
+from procesamiento.coverage_heatmap import get_coverage_dtype
+from procesamiento.level_volume import parse_level_number
 
 def convert_shapefile_to_image_coords(image_path, shapefile_path):
     """
     Convierte los puntos de un shapefile a coordenadas de imagen utilizando la georreferenciación del GeoTIFF.
     """
-    with rasterio.open(image_path) as dataset:
-        transform = dataset.transform
-        crs = dataset.crs
+    points = shapefile_to_pixel_coords(shapefile_path, *read_georeference(image_path))
+    return [{"x": x, "y": y} for x, y in points.tolist()]
 
-    gdf = gpd.read_file(shapefile_path)
-    if gdf.crs != crs:
-        gdf = gdf.to_crs(crs)
-    
-    points_in_image_coords = []
-    for point in gdf.geometry:
-        x, y = point.x, point.y
-        row, col = rasterio.transform.rowcol(transform, x, y)
-        points_in_image_coords.append({"x": int(col), "y": int(row)})
+def stamp_points(points, coverage_grid, point_size=3):
+    """
+    Estampa en una sola pasada vectorizada las ventanas de lado point_size centradas en los puntos de un nivel,
+    sumando +1 a cada píxel cubierto por al menos una ventana (los solapes del mismo nivel cuentan una vez).
+    Solo se recorren los píxeles de las ventanas, no el grid completo.
 
-    return points_in_image_coords
+    Parameters:
+    points (numpy.ndarray | list): Array (n, 2) de coordenadas (x, y) o lista de diccionarios {"x", "y"}.
+    coverage_grid (numpy.ndarray): Grid de cobertura sobre el que acumular.
+    point_size (int): Tamaño de la vecindad alrededor de cada punto.
+    """
+    if len(points) and isinstance(points[0], dict):
+        points = [(point["x"], point["y"]) for point in points]
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width = coverage_grid.shape
+
+    # Coordenadas de las columnas y filas de la ventana de cada punto
+    offsets = np.arange(-(point_size // 2), point_size // 2 + 1)
+    xs = points[:, 0, None] + offsets
+    ys = points[:, 1, None] + offsets
+
+    # Índices de los píxeles de todas las ventanas dentro de la imagen, sin repetir
+    valid = ((ys >= 0) & (ys < height))[:, :, None] & ((xs >= 0) & (xs < width))[:, None, :]
+    pixels = np.sort((ys[:, :, None] * width + xs[:, None, :])[valid])
+    unique = np.ones(len(pixels), dtype=bool)
+    unique[1:] = pixels[1:] != pixels[:-1]
+    pixels = pixels[unique]
+
+    coverage_grid[pixels // width, pixels % width] += 1
 
 def accumulate_points_with_unique_count(points, coverage_grid, point_size=3):
     """
     Acumula los puntos en una capa temporal por cada nivel, incrementando el valor en una vecindad
     alrededor de cada punto, pero limitando la acumulación a +1 por cada nivel.
     """
-    temp_grid = np.zeros_like(coverage_grid, dtype=int)
-    
-    for point in points:
-        x, y = point["x"], point["y"]
-        
-        # Crear una ventana alrededor del punto para incrementar su valor
-        x_min = max(0, x - point_size // 2)
-        x_max = min(coverage_grid.shape[1], x + point_size // 2 + 1)
-        y_min = max(0, y - point_size // 2)
-        y_max = min(coverage_grid.shape[0], y + point_size // 2 + 1)
-        
-        # Marcar la vecindad en el grid temporal
-        temp_grid[y_min:y_max, x_min:x_max] = 1
-
-    # Acumular el resultado en el grid de cobertura
-    coverage_grid += temp_grid
-
-def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_level=None, point_size=3, show=False):
+    stamp_points(points, coverage_grid, point_size=point_size)
+
+def accumulate_levels(points_by_level, image_shape, point_size=3, dtype=int):
+    """
+    Acumula varios niveles de puntos en un grid parcial. Se ejecuta en los procesos del pool, cada uno con
+    su propio grid parcial que luego se suma al heatmap.
+
+    Parameters:
+    points_by_level (list): Arrays (n, 2) de coordenadas (x, y), uno por nivel.
+    image_shape (tuple): Tamaño (alto, ancho) del grid.
+    point_size (int): Tamaño de la vecindad alrededor de cada punto.
+    dtype (numpy.dtype): Tipo de dato del grid parcial. Default: int.
+
+    Returns:
+    numpy.ndarray: Grid parcial con la cobertura de los niveles.
+    """
+    partial_grid = np.zeros(image_shape, dtype=dtype)
+    for points in points_by_level:
+        stamp_points(points, partial_grid, point_size=point_size)
+    return partial_grid
+
+def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_level=None, point_size=3, show=False, cache_dir=None, num_workers=1):
     """
     Construye un heatmap acumulativo a partir de shapefiles y archivos TIFF dentro de un rango de niveles.
+    La georreferenciación se lee una sola vez para toda la finca y las coordenadas de píxel de cada shapefile
+    se guardan en caché (ver convert_shapefiles_to_pixel_coords). Con num_workers > 1 los shapefiles se leen
+    en paralelo y los niveles se reparten entre procesos que acumulan grids parciales, sumados al final.
     
     Parameters:
     tiff_dir (str): Directorio que contiene las imágenes GeoTIFF.
@@ -60,6 +94,8 @@ def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_l
     max_level (int, optional): Nivel máximo de archivos a procesar.
     point_size (int): Tamaño de la vecindad alrededor de cada punto en el heatmap.
     show (bool): Si True, muestra el heatmap generado.
+    cache_dir (str, optional): Directorio de la caché de coordenadas. Si es None, '.pixel_cache' dentro de shapefile_dir.
+    num_workers (int): Número de procesos para convertir y acumular los niveles. Default: 1.
     
     Returns:
     numpy.ndarray: Heatmap acumulativo de los puntos.
@@ -70,8 +106,6 @@ def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_l
     
     with rasterio.open(os.path.join(tiff_dir, sample_tiff)) as dataset:
         image_shape = (dataset.height, dataset.width)
-    
-    heatmap = np.zeros(image_shape, dtype=int)
 
     # Listar solo los archivos TIFF que tienen un shapefile correspondiente
     tiff_files = [
@@ -79,21 +113,30 @@ def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_l
         if f.lower().endswith(('.tif', '.tiff')) and os.path.exists(os.path.join(shapefile_dir, f"{os.path.splitext(f)[0]}.shp"))
     ]
 
-    # Aplicar filtro de niveles si están definidos
-    if min_level is not None or max_level is not None:
-        tiff_files = [
-            tiff_file for tiff_file in tiff_files
-            if min_level <= int(os.path.splitext(tiff_file)[0].split('_')[1]) <= max_level
-        ]
-
-    # Procesar cada TIFF que tenga shapefile correspondiente
-    for tiff_file in tqdm(tiff_files, desc="Procesando niveles", unit="nivel"):
-        tiff_path = os.path.join(tiff_dir, tiff_file)
-        base_name = os.path.splitext(tiff_file)[0]
-        shapefile_path = os.path.join(shapefile_dir, f"{base_name}.shp")
-
-        points = convert_shapefile_to_image_coords(tiff_path, shapefile_path)
-        accumulate_points_with_unique_count(points, heatmap, point_size=point_size)
+    # Aplicar filtro de niveles, comprobando cada límite solo si está definido
+    if min_level is not None:
+        tiff_files = [tiff_file for tiff_file in tiff_files if parse_level_number(tiff_file) >= min_level]
+    if max_level is not None:
+        tiff_files = [tiff_file for tiff_file in tiff_files if parse_level_number(tiff_file) <= max_level]
+
+    # Convertir los puntos de todos los shapefiles con la georreferenciación de la finca (con caché)
+    shapefile_paths = [os.path.join(shapefile_dir, f"{os.path.splitext(f)[0]}.shp") for f in tiff_files]
+    cache_dir = cache_dir or os.path.join(shapefile_dir, ".pixel_cache")
+    points_by_level = convert_shapefiles_to_pixel_coords(shapefile_paths, os.path.join(tiff_dir, sample_tiff),
+                                                         cache_dir=cache_dir, num_workers=num_workers)
+    points_by_level = [points_by_level[shapefile_path] for shapefile_path in shapefile_paths]
+
+    # Acumular los niveles, repartidos entre procesos con un grid parcial cada uno si se indica
+    dtype = get_coverage_dtype(len(points_by_level))
+    if num_workers > 1 and len(points_by_level) > 1:
+        chunks = [points_by_level[i::num_workers] for i in range(num_workers) if points_by_level[i::num_workers]]
+        heatmap = np.zeros(image_shape, dtype=dtype)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(accumulate_levels, chunk, image_shape, point_size, dtype) for chunk in chunks]
+            for future in tqdm(futures, desc="Procesando niveles", unit="bloque"):
+                heatmap += future.result()
+    else:
+        heatmap = accumulate_levels(tqdm(points_by_level, desc="Procesando niveles", unit="nivel"), image_shape, point_size, dtype)
     
     if show:
         plt.figure(figsize=(10, 8))
@@ -107,7 +150,7 @@ def build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=None, max_l
 
     return heatmap
 
-def create_ground_truth_tree_positions(tiff_dir, shapefile_dir, output_path=None, min_level=None, max_level=None, point_size=20, min_percentage=0.105, dbscan_eps=50, dbscan_min_samples=200, show_steps=False):
+def create_ground_truth_tree_positions(tiff_dir, shapefile_dir, output_path=None, min_level=None, max_level=None, point_size=20, min_percentage=0.105, dbscan_eps=50, dbscan_min_samples=200, show_steps=False, num_workers=1):
     """
     Crea posiciones de árboles de verdad de terreno (ground truth) a partir de shapefiles y archivos TIFF,
     aplicando un filtro y DBSCAN para detectar centros de árboles.
@@ -123,12 +166,13 @@ def create_ground_truth_tree_positions(tiff_dir, shapefile_dir, output_path=None
     dbscan_eps (float): Máxima distancia entre puntos en el mismo cluster en DBSCAN.
     dbscan_min_samples (int): Número mínimo de muestras en un cluster para DBSCAN.
     show_steps (bool): Si True, muestra los resultados de cada paso.
+    num_workers (int): Número de procesos para construir el heatmap. Default: 1.
     
     Returns:
     List[Tuple[int, int]]: Lista de posiciones centrales (x, y) de los árboles detectados.
     """
     # Paso 1: Crear el heatmap acumulativo a partir de los shapefiles
-    heatmap_gt = build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=min_level, max_level=max_level, point_size=point_size, show=show_steps)
+    heatmap_gt = build_heatmap_from_shapefiles(tiff_dir, shapefile_dir, min_level=min_level, max_level=max_level, point_size=point_size, show=show_steps, num_workers=num_workers)
     
     # Paso 2: Filtrar el heatmap usando un porcentaje del valor máximo
     filtered_heatmap_gt = filter_heatmap(heatmap_gt, min_percentage=min_percentage, show=show_steps)
@@ -165,5 +209,6 @@ if __name__ == "__main__":
         dbscan_eps=50,
         dbscan_min_samples=200,
         output_path=output_path,
-        show_steps=False
+        show_steps=False,
+        num_workers=4
     )
\ No newline at end of file
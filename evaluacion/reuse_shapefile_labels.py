@@ -1,11 +1,17 @@
 import os
 import json
-import rasterio
-import geopandas as gpd
 import cv2
 from tqdm import tqdm
 
-def convert_shapefile_to_image_coords(image_path, shapefile_path, output_json_path):
+# Agrega el directorio raíz del proyecto al sys.path para importar
+import sys
+from pathlib import Path
+directorio_raiz = Path(__file__).resolve().parent.parent
+sys.path.append(str(directorio_raiz))
+
+from procesamiento.shapefile_points import read_georeference, shapefile_to_pixel_coords
+
+def convert_shapefile_to_image_coords(image_path, shapefile_path, output_json_path, georeference=None):
     """
     Convierte los puntos de un shapefile a coordenadas de imagen utilizando la georreferenciación del GeoTIFF.
     
@@ -13,26 +19,14 @@ def convert_shapefile_to_image_coords(image_path, shapefile_path, output_json_pa
     image_path (str): Ruta a la imagen GeoTIFF.
     shapefile_path (str): Ruta al archivo .shp que contiene los puntos.
     output_json_path (str): Ruta para guardar el archivo JSON con las coordenadas de los puntos.
+    georeference (tuple, optional): Georreferenciación (transform, crs) ya leída (ver read_georeference).
+                                    Si es None, se lee de image_path.
     """
-    # Leer la imagen GeoTIFF
-    with rasterio.open(image_path) as dataset:
-        transform = dataset.transform  # Transformación geoespacial del raster
-        crs = dataset.crs
-
-    # Leer los puntos del shapefile usando geopandas
-    gdf = gpd.read_file(shapefile_path)
-
-    # Verificar si el shapefile y el GeoTIFF tienen el mismo sistema de coordenadas
-    if gdf.crs != crs:
-        gdf = gdf.to_crs(crs)  # Reproyectar si es necesario
-
-    # Convertir las coordenadas de los puntos a coordenadas de píxeles
-    points_in_image_coords = []
-    for point in gdf.geometry:
-        x, y = point.x, point.y
-        # Convertir coordenadas geográficas a coordenadas de fila y columna de imagen
-        row, col = rasterio.transform.rowcol(transform, x, y)
-        points_in_image_coords.append({"x": int(col), "y": int(row)})
+    # Leer la georreferenciación del GeoTIFF si no se ha leído ya
+    transform, crs = georeference or read_georeference(image_path)
+
+    # Convertir todos los puntos a coordenadas de píxeles con una sola llamada vectorizada
+    points_in_image_coords = [{"x": x, "y": y} for x, y in shapefile_to_pixel_coords(shapefile_path, transform, crs).tolist()]
 
     # Guardar las coordenadas en un archivo JSON
     os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
@@ -84,6 +78,9 @@ def process_directory_and_draw_points(tiff_dir, shapefile_dir, json_output_dir,
     # Listar todas las imágenes GeoTIFF en el directorio de entrada
     tiff_files = [f for f in os.listdir(tiff_dir) if f.lower().endswith(('.tif', '.tiff'))]
 
+    # Leer la georreferenciación una sola vez: todos los niveles de la finca la comparten
+    georeference = read_georeference(os.path.join(tiff_dir, tiff_files[0])) if tiff_files else None
+
     # Procesar cada archivo TIFF
     for tiff_file in tqdm(tiff_files, desc="Procesando archivos", unit="archivo"):
         # Construir las rutas a los archivos de imagen y shapefile
@@ -97,7 +94,7 @@ def process_directory_and_draw_points(tiff_dir, shapefile_dir, json_output_dir,
         # Verificar que el shapefile y la imagen PNG correspondientes existan
         if os.path.exists(shapefile_path) and os.path.exists(png_image_path):
             # Convertir puntos del shapefile a coordenadas de imagen y guardarlos en JSON
-            convert_shapefile_to_image_coords(tiff_path, shapefile_path, json_output_path)
+            convert_shapefile_to_image_coords(tiff_path, shapefile_path, json_output_path, georeference)
             
             # Dibujar los puntos en la imagen PNG usando las coordenadas guardadas en el JSON
             draw_points_on_image_opencv(png_image_path, json_output_path, output_image_path)
@@ -2,70 +2,47 @@ import json
 import os
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import ndimage, signal
 from sklearn.cluster import DBSCAN
-from tqdm import tqdm
-from PIL import Image
+from procesamiento.coverage_heatmap import get_image_shape, build_coverage_grid
+from procesamiento.coverage_index import query_coverage_index
+from visualizacion.heatmap_render import get_preview_grid
 
-def create_heatmap(json_dir, image_dir, min_level=None, max_level=None, show=False):
+def create_heatmap(json_dir, image_dir, min_level=None, max_level=None, show=False, memory_budget_mb=None, heatmap_path=None, coverage_index=None):
     """
     Crea un heatmap acumulativo de detecciones de árboles a partir de archivos JSON.
+    Con memory_budget_mb la finca se procesa por bandas (ver build_coverage_grid) y con heatmap_path el
+    heatmap se guarda como memmap en disco, para fincas cuyo grid no cabe en memoria.
+    Con coverage_index el heatmap de cualquier rango de niveles se obtiene del índice acumulado de
+    cobertura con una sola resta, sin leer las detecciones. El índice debe ser de resolución completa
+    (block_size 1), para que el heatmap sea idéntico al rasterizado de las detecciones.
     
     Parameters:
-    json_dir (str): Directorio que contiene los archivos JSON de detecciones.
-    image_dir (str): Directorio que contiene las imágenes para determinar el tamaño del heatmap.
+    json_dir (str): Directorio que contiene los archivos JSON de detecciones, o ruta del almacén columnar (.npz).
+    image_dir (str): Directorio que contiene las imágenes (o el volumen de niveles) para determinar el tamaño del heatmap.
     min_level (int, optional): Nivel mínimo de archivos JSON a procesar.
     max_level (int, optional): Nivel máximo de archivos JSON a procesar.
     show (bool): Si True, muestra el heatmap.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB para el procesado por bandas.
+    heatmap_path (str, optional): Ruta .npy donde guardar el heatmap como memmap.
+    coverage_index (str, optional): Directorio del índice acumulado de cobertura con block_size 1 (ver build_coverage_index).
     """
-    def get_image_shape(image_dir):
-        image_files = [f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
-        if not image_files:
-            raise ValueError("No se encontraron imágenes en el directorio proporcionado.")
-        
-        first_image_path = os.path.join(image_dir, image_files[0])
-        with Image.open(first_image_path) as img:
-            return img.size[::-1]  # PIL retorna (ancho, altura), pero lo invertimos a (altura, ancho)
-    
-    image_shape = get_image_shape(image_dir)
-    coverage_grid = np.zeros(image_shape, dtype=int)
-    json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
-
-    # Filtrar archivos JSON por nivel si min_level y/o max_level están definidos
-    if min_level is not None or max_level is not None:
-        json_files = [
-            json_file for json_file in json_files 
-            if min_level <= int(json_file.split('_')[1]) <= max_level
-        ]
-
-    for json_file in tqdm(json_files, desc="Procesando niveles", unit="nivel"):
-        json_path = os.path.join(json_dir, json_file)
-        with open(json_path, 'r') as f:
-            detections = json.load(f)
-
-        temp_grid = np.zeros(image_shape, dtype=int)
-        for detection in detections:
-            x_center = detection['x_center']
-            y_center = detection['y_center']
-            width = detection['width']
-            height = detection['height']
-
-            x_min = int(x_center - (width / 2))
-            y_min = int(y_center - (height / 2))
-            x_max = int(x_center + (width / 2))
-            y_max = int(y_center + (height / 2))
-
-            x_min = max(0, x_min)
-            y_min = max(0, y_min)
-            x_max = min(image_shape[1], x_max)
-            y_max = min(image_shape[0], y_max)
-
-            temp_grid[y_min:y_max, x_min:x_max] = 1
-
-        coverage_grid += temp_grid
+    if coverage_index is not None:
+        # Consultar el rango de niveles en el índice acumulado (exacto, con el mismo tipo de dato que el rasterizado)
+        coverage_grid = query_coverage_index(coverage_index, min_level, max_level, json_dir=json_dir, exact=True,
+                                             output_path=heatmap_path)
+    else:
+        image_shape = get_image_shape(image_dir)
+
+        # Rasterizar las BBoxes de todos los niveles con el motor vectorizado compartido
+        coverage_grid = build_coverage_grid(json_dir, image_shape, min_level, max_level,
+                                            memory_budget_mb=memory_budget_mb, output_path=heatmap_path)
     
     if show:
+        # Representar una vista previa reducida por máximos, con las coordenadas de la finca
+        preview, _, extent = get_preview_grid(coverage_grid)
         plt.figure(figsize=(10, 8))
-        plt.imshow(coverage_grid, cmap='hot', interpolation='nearest')
+        plt.imshow(preview, cmap='hot', interpolation='nearest', extent=extent)
         plt.colorbar(label='Frecuencia de Cobertura (filtrado)')
         plt.title('Heatmap Filtrado')
         plt.gca().invert_yaxis()  # Invertir eje Y
@@ -91,8 +68,9 @@ def filter_heatmap(heatmap, min_percentage=0.1, show=False):
     
     # Visualizar el heatmap si se especifica
     if show:
+        preview, _, extent = get_preview_grid(filtered_heatmap)
         plt.figure(figsize=(10, 8))
-        plt.imshow(filtered_heatmap, cmap='hot', interpolation='nearest')
+        plt.imshow(preview, cmap='hot', interpolation='nearest', extent=extent)
         plt.colorbar(label='Frecuencia de Cobertura (filtrado)')
         plt.title('Heatmap Filtrado')
         plt.gca().invert_yaxis()  # Invertir eje Y
@@ -135,35 +113,141 @@ def apply_dbscan(filtered_heatmap, eps=3, min_samples=5, show=False):
         
     return filtered_coords, filtered_labels
 
-def calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels, show=False):
+def apply_grid_clustering(filtered_heatmap, eps=3, min_samples=5, cell_size=None, show=False):
+    """
+    Alternativa a apply_dbscan que agrupa los píxeles no nulos del heatmap filtrado trabajando sobre el
+    raster en lugar de sobre la lista de puntos, en tiempo casi lineal. Es una aproximación de DBSCAN por
+    rejilla de densidad: los píxeles se cuentan en celdas de lado cell_size, una celda es núcleo si en el
+    radio eps a su alrededor hay al menos min_samples píxeles, las celdas núcleo a menos de eps se unen
+    como componentes conexas y las celdas frontera toman la etiqueta de la celda núcleo más cercana si está
+    a menos de eps. Las distancias se miden entre centros de celda, por lo que la frontera eps tiene una
+    tolerancia del orden de cell_size. El resultado tiene el mismo formato que apply_dbscan (sin ruido).
+
+    Parameters:
+    filtered_heatmap (numpy.ndarray): Heatmap filtrado.
+    eps (float): Radio de vecindad, equivalente al eps de DBSCAN.
+    min_samples (int): Número mínimo de píxeles en el radio eps para que una celda sea núcleo.
+    cell_size (int, optional): Lado de las celdas de la rejilla en píxeles. Si es None, se usa eps / 8, con
+                               lo que el error de discretización queda muy por debajo de eps.
+    show (bool): Si True, muestra los clusters encontrados sin el ruido.
+    """
+    non_zero_coords = np.argwhere(filtered_heatmap > 0)
+    if len(non_zero_coords) == 0:
+        print("No se encontraron píxeles después del filtrado.")
+        return non_zero_coords, np.array([])
+
+    # Contar los píxeles no nulos de cada celda de la rejilla
+    cell_size = cell_size or max(1, int(eps // 8))
+    grid_shape = (-(-filtered_heatmap.shape[0] // cell_size), -(-filtered_heatmap.shape[1] // cell_size))
+    cells = non_zero_coords // cell_size
+    cell_index = cells[:, 0] * grid_shape[1] + cells[:, 1]
+    counts = np.bincount(cell_index, minlength=grid_shape[0] * grid_shape[1]).reshape(grid_shape)
+
+    # Contar los píxeles dentro del radio eps de cada celda convolucionando con un disco de celdas (FFT)
+    radius = eps / cell_size
+    reach = int(np.ceil(radius))
+    yy, xx = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    disk = (yy ** 2 + xx ** 2 <= radius ** 2).astype(float)
+    neighbor_counts = np.rint(signal.fftconvolve(counts, disk, mode='same'))
+
+    # Celdas núcleo y unión de las que están a menos de eps entre sí
+    core = (counts > 0) & (neighbor_counts >= min_samples)
+    if not core.any():
+        print("No se encontraron clusters después del clustering.")
+        return np.empty((0, 2), dtype=non_zero_coords.dtype), np.array([])
+    half_reach = int(np.ceil(radius / 2))
+    yy, xx = np.mgrid[-half_reach:half_reach + 1, -half_reach:half_reach + 1]
+    connected = ndimage.binary_dilation(core, structure=(yy ** 2 + xx ** 2 <= (radius / 2) ** 2))
+    component_labels, _ = ndimage.label(connected)
+
+    # Asignar cada celda a la celda núcleo más cercana si está dentro del radio eps
+    distances, (nearest_y, nearest_x) = ndimage.distance_transform_edt(~core, return_indices=True)
+    cell_labels = np.where(distances <= radius, component_labels[nearest_y, nearest_x], 0)
+
+    # Pasar las etiquetas de las celdas a los píxeles y descartar el ruido
+    pixel_labels = cell_labels[cells[:, 0], cells[:, 1]]
+    mask = pixel_labels > 0
+    filtered_coords = non_zero_coords[mask]
+    _, filtered_labels = np.unique(pixel_labels[mask], return_inverse=True)
+
+    if show:
+        plt.figure(figsize=(6, 5))
+        plt.scatter(filtered_coords[:, 1], filtered_coords[:, 0], c=filtered_labels, cmap='tab20b', s=10)
+        plt.gca().invert_yaxis()
+        plt.title('Clustering de Detección de Árboles (rejilla) - Sin Ruido')
+        plt.colorbar(label='Etiqueta de Cluster')
+        plt.gca().invert_yaxis()  # Invertir eje Y
+        plt.show()
+
+    return filtered_coords, filtered_labels
+
+def calculate_cluster_statistics(filtered_heatmap, non_zero_coords, labels):
+    """
+    Calcula en una sola pasada vectorizada (np.bincount y reducciones por segmentos) las estadísticas de
+    cada cluster: centro ponderado, número de píxeles, peso total, valor máximo y bounding box.
+
+    Parameters:
+    filtered_heatmap (numpy.ndarray): Heatmap filtrado.
+    non_zero_coords (numpy.ndarray): Coordenadas no nulas en el heatmap filtrado.
+    labels (numpy.ndarray): Etiquetas de cluster para las coordenadas no nulas (-1 es ruido y se ignora).
+
+    Returns:
+    dict: Arrays con una posición por cluster, ordenados por etiqueta: 'label', 'center_x', 'center_y',
+          'pixel_count', 'total_weight', 'peak_value', 'x_min', 'y_min', 'x_max' e 'y_max'.
     """
-    Calcula el centro ponderado de cada cluster.
+    # Ignorar el ruido
+    labels = np.asarray(labels)
+    mask = labels != -1
+    non_zero_coords, labels = np.asarray(non_zero_coords).reshape(-1, 2)[mask], labels[mask]
+
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    rows, cols = non_zero_coords[:, 0], non_zero_coords[:, 1]
+    values = filtered_heatmap[rows, cols].astype(np.float64)
+
+    # Sumas por cluster con np.bincount
+    pixel_count = np.bincount(inverse, minlength=len(unique_labels))
+    total_weight = np.bincount(inverse, weights=values, minlength=len(unique_labels))
+    weighted_x = np.bincount(inverse, weights=cols * values, minlength=len(unique_labels))
+    weighted_y = np.bincount(inverse, weights=rows * values, minlength=len(unique_labels))
+
+    # Máximos y mínimos por cluster reduciendo segmentos contiguos tras ordenar por etiqueta
+    order = np.argsort(inverse, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0]) if len(order) else np.zeros(0, dtype=int)
+    def reduce_segments(ufunc, array):
+        return ufunc.reduceat(array[order], starts) if len(order) else np.zeros(0, dtype=array.dtype)
+
+    return {
+        "label": unique_labels,
+        "center_x": (weighted_x / total_weight).astype(int),
+        "center_y": (weighted_y / total_weight).astype(int),
+        "pixel_count": pixel_count,
+        "total_weight": total_weight,
+        "peak_value": reduce_segments(np.maximum, values),
+        "x_min": reduce_segments(np.minimum, cols),
+        "y_min": reduce_segments(np.minimum, rows),
+        "x_max": reduce_segments(np.maximum, cols),
+        "y_max": reduce_segments(np.maximum, rows),
+    }
+
+def calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels, show=False, statistics=None):
+    """
+    Calcula el centro ponderado de cada cluster (ver calculate_cluster_statistics).
     
     Parameters:
     filtered_heatmap (numpy.ndarray): Heatmap filtrado.
     non_zero_coords (numpy.ndarray): Coordenadas no nulas en el heatmap filtrado.
     labels (numpy.ndarray): Etiquetas de cluster para las coordenadas no nulas.
     show (bool): Si True, muestra los centros de los clusters en el heatmap.
+    statistics (dict, optional): Estadísticas de los clusters ya calculadas. Si es None, se calculan.
     """
-    unique_labels = set(labels)
-    centers = []
-    
-    for label in unique_labels:
-        if label == -1:  # Ignorar el ruido
-            continue
-        
-        cluster_coords = non_zero_coords[labels == label]
-        cluster_values = filtered_heatmap[cluster_coords[:, 0], cluster_coords[:, 1]]
-        
-        total_weight = np.sum(cluster_values)
-        center_x = int(np.sum(cluster_coords[:, 1] * cluster_values) / total_weight)
-        center_y = int(np.sum(cluster_coords[:, 0] * cluster_values) / total_weight)
-        
-        centers.append((center_x, center_y))
+    if statistics is None:
+        statistics = calculate_cluster_statistics(filtered_heatmap, non_zero_coords, labels)
+    centers = list(zip(statistics["center_x"].tolist(), statistics["center_y"].tolist()))
     
     if show:
+        preview, _, extent = get_preview_grid(filtered_heatmap)
         plt.figure(figsize=(6, 5))
-        plt.imshow(filtered_heatmap, cmap='hot', interpolation='nearest')
+        plt.imshow(preview, cmap='hot', interpolation='nearest', extent=extent)
         plt.scatter([c[0] for c in centers], [c[1] for c in centers], color='blue', marker='x', s=100, label='Centro de Árbol')
         plt.gca().invert_yaxis()
         plt.title('Centros de los Árboles Detectados')
@@ -172,12 +256,14 @@ def calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels, show=Fa
         
     return centers
 
-def detect_trees_from_heatmap(json_dir, image_dir, output_path=None, min_percentage=0.105, dbscan_eps=50, dbscan_min_samples=200, min_level=None, max_level=None, show_steps=False):
+def detect_trees_from_heatmap(json_dir, image_dir, output_path=None, min_percentage=0.105, dbscan_eps=50, dbscan_min_samples=200, min_level=None, max_level=None, show_steps=False, memory_budget_mb=None, clustering_method='dbscan', statistics_path=None, heatmap=None, coverage_index=None):
     """
     Detecta árboles en un heatmap utilizando filtrado, clustering y cálculo de centros.
+    El clustering puede hacerse con DBSCAN sobre los píxeles ('dbscan') o con la aproximación por rejilla
+    de densidad sobre el raster ('grid', ver apply_grid_clustering), que usa los mismos eps y min_samples.
 
     Parameters:
-    json_dir (str): Directorio de detecciones JSON.
+    json_dir (str): Directorio de detecciones JSON o ruta del almacén columnar (.npz).
     image_dir (str): Directorio de imágenes de referencia para el tamaño del heatmap.
     output_path (str, optional): Ruta para guardar la lista de centros detectados. Si es None, no guarda.
     min_percentage (float): Porcentaje mínimo para el filtrado en relación al valor máximo del heatmap.
@@ -186,11 +272,28 @@ def detect_trees_from_heatmap(json_dir, image_dir, output_path=None, min_percent
     min_level (int, optional): Nivel mínimo de archivos JSON a procesar.
     max_level (int, optional): Nivel máximo de archivos JSON a procesar.
     show_steps (bool): Si True, muestra los resultados de cada paso.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB para crear el heatmap por bandas.
+    clustering_method (str): Método de clustering, 'dbscan' o 'grid'. Default: 'dbscan'.
+    statistics_path (str, optional): Ruta para guardar las estadísticas de cada cluster (ver
+                                     calculate_cluster_statistics) para control de calidad. Si es None, no guarda.
+    heatmap (numpy.ndarray, optional): Heatmap ya calculado para el mismo rango de niveles (ver
+                                       get_or_create_heatmap). Si se indica, no se leen las detecciones.
+    coverage_index (str, optional): Directorio del índice acumulado de cobertura (con block_size 1) para crear el heatmap.
     """
-    heatmap = create_heatmap(json_dir, image_dir, min_level=min_level, max_level=max_level, show=show_steps)
+    if heatmap is None:
+        heatmap = create_heatmap(json_dir, image_dir, min_level=min_level, max_level=max_level, show=show_steps,
+                                 memory_budget_mb=memory_budget_mb, coverage_index=coverage_index)
     filtered_heatmap = filter_heatmap(heatmap, min_percentage=min_percentage, show=show_steps)
-    non_zero_coords, labels = apply_dbscan(filtered_heatmap, eps=dbscan_eps, min_samples=dbscan_min_samples, show=show_steps)
-    centers = calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels, show=show_steps)
+    if clustering_method == 'dbscan':
+        non_zero_coords, labels = apply_dbscan(filtered_heatmap, eps=dbscan_eps, min_samples=dbscan_min_samples, show=show_steps)
+    elif clustering_method == 'grid':
+        non_zero_coords, labels = apply_grid_clustering(filtered_heatmap, eps=dbscan_eps, min_samples=dbscan_min_samples, show=show_steps)
+    else:
+        raise ValueError(f"Método de clustering no válido: {clustering_method}. Use 'dbscan' o 'grid'.")
+
+    # Estadísticas de los clusters, calculadas una sola vez para los centros y el control de calidad
+    statistics = calculate_cluster_statistics(filtered_heatmap, non_zero_coords, labels)
+    centers = calculate_cluster_centers(filtered_heatmap, non_zero_coords, labels, show=show_steps, statistics=statistics)
 
     # Guardar los centros detectados si se especifica output_path
     if output_path:
@@ -199,7 +302,15 @@ def detect_trees_from_heatmap(json_dir, image_dir, output_path=None, min_percent
             json.dump(centers, f, indent=4)
         print(f"Centros de árboles guardados en: {output_path}")
 
+    # Guardar las estadísticas de cada cluster si se especifica statistics_path
+    if statistics_path:
+        os.makedirs(os.path.dirname(statistics_path), exist_ok=True)
+        with open(statistics_path, 'w') as f:
+            json.dump([dict(zip(statistics, values)) for values in zip(*(v.tolist() for v in statistics.values()))], f, indent=4)
+        print(f"Estadísticas de clusters guardadas en: {statistics_path}")
+
     return centers
 
 # Ejemplo de uso:
-# centers = detect_trees_from_heatmap("data/finca/detections/remapped_detections", "data/finca/rgb_images", "data/finca/detections/tree_centers.json", min_percentage=0.105, dbscan_eps=5, dbscan_min_samples=10, min_level=100, max_level=250, show_steps=True)
\ No newline at end of file
+# centers = detect_trees_from_heatmap("data/finca/detections/remapped_detections", "data/finca/rgb_images", "data/finca/detections/tree_centers.json", min_percentage=0.105, dbscan_eps=5, dbscan_min_samples=10, min_level=100, max_level=250, show_steps=True)
+# centers = detect_trees_from_heatmap("data/finca/detections/remapped_detections.npz", "data/finca/volume", "data/finca/detections/tree_centers.json", min_level=100, max_level=250, clustering_method='grid')
@@ -1,11 +1,13 @@
 # Importaciones de los módulos
 from procesamiento.initial_checks import check_same_image_sizes
-from procesamiento.convert_tiff_to_png import convert_tiff_to_png
-from procesamiento.create_blank_density_image import create_blank_density_image
-from procesamiento.combine_channels_to_rgb import combine_channels_to_rgb_batch
-from procesamiento.crop_images import crop_images
+from procesamiento.ingest_levels import ingest_levels_to_rgb
+from procesamiento.level_volume import build_level_volume
+from procesamiento.crop_images import CropSource
 from procesamiento.apply_yolo import apply_yolo_to_crops
+from procesamiento.pipeline import run_streaming_pipeline
 from procesamiento.postprocess_detections import split_detections_by_level, remap_detections_to_original
+from procesamiento.detection_store import build_detection_store
+from procesamiento.coverage_heatmap import get_or_create_heatmap
 from visualizacion.visualize_detections import draw_all_detections
 from visualizacion.heatmap_visualization import draw_coverage_heatmap
 from evaluacion.tree_identification import detect_trees_from_heatmap
@@ -17,36 +19,50 @@ finca = "P7"
 min_level = 100
 max_level = 250
 
+# Número de procesos para las etapas paralelizables
+num_workers = 4
+
 # Paso 0: Comprobar que todas las imágenes tienen el mismo tamaño
 check_same_image_sizes(f"data/{finca}/1cm_meanint", f"data/{finca}/1cm_maxint")
 
-# Paso 1: Convertir TIFF a PNG
-convert_tiff_to_png(f"data/{finca}/1cm_meanint", f"data/{finca}/png_channels/meanint")
-convert_tiff_to_png(f"data/{finca}/1cm_maxint", f"data/{finca}/png_channels/maxint")
-create_blank_density_image(f"data/{finca}/1cm_maxint", f"data/{finca}/png_channels/density/density_blank.png")
-
-# Paso 2: Combinar los canales en una imagen RGB
-combine_channels_to_rgb_batch(f"data/{finca}/png_channels/meanint", 
-                              f"data/{finca}/png_channels/maxint", 
-                              f"data/{finca}/png_channels/density/", 
-                              f"data/{finca}/rgb_images/")
+# Paso 1 y 2: Leer los TIFF de cada nivel una sola vez y construir el volumen RGB de niveles (density constante en negro)
+# Si se quieren exportar las imágenes RGB en PNG: ingest_levels_to_rgb(f"data/{finca}/1cm_meanint", f"data/{finca}/1cm_maxint", f"data/{finca}/rgb_images/")
+build_level_volume(f"data/{finca}/1cm_meanint", f"data/{finca}/1cm_maxint", f"data/{finca}/volume", num_workers=num_workers)
 
-# Paso 3: Realizar crops de la imagen RGB
-crop_images(f"data/{finca}/rgb_images/", f"data/{finca}/crops/")
+# Paso 3: Generar los crops leyendo ventanas del volumen, sin escribirlos en disco
+# (debug_output_dir=f"data/{finca}/crops/" los guarda también en PNG para depuración)
+# Los crops sin contenido en el canal maxint (fuera de la zona escaneada o por encima de la copa) se omiten
+crop_source = CropSource(f"data/{finca}/volume", min_max_intensity=1)
 
 # Paso 4: Detectar las secciones con YOLO
+# Alternativa con carga, recorte, inferencia y escritura solapadas (sustituye a los pasos 3 y 4):
+# run_streaming_pipeline(f"data/{finca}/volume", f"data/{finca}/detections/detections.jsonl", model, batch_size=16,
+#                        cache_dir=f"data/{finca}/detections/cache")
 model = "entrenamiento/runs/detect/train2/weights/best.pt"
-apply_yolo_to_crops(f"data/{finca}/crops", f"data/{finca}/detections/detections.json", model)
+apply_yolo_to_crops(crop_source, f"data/{finca}/detections/detections.jsonl", model, batch_size=16,
+                    cache_dir=f"data/{finca}/detections/cache")
 
-# Paso 5.1: Mapear detecciones a dimensiones de la finca
-split_detections_by_level(f"data/{finca}/detections/detections.json", f"data/{finca}/detections/level_detections")
-remap_detections_to_original(f"data/{finca}/detections/level_detections", f"data/{finca}/detections/remapped_detections")
+# Paso 5.1: Mapear detecciones a dimensiones de la finca, fusionar los duplicados entre crops solapados
+# y guardarlas en el almacén columnar
+# (split_detections_by_level + remap_detections_to_original generan en su lugar un JSON por nivel)
+detections = f"data/{finca}/detections/remapped_detections.npz"
+build_detection_store(f"data/{finca}/detections/detections.jsonl", detections, merge='nms')
 
 # Paso 5.2: Visualización de detecciones
-draw_all_detections(f"data/{finca}/rgb_images", f"data/{finca}/detections/remapped_detections", f"data/{finca}/visualization/detections_output")
-draw_coverage_heatmap(f"data/{finca}/detections/remapped_detections", f"data/{finca}/rgb_images", 
-                      f"data/{finca}/visualization/", min_level=min_level, max_level=max_level)
+# Para fincas grandes, render_detection_pyramids (visualizacion/tile_pyramid.py) genera en su lugar teselas XYZ navegables
+draw_all_detections(f"data/{finca}/volume", detections, f"data/{finca}/visualization/detections_output",
+                    num_workers=num_workers, compression=1)
+
+# Paso 5.3: Heatmap de cobertura, construido una sola vez y guardado en disco para los pasos siguientes
+# Para explorar distintos rangos de niveles: build_coverage_index(detections, f"data/{finca}/volume", f"data/{finca}/coverage_index")
+# y después draw_coverage_heatmap con coverage_index=f"data/{finca}/coverage_index"; create_heatmap / detect_trees_from_heatmap
+# con coverage_index necesitan un índice exacto, construido con block_size=1
+heatmap = get_or_create_heatmap(detections, f"data/{finca}/volume", f"data/{finca}/heatmaps",
+                                min_level=min_level, max_level=max_level)
+draw_coverage_heatmap(detections, f"data/{finca}/volume", 
+                      f"data/{finca}/visualization/", min_level=min_level, max_level=max_level, heatmap=heatmap,
+                      renderer='native')
 
 # Paso 6: Identificación de árboles
-detect_trees_from_heatmap(f"data/{finca}/detections/remapped_detections", f"data/{finca}/rgb_images", 
-                          f"data/{finca}/results/tree_centers.json", min_level=min_level, max_level=max_level)
\ No newline at end of file
+detect_trees_from_heatmap(detections, f"data/{finca}/volume", 
+                          f"data/{finca}/results/tree_centers.json", min_level=min_level, max_level=max_level, heatmap=heatmap)
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
-import json
+import numpy as np
+import cv2
 from ultralytics import YOLO
 from tqdm import tqdm
+from procesamiento.detection_cache import DetectionCache, hash_crop_pixels
+from procesamiento.detections_io import DetectionWriter
 
 def load_yolo_model(model_path):
     """
@@ -16,62 +19,186 @@ def load_yolo_model(model_path):
     model = YOLO(model_path)
     return model
 
-def apply_yolo_to_crops(crop_dir, output_json_path, model_path):
+def iter_crop_inputs(crop_dir):
+    """
+    Genera pares (nombre_crop, entrada_modelo) a partir de un directorio de crops o de una fuente de crops.
+
+    Parameters:
+    crop_dir (str or iterable): Directorio con los PNG de los crops, o iterable de tuplas (nivel, x, y, crop)
+                                como CropSource, con los crops en RGB.
+    """
+    if isinstance(crop_dir, str):
+        # Listar todos los archivos en el directorio de crops
+        for crop_file in os.listdir(crop_dir):
+            if crop_file.endswith('.png'):
+                yield crop_file, os.path.join(crop_dir, crop_file)
+    else:
+        for level_name, x, y, crop in crop_dir:
+            # YOLO espera arrays en orden BGR, como los devuelve cv2.imread
+            yield f"{level_name}_{x}_{y}.png", np.ascontiguousarray(crop[..., ::-1])
+
+def iter_batches(iterable, batch_size):
+    """
+    Agrupa los elementos de un iterable en listas de tamaño batch_size (la última puede ser menor).
+
+    Parameters:
+    iterable (iterable): Elementos a agrupar.
+    batch_size (int): Tamaño de cada lote.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def extract_boxes(result):
+    """
+    Extrae las cajas de un resultado de YOLO como tensores completos (xywh, conf, cls) en lugar de caja a caja.
+
+    Parameters:
+    result (ultralytics.engine.results.Results): Resultado de YOLO para un crop.
+
+    Returns:
+    list: Lista de cajas [x_center, y_center, width, height, confidence, class].
+    """
+    boxes = result.boxes  # Las cajas detectadas
+    if len(boxes) == 0:
+        return []
+
+    # Extraer coordenadas (x_center, y_center, width, height), confianzas y clases de una vez
+    xywh = boxes.xywh.cpu().numpy().tolist()
+    confidences = boxes.conf.cpu().numpy().tolist()
+    classes = boxes.cls.cpu().numpy().astype(int).tolist()
+    return [coords + [confidence, cls] for coords, confidence, cls in zip(xywh, confidences, classes)]
+
+def boxes_to_detections(crop_file, boxes):
+    """
+    Convierte una lista de cajas [x_center, y_center, width, height, confidence, class] en diccionarios de detección.
+
+    Parameters:
+    crop_file (str): Nombre del crop al que pertenecen las cajas.
+    boxes (list): Lista de cajas.
+
+    Returns:
+    list: Lista de diccionarios con las detecciones del crop.
+    """
+    return [
+        {
+            "image": crop_file,
+            "x_center": x_center,
+            "y_center": y_center,
+            "width": width,
+            "height": height,
+            "confidence": confidence,
+            "class": int(cls)
+        }
+        for x_center, y_center, width, height, confidence, cls in boxes
+    ]
+
+def extract_detections(result, crop_file):
+    """
+    Convierte las cajas de un resultado de YOLO en diccionarios de detección.
+
+    Parameters:
+    result (ultralytics.engine.results.Results): Resultado de YOLO para un crop.
+    crop_file (str): Nombre del crop al que pertenece el resultado.
+
+    Returns:
+    list: Lista de diccionarios con las detecciones del crop.
+    """
+    return boxes_to_detections(crop_file, extract_boxes(result))
+
+def infer_batch(model, batch, cache=None, inference_settings=None):
+    """
+    Aplica el modelo YOLO a un lote de crops y devuelve sus detecciones. Si se proporciona una caché,
+    los crops ya presentes en ella no pasan por el modelo y los nuevos resultados se añaden a la caché.
+
+    Parameters:
+    model (YOLO): Modelo YOLO cargado.
+    batch (list): Lista de pares (nombre_crop, entrada_modelo), donde la entrada es una ruta o un array BGR.
+    cache (DetectionCache, optional): Caché de detecciones.
+    inference_settings (dict, optional): Parámetros adicionales para la llamada al modelo.
+
+    Returns:
+    list: Lista de diccionarios con las detecciones del lote.
+    """
+    detections = []
+    pending = []
+    for crop_file, model_input in batch:
+        if cache is None:
+            pending.append((crop_file, model_input, None))
+            continue
+
+        # Leer los píxeles del crop (igual que YOLO lee los PNG) para calcular su clave
+        if isinstance(model_input, str):
+            model_input = cv2.imread(model_input)
+        key = hash_crop_pixels(model_input)
+        boxes = cache.get(key)
+        if boxes is None:
+            pending.append((crop_file, model_input, key))
+        else:
+            detections.extend(boxes_to_detections(crop_file, boxes))
+
+    if pending:
+        # Realizar la predicción con YOLO sobre los crops del lote que no están en caché
+        preds = model([model_input for _, model_input, _ in pending], verbose=False, **(inference_settings or {}))
+
+        # Extraer las detecciones de cada crop del lote
+        for (crop_file, _, key), result in zip(pending, preds):
+            boxes = extract_boxes(result)
+            if cache is not None:
+                cache.put(key, boxes)
+            detections.extend(boxes_to_detections(crop_file, boxes))
+
+    return detections
+
+def apply_yolo_to_crops(crop_dir, output_json_path, model_path, batch_size=1, cache_dir=None, inference_settings=None, checkpoint_every=500):
     """
     Aplica el modelo YOLO a cada crop en un directorio y guarda los resultados en un JSON.
+    Si output_json_path termina en '.jsonl', las detecciones se escriben en formato JSON Lines a medida que
+    se infieren, sin acumularlas en memoria. Los crops se envían al modelo en lotes de batch_size para repartir el coste fijo de cada llamada.
+    Si se indica cache_dir, las detecciones de cada crop se guardan en una caché persistente direccionada por
+    los píxeles del crop, los pesos del modelo y los parámetros de inferencia; los crops ya presentes en la
+    caché no pasan por el modelo y una ejecución interrumpida se reanuda desde el último volcado.
 
     Parameters:
-    crop_dir (str): Directorio que contiene las imágenes de los crops.
-    output_json_path (str): Ruta donde se guardará el archivo JSON con los resultados.
+    crop_dir (str or CropSource): Directorio que contiene las imágenes de los crops, o una fuente de crops
+                                  (ver crop_images.CropSource) que los lee directamente de las imágenes de nivel.
+    output_json_path (str): Ruta donde se guardará el archivo JSON (.json o .jsonl) con los resultados.
     model_path (str): Ruta al archivo del modelo YOLO entrenado (.pt).
+    batch_size (int): Número de crops por llamada al modelo. Default: 1.
+    cache_dir (str, optional): Directorio de la caché de detecciones. Si es None, no se usa caché.
+    inference_settings (dict, optional): Parámetros adicionales para la llamada al modelo (conf, iou, imgsz...).
+    checkpoint_every (int): Cada cuántos crops nuevos se vuelca la caché a disco. Default: 500.
     """
     # Crear la carpeta de salida si no existe
     os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
 
+    inference_settings = inference_settings or {}
+
     # Cargar el modelo YOLO
     model = load_yolo_model(model_path)
 
-    # Listar todos los archivos en el directorio de crops
-    crop_files = [f for f in os.listdir(crop_dir) if f.endswith('.png')]
-
-    # Lista para almacenar todos los resultados
-    results = []
-
-    # Procesar cada crop con una barra de progreso
-    for crop_file in tqdm(crop_files, desc="Aplicando YOLO a crops", unit="imagen"):
-        crop_path = os.path.join(crop_dir, crop_file)
-
-        # Realizar la predicción con YOLO
-        preds = model(crop_path)
-
-        # Extraer las detecciones
-        for result in preds:
-            boxes = result.boxes  # Las cajas detectadas
-
-            # Recorrer cada detección y guardar la información relevante
-            for box in boxes:
-                # Extraer coordenadas y detalles de la detección
-                x_center, y_center, width, height = box.xywh[0]  # x_center, y_center, width, height
-                confidence = box.conf[0]  # Confianza de la detección
-                cls = int(box.cls[0])  # Clase de la detección
-
-                # Convertir a formato de JSON
-                detection_result = {
-                    "image": crop_file,
-                    "x_center": float(x_center),
-                    "y_center": float(y_center),
-                    "width": float(width),
-                    "height": float(height),
-                    "confidence": float(confidence),
-                    "class": cls
-                }
-                results.append(detection_result)
-
-    # Guardar todos los resultados en un archivo JSON
-    with open(output_json_path, 'w') as json_file:
-        json.dump(results, json_file, indent=4)
+    # Abrir la caché de detecciones si se ha indicado
+    cache = DetectionCache(cache_dir, model_path, inference_settings, checkpoint_every) if cache_dir else None
+
+    total = None if isinstance(crop_dir, str) else len(crop_dir)
+
+    # Procesar los crops por lotes con una barra de progreso, escribiendo los resultados a medida que llegan
+    with DetectionWriter(output_json_path) as writer, tqdm(total=total, desc="Aplicando YOLO a crops", unit="imagen") as progress:
+        for batch in iter_batches(iter_crop_inputs(crop_dir), batch_size):
+            writer.write(infer_batch(model, batch, cache, inference_settings))
+            progress.update(len(batch))
+
+    if cache is not None:
+        cache.close()
 
     print(f"Resultados guardados en {output_json_path}")
 
 # Ejemplo de uso
-# apply_yolo_to_crops("data/P28/crop_images", "data/P28/detections/detections.json", "path/to/your/model.pt")
\ No newline at end of file
+# apply_yolo_to_crops("data/P28/crop_images", "data/P28/detections/detections.json", "path/to/your/model.pt")
+# apply_yolo_to_crops(CropSource("data/P28/volume"), "data/P28/detections/detections.json", "path/to/your/model.pt", batch_size=16,
+#                     cache_dir="data/P28/detections/cache")
\ No newline at end of file
@@ -1,42 +1,151 @@
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 import numpy as np
 import tifffile
 from tqdm import tqdm
 
-def convert_tiff_to_png(input_dir, output_dir):
+MANIFEST_FILENAME = ".conversion_manifest.json"
+
+def get_source_signature(*paths):
+    """
+    Devuelve la firma (mtime, tamaño) de uno o varios archivos de origen.
+    Si cambia la firma, el archivo de salida derivado debe regenerarse.
+
+    Parameters:
+    *paths (str): Rutas de los archivos de origen.
+
+    Returns:
+    list: Lista de pares [mtime_ns, tamaño] en el mismo orden que las rutas.
+    """
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append([stat.st_mtime_ns, stat.st_size])
+    return signature
+
+def load_manifest(output_dir):
+    """
+    Carga el manifiesto de conversiones de un directorio de salida. Si no existe o está corrupto
+    (por ejemplo, tras una interrupción), devuelve un manifiesto vacío.
+
+    Parameters:
+    output_dir (str): Directorio de salida que contiene el manifiesto.
+
+    Returns:
+    dict: Diccionario {nombre_salida: firma_de_origen}.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    """
+    Guarda el manifiesto de conversiones de forma atómica (archivo temporal + renombrado).
+
+    Parameters:
+    output_dir (str): Directorio de salida donde se guardará el manifiesto.
+    manifest (dict): Diccionario {nombre_salida: firma_de_origen}.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def is_up_to_date(manifest, output_dir, output_file, signature):
+    """
+    Comprueba si un archivo de salida existe y fue generado a partir de origen(es) con la misma firma.
+
+    Parameters:
+    manifest (dict): Manifiesto cargado con load_manifest.
+    output_dir (str): Directorio de salida.
+    output_file (str): Nombre del archivo de salida.
+    signature (list): Firma actual de los archivos de origen (ver get_source_signature).
+    """
+    return manifest.get(output_file) == signature and os.path.exists(os.path.join(output_dir, output_file))
+
+def convert_single_tiff_to_png(tiff_path, png_path):
+    """
+    Convierte una única imagen .tif a .png en formato uint8.
+
+    Parameters:
+    tiff_path (str): Ruta de la imagen .tif de entrada.
+    png_path (str): Ruta de la imagen .png de salida.
+    """
+    # Leer la imagen .tif y convertirla a uint8
+    img = tifffile.imread(tiff_path).astype(np.uint8)
+
+    # Guardar la imagen en formato .png
+    Image.fromarray(img).save(png_path, "PNG")
+
+def convert_tiff_to_png(input_dir, output_dir, num_workers=1, skip_up_to_date=True, checkpoint_every=20):
     """
     Convierte todas las imágenes .tif de una carpeta a .png y las guarda en la carpeta especificada.
     Convierte a formato uint8 para asegurarse de que las imágenes sean compatibles con PNG.
-    
+    Opcionalmente reparte los archivos entre varios procesos y omite las salidas cuyo TIFF de origen
+    no ha cambiado (mismo mtime y tamaño) desde la última conversión.
+
     Parameters:
     input_dir (str): Directorio de entrada que contiene las imágenes .tif.
     output_dir (str): Directorio de salida donde se guardarán las imágenes .png.
+    num_workers (int): Número de procesos para la conversión. Si es 1, se convierte en serie. Default: 1.
+    skip_up_to_date (bool): Si True, omite los PNG ya generados a partir del mismo TIFF. Default: True.
+    checkpoint_every (int): Cada cuántas conversiones se guarda el manifiesto, para poder reanudar
+                            tras una interrupción. Default: 20.
     """
     # Verificar que el directorio de salida exista, si no, crearlo
     os.makedirs(output_dir, exist_ok=True)
-    
+
     # Listar todos los archivos .tif en el directorio de entrada
     tiff_files = [f for f in os.listdir(input_dir) if f.endswith('.tif')]
-    
-    # Iterar sobre los archivos .tif con tqdm para mostrar el progreso
-    for tiff_file in tqdm(tiff_files, desc="Convirtiendo TIFF a PNG", unit="archivo"):
-        # Ruta completa al archivo .tif
+
+    # Cargar el manifiesto de conversiones previas
+    manifest = load_manifest(output_dir) if skip_up_to_date else {}
+
+    # Determinar qué archivos necesitan conversión
+    pending = []
+    for tiff_file in tiff_files:
         tiff_path = os.path.join(input_dir, tiff_file)
-        
-        # Leer la imagen .tif y convertirla a uint8
-        img = tifffile.imread(tiff_path).astype(np.uint8)
-        
-        # Convertir la imagen a un objeto PIL
-        pil_img = Image.fromarray(img)
-        
-        # Nombre del archivo .png de salida
         png_file = os.path.splitext(tiff_file)[0] + ".png"
-        png_path = os.path.join(output_dir, png_file)
-        
-        # Guardar la imagen en formato .png
-        pil_img.save(png_path, "PNG")
+        signature = get_source_signature(tiff_path)
+        if skip_up_to_date and is_up_to_date(manifest, output_dir, png_file, signature):
+            continue
+        pending.append((tiff_path, png_file, signature))
+
+    skipped = len(tiff_files) - len(pending)
+    if skipped:
+        print(f"Omitidos {skipped} archivos ya convertidos y sin cambios.")
+
+    # Iterar sobre los archivos .tif con tqdm para mostrar el progreso
+    if num_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                executor.submit(convert_single_tiff_to_png, tiff_path, os.path.join(output_dir, png_file)): (png_file, signature)
+                for tiff_path, png_file, signature in pending
+            }
+            for done, future in enumerate(tqdm(as_completed(futures), total=len(futures), desc="Convirtiendo TIFF a PNG", unit="archivo"), start=1):
+                future.result()
+                png_file, signature = futures[future]
+                manifest[png_file] = signature
+                if done % checkpoint_every == 0:
+                    save_manifest(output_dir, manifest)
+    else:
+        for done, (tiff_path, png_file, signature) in enumerate(tqdm(pending, desc="Convirtiendo TIFF a PNG", unit="archivo"), start=1):
+            convert_single_tiff_to_png(tiff_path, os.path.join(output_dir, png_file))
+            manifest[png_file] = signature
+            if done % checkpoint_every == 0:
+                save_manifest(output_dir, manifest)
+
+    # Guardar el manifiesto final
+    save_manifest(output_dir, manifest)
 
 # Uso en el main o en notebook
 # convert_tiff_to_png("data/1cm_meanint", "data/png_channels/meanint")
-# convert_tiff_to_png("data/1cm_maxint", "data/png_channels/maxint")
\ No newline at end of file
+# convert_tiff_to_png("data/1cm_maxint", "data/png_channels/maxint", num_workers=4)
@@ -0,0 +1,290 @@
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from procesamiento.convert_tiff_to_png import get_source_signature
+from procesamiento.detections_io import list_detection_files
+from procesamiento.detection_store import iter_level_boxes, is_detection_store
+from procesamiento.level_volume import is_level_volume, get_volume_image_shape
+
+def get_image_shape(image_dir):
+    """
+    Devuelve el tamaño (alto, ancho) de las imágenes de la finca a partir de la primera imagen del directorio
+    o del índice del volumen de niveles.
+
+    Parameters:
+    image_dir (str): Directorio de imágenes o volumen de niveles.
+    """
+    # Si es un volumen de niveles, el tamaño está en su índice
+    if is_level_volume(image_dir):
+        return get_volume_image_shape(image_dir)
+
+    image_files = [f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
+    if not image_files:
+        raise ValueError("No se encontraron imágenes en el directorio proporcionado.")
+
+    # Cargar la primera imagen para obtener el tamaño
+    first_image_path = os.path.join(image_dir, image_files[0])
+    with Image.open(first_image_path) as img:
+        return img.size[::-1]  # PIL retorna (ancho, altura), pero lo invertimos a (altura, ancho)
+
+def boxes_to_pixel_bounds(x_center, y_center, width, height, image_shape):
+    """
+    Convierte cajas (centro, ancho, alto) en límites enteros de píxel [x_min, x_max) x [y_min, y_max),
+    truncando y recortando a la imagen igual que el pintado caja a caja original.
+
+    Parameters:
+    x_center, y_center, width, height (numpy.ndarray): Columnas de las cajas.
+    image_shape (tuple): Tamaño (alto, ancho) de la imagen.
+
+    Returns:
+    tuple: Arrays (x_min, y_min, x_max, y_max) de tipo int64.
+    """
+    x_center = np.asarray(x_center, dtype=np.float64)
+    y_center = np.asarray(y_center, dtype=np.float64)
+    half_width = np.asarray(width, dtype=np.float64) / 2
+    half_height = np.asarray(height, dtype=np.float64) / 2
+
+    x_min = np.maximum(0, np.trunc(x_center - half_width).astype(np.int64))
+    y_min = np.maximum(0, np.trunc(y_center - half_height).astype(np.int64))
+    x_max = np.minimum(image_shape[1], np.trunc(x_center + half_width).astype(np.int64))
+    y_max = np.minimum(image_shape[0], np.trunc(y_center + half_height).astype(np.int64))
+    return x_min, y_min, x_max, y_max
+
+class CoverageRasterizer:
+    """
+    Motor de rasterizado de cajas para los heatmaps de cobertura. Pinta todas las cajas de un nivel en una sola
+    pasada vectorizada con un array de diferencias 2D y sumas acumuladas, recorta el resultado del nivel a 0/1
+    (cada nivel suma como máximo 1 por píxel) y lo acumula en el grid de cobertura. Los buffers se reservan una
+    vez y se reutilizan entre niveles, y cada nivel solo recorre la región que ocupan sus cajas.
+
+    Parameters:
+    image_shape (tuple): Tamaño (alto, ancho) del grid de cobertura.
+    dtype (numpy.dtype): Tipo de dato del grid de cobertura. Default: int.
+    grid (numpy.ndarray, optional): Grid existente (o vista de una banda) sobre el que acumular.
+    """
+    def __init__(self, image_shape, dtype=int, grid=None):
+        self.image_shape = tuple(image_shape)
+        self.grid = np.zeros(self.image_shape, dtype=dtype) if grid is None else grid
+        self._diff = np.zeros((self.image_shape[0] + 1, self.image_shape[1] + 1), dtype=np.int32)
+        self._mask = np.zeros(self.image_shape, dtype=bool)
+
+    def add_level_bounds(self, x_min, y_min, x_max, y_max):
+        """
+        Acumula un nivel a partir de los límites enteros de sus cajas (x_max e y_max excluidos).
+
+        Parameters:
+        x_min, y_min, x_max, y_max (numpy.ndarray): Límites de las cajas del nivel, ya recortados a la imagen.
+        """
+        x_min, y_min, x_max, y_max = (np.asarray(v, dtype=np.int64) for v in (x_min, y_min, x_max, y_max))
+
+        # Descartar cajas vacías (igual que un slice vacío no pinta nada)
+        valid = (x_min < x_max) & (y_min < y_max)
+        if not valid.any():
+            return
+        x_min, y_min, x_max, y_max = x_min[valid], y_min[valid], x_max[valid], y_max[valid]
+
+        # Región del nivel que contiene todas sus cajas
+        y0, y1 = y_min.min(), y_max.max()
+        x0, x1 = x_min.min(), x_max.max()
+        diff = self._diff[y0:y1 + 1, x0:x1 + 1]
+
+        # Marcar las esquinas de cada caja en el array de diferencias
+        np.add.at(diff, (y_min - y0, x_min - x0), 1)
+        np.add.at(diff, (y_min - y0, x_max - x0), -1)
+        np.add.at(diff, (y_max - y0, x_min - x0), -1)
+        np.add.at(diff, (y_max - y0, x_max - x0), 1)
+
+        # Las sumas acumuladas dan el número de cajas que cubren cada píxel
+        np.cumsum(diff, axis=0, out=diff)
+        np.cumsum(diff, axis=1, out=diff)
+
+        # Recortar a 0/1 y acumular en el grid de cobertura
+        mask = self._mask[y0:y1, x0:x1]
+        np.greater(diff[:-1, :-1], 0, out=mask)
+        region = self.grid[y0:y1, x0:x1]
+        np.add(region, mask, out=region, casting='unsafe')
+
+        # Dejar el buffer de diferencias a cero para el siguiente nivel
+        diff[...] = 0
+
+    def add_level(self, x_center, y_center, width, height):
+        """
+        Acumula un nivel a partir de las cajas (centro, ancho, alto) de sus detecciones.
+
+        Parameters:
+        x_center, y_center, width, height (numpy.ndarray): Columnas de las cajas del nivel.
+        """
+        self.add_level_bounds(*boxes_to_pixel_bounds(x_center, y_center, width, height, self.image_shape))
+
+def get_coverage_dtype(num_levels):
+    """
+    Devuelve el tipo entero sin signo más pequeño capaz de almacenar la cobertura de num_levels niveles
+    (uint8 hasta 255 niveles, uint16 hasta 65535).
+
+    Parameters:
+    num_levels (int): Número de niveles que se acumulan en el grid.
+    """
+    return np.min_scalar_type(max(1, num_levels))
+
+def compute_band_rows(image_shape, memory_budget_mb=None):
+    """
+    Calcula el número de filas de cada banda del grid para que los buffers de trabajo del rasterizado
+    (array de diferencias int32 y máscara booleana) no superen el presupuesto de memoria.
+
+    Parameters:
+    image_shape (tuple): Tamaño (alto, ancho) del grid.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB. Si es None, se usa una sola banda.
+    """
+    if memory_budget_mb is None:
+        return image_shape[0]
+    bytes_per_row = (image_shape[1] + 1) * np.dtype(np.int32).itemsize + image_shape[1]
+    return int(min(image_shape[0], max(1, memory_budget_mb * 1024 ** 2 // bytes_per_row - 1)))
+
+def build_coverage_grid(json_dir, image_shape, min_level=None, max_level=None, memory_budget_mb=None, output_path=None, dtype=None):
+    """
+    Construye el grid de cobertura de detecciones: para cada píxel, el número de niveles en los que alguna
+    caja lo cubre. El grid se procesa por bandas horizontales cuyos buffers de trabajo respetan el presupuesto
+    de memoria, y cada banda se escribe en su posición del grid completo, de forma que el máximo global y el
+    resultado son los mismos que procesando la finca entera de una vez. Con output_path el grid se guarda
+    como un memmap .npy en disco y no necesita caber en memoria.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_shape (tuple): Tamaño (alto, ancho) del grid.
+    min_level (int, optional): Nivel mínimo a procesar.
+    max_level (int, optional): Nivel máximo a procesar.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB para los buffers de cada banda.
+                                        Si es None, se procesa la finca en una sola banda.
+    output_path (str, optional): Ruta .npy donde se crea el grid como memmap. Si es None, se crea en memoria.
+    dtype (numpy.dtype, optional): Tipo del grid. Si es None, el entero sin signo más pequeño suficiente
+                                   para el número de niveles (ver get_coverage_dtype).
+
+    Returns:
+    numpy.ndarray: Grid de cobertura (numpy.memmap si se indicó output_path).
+    """
+    image_shape = tuple(image_shape)
+
+    # Leer una vez los límites de las cajas de cada nivel (mucho más pequeños que el grid)
+    level_bounds = [
+        boxes_to_pixel_bounds(boxes['x_center'], boxes['y_center'], boxes['width'], boxes['height'], image_shape)
+        for _, boxes in iter_level_boxes(json_dir, min_level, max_level)
+    ]
+
+    # Crear el grid de salida con el tipo más pequeño suficiente
+    if dtype is None:
+        dtype = get_coverage_dtype(len(level_bounds))
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        coverage_grid = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=image_shape)
+        coverage_grid[...] = 0
+    else:
+        coverage_grid = np.zeros(image_shape, dtype=dtype)
+
+    # Rasterizar banda a banda reutilizando los mismos buffers
+    band_rows = compute_band_rows(image_shape, memory_budget_mb)
+    rasterizer = CoverageRasterizer((band_rows, image_shape[1]), grid=coverage_grid[:band_rows])
+    bands = range(0, image_shape[0], band_rows)
+    for row_start in tqdm(bands, desc="Procesando bandas", unit="banda", disable=len(bands) == 1):
+        row_stop = min(row_start + band_rows, image_shape[0])
+        rasterizer.grid = coverage_grid[row_start:row_stop]
+
+        for x_min, y_min, x_max, y_max in tqdm(level_bounds, desc="Procesando niveles", unit="nivel", disable=len(bands) > 1):
+            # Recortar las cajas del nivel a la banda y pasarlas a coordenadas de la banda
+            in_band = (y_min < row_stop) & (y_max > row_start)
+            rasterizer.add_level_bounds(
+                x_min[in_band],
+                np.maximum(y_min[in_band], row_start) - row_start,
+                x_max[in_band],
+                np.minimum(y_max[in_band], row_stop) - row_start,
+            )
+
+    if output_path:
+        coverage_grid.flush()
+    return coverage_grid
+
+def get_heatmap_key(json_dir, image_shape, min_level=None, max_level=None):
+    """
+    Calcula la clave del heatmap a partir de las detecciones de entrada (firma mtime/tamaño del almacén o de
+    cada archivo del directorio), el tamaño del grid y el rango de niveles. Si cambia cualquiera de ellos,
+    cambia la clave y el heatmap se vuelve a construir.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_shape (tuple): Tamaño (alto, ancho) del grid.
+    min_level (int, optional): Nivel mínimo.
+    max_level (int, optional): Nivel máximo.
+    """
+    if is_detection_store(json_dir):
+        sources = [[os.path.basename(json_dir)] + get_source_signature(json_dir)]
+    else:
+        sources = [[f] + get_source_signature(os.path.join(json_dir, f)) for f in sorted(list_detection_files(json_dir))]
+    key = json.dumps([os.path.abspath(json_dir), sources, list(image_shape), min_level, max_level])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def get_heatmap_path(json_dir, image_shape, heatmap_dir, min_level=None, max_level=None):
+    """
+    Devuelve la ruta del heatmap persistido para unas detecciones, tamaño y rango de niveles.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_shape (tuple): Tamaño (alto, ancho) del grid.
+    heatmap_dir (str): Directorio donde se guardan los heatmaps.
+    min_level (int, optional): Nivel mínimo.
+    max_level (int, optional): Nivel máximo.
+    """
+    return os.path.join(heatmap_dir, f"heatmap_{get_heatmap_key(json_dir, image_shape, min_level, max_level)}.npz")
+
+def load_heatmap(heatmap_path):
+    """
+    Carga un heatmap persistido (.npz) por get_or_create_heatmap.
+
+    Parameters:
+    heatmap_path (str): Ruta del heatmap.
+    """
+    with np.load(heatmap_path) as data:
+        return data["heatmap"]
+
+def get_or_create_heatmap(json_dir, image_dir, heatmap_dir, min_level=None, max_level=None, memory_budget_mb=None):
+    """
+    Devuelve el heatmap de cobertura como artefacto persistido en disco: si ya existe un heatmap para las
+    mismas detecciones, tamaño y rango de niveles (ver get_heatmap_key) se carga directamente; si no, se
+    construye con build_coverage_grid y se guarda comprimido (.npz) en heatmap_dir. Así la visualización,
+    la identificación de árboles y cualquier re-ejecución de filtrado/clustering comparten un único grid.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_dir (str): Directorio de imágenes o volumen de niveles para determinar el tamaño del grid.
+    heatmap_dir (str): Directorio donde se guardan los heatmaps.
+    min_level (int, optional): Nivel mínimo a procesar.
+    max_level (int, optional): Nivel máximo a procesar.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB para construir el grid por bandas.
+
+    Returns:
+    numpy.ndarray: Grid de cobertura.
+    """
+    image_shape = get_image_shape(image_dir)
+    heatmap_path = get_heatmap_path(json_dir, image_shape, heatmap_dir, min_level, max_level)
+
+    # Reutilizar el heatmap guardado si las entradas no han cambiado
+    if os.path.exists(heatmap_path):
+        print(f"Heatmap cargado desde: {heatmap_path}")
+        return load_heatmap(heatmap_path)
+
+    coverage_grid = build_coverage_grid(json_dir, image_shape, min_level, max_level, memory_budget_mb=memory_budget_mb)
+
+    # Guardar de forma atómica para no dejar un heatmap a medias si se interrumpe
+    os.makedirs(heatmap_dir, exist_ok=True)
+    tmp_path = heatmap_path + ".tmp.npz"
+    np.savez_compressed(tmp_path, heatmap=coverage_grid)
+    os.replace(tmp_path, heatmap_path)
+    print(f"Heatmap guardado en: {heatmap_path}")
+    return coverage_grid
+
+# Ejemplo de uso
+# coverage_grid = build_coverage_grid("data/P28/detections/remapped_detections.npz", (20000, 20000), min_level=100, max_level=250)
+# coverage_grid = build_coverage_grid("data/P28/detections/remapped_detections.npz", (20000, 20000), min_level=100, max_level=250,
+#                                     memory_budget_mb=512, output_path="data/P28/detections/coverage_grid.npy")
+# heatmap = get_or_create_heatmap("data/P28/detections/remapped_detections.npz", "data/P28/volume", "data/P28/heatmaps", min_level=100, max_level=250)
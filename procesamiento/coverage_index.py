@@ -0,0 +1,175 @@
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from procesamiento.coverage_heatmap import CoverageRasterizer, get_image_shape, get_heatmap_key, get_coverage_dtype
+from procesamiento.detection_store import iter_level_boxes
+from procesamiento.level_volume import parse_level_number
+
+PREFIX_FILENAME = "coverage_prefix.npy"
+INDEX_FILENAME = "coverage_index.json"
+
+# Tamaño máximo por defecto del índice acumulado en disco, en MB
+MAX_INDEX_SIZE_MB = 16384
+
+def build_coverage_index(json_dir, image_dir, index_dir, block_size=4, max_size_mb=MAX_INDEX_SIZE_MB):
+    """
+    Construye el índice acumulado de cobertura por niveles: un array mapeado en memoria ('coverage_prefix.npy')
+    de forma (niveles + 1, alto / block_size, ancho / block_size) cuya capa k es la suma de la cobertura de los
+    k primeros niveles (ordenados por número de nivel), y un índice JSON ('coverage_index.json') con los números
+    de nivel. La cobertura de cualquier rango de niveles es la resta de dos capas (ver query_coverage_index).
+    Con block_size > 1 cada celda acumula los píxeles cubiertos de un bloque de block_size x block_size, lo que
+    reduce el tamaño del índice a cambio de resolución (block_size ** 2 veces menos celdas); ese índice solo sirve
+    para explorar rangos de niveles en draw_coverage_heatmap, y create_heatmap / detect_trees_from_heatmap
+    exigen block_size 1 para que los centros de árboles no cambien (ver query_coverage_index). Antes de crearlo se
+    estima su tamaño en disco y, si supera max_size_mb, se lanza un error en lugar de llenar el disco. Si el
+    índice ya existe para las mismas detecciones, no se reconstruye.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones JSON por nivel o ruta del almacén columnar (.npz).
+    image_dir (str): Directorio de imágenes o volumen de niveles para determinar el tamaño del grid.
+    index_dir (str): Directorio donde se guardarán el índice acumulado y su índice JSON.
+    block_size (int): Lado del bloque de reducción en píxeles. Default: 4 (1 es resolución completa, exacto).
+    max_size_mb (float, optional): Tamaño máximo del índice en disco en MB. Si es None, sin límite. Default: 16384.
+
+    Returns:
+    dict: Índice JSON del índice acumulado.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    image_shape = tuple(get_image_shape(image_dir))
+    source_key = get_heatmap_key(json_dir, image_shape)
+
+    # Reutilizar el índice existente si se construyó con las mismas detecciones
+    prefix_path = os.path.join(index_dir, PREFIX_FILENAME)
+    index_path = os.path.join(index_dir, INDEX_FILENAME)
+    if os.path.exists(index_path) and os.path.exists(prefix_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get("source_key") == source_key and index.get("block_size") == block_size:
+            print(f"Índice de cobertura actualizado, se reutiliza: {prefix_path}")
+            return index
+
+    # Leer las detecciones de cada nivel ordenadas por número de nivel
+    level_boxes = sorted(iter_level_boxes(json_dir), key=lambda item: parse_level_number(item[0]))
+
+    # Crear el índice acumulado vacío en disco, con la capa 0 a cero
+    grid_shape = (-(-image_shape[0] // block_size), -(-image_shape[1] // block_size))
+    dtype = get_coverage_dtype(len(level_boxes) * block_size ** 2)
+
+    # Estimar el tamaño del índice antes de reservarlo en disco
+    size_mb = (len(level_boxes) + 1) * grid_shape[0] * grid_shape[1] * np.dtype(dtype).itemsize / 1024 ** 2
+    if max_size_mb is not None and size_mb > max_size_mb:
+        raise ValueError(f"El índice de cobertura ocuparía {size_mb:.0f} MB (límite {max_size_mb} MB). "
+                         f"Usa un block_size mayor que {block_size} o aumenta max_size_mb.")
+
+    prefix = np.lib.format.open_memmap(prefix_path, mode='w+', dtype=dtype, shape=(len(level_boxes) + 1,) + grid_shape)
+    prefix[0] = 0
+
+    # Buffer del nivel con el tamaño múltiplo del bloque, reutilizado entre niveles
+    level_buffer = np.zeros((grid_shape[0] * block_size, grid_shape[1] * block_size), dtype=np.uint8)
+    rasterizer = CoverageRasterizer(image_shape, grid=level_buffer[:image_shape[0], :image_shape[1]])
+
+    for position, (_, boxes) in enumerate(tqdm(level_boxes, desc="Construyendo índice de cobertura", unit="nivel"), start=1):
+        level_buffer[...] = 0
+        rasterizer.add_level(boxes['x_center'], boxes['y_center'], boxes['width'], boxes['height'])
+
+        # Reducir el nivel por bloques y acumularlo sobre la capa anterior
+        level_blocks = level_buffer.reshape(grid_shape[0], block_size, grid_shape[1], block_size).sum(axis=(1, 3), dtype=dtype)
+        np.add(prefix[position - 1], level_blocks, out=prefix[position])
+
+    prefix.flush()
+    del prefix
+
+    # Guardar el índice JSON (al final, para que un índice a medias no se reutilice)
+    index = {
+        "levels": [parse_level_number(level_name) for level_name, _ in level_boxes],
+        "level_names": [level_name for level_name, _ in level_boxes],
+        "image_shape": list(image_shape),
+        "block_size": block_size,
+        "source_key": source_key
+    }
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=4)
+
+    print(f"Índice de cobertura guardado en: {prefix_path}")
+    return index
+
+def load_coverage_index(index_dir):
+    """
+    Abre el índice acumulado de cobertura en modo solo lectura, mapeado en memoria.
+
+    Parameters:
+    index_dir (str): Directorio que contiene 'coverage_prefix.npy' y 'coverage_index.json'.
+
+    Returns:
+    tuple: (índice acumulado numpy.memmap, índice JSON dict).
+    """
+    with open(os.path.join(index_dir, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    prefix = np.load(os.path.join(index_dir, PREFIX_FILENAME), mmap_mode='r')
+    return prefix, index
+
+def is_coverage_index(path):
+    """
+    Indica si una ruta es un directorio con un índice acumulado de cobertura.
+
+    Parameters:
+    path (str): Ruta a comprobar.
+    """
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME)) and os.path.isfile(os.path.join(path, PREFIX_FILENAME))
+
+def query_coverage_index(index_dir, min_level=None, max_level=None, json_dir=None, exact=False, output_path=None):
+    """
+    Calcula la cobertura de un rango de niveles [min_level, max_level] restando dos capas del índice acumulado.
+    Con block_size 1 el resultado es idéntico a build_coverage_grid, con su mismo tipo de dato entero; con
+    block_size > 1 es la cobertura media (float32) de cada bloque, a la resolución de los bloques, y solo sirve
+    para explorar rangos de niveles en las visualizaciones. Para la identificación de árboles, que depende de
+    los valores exactos del grid, se usa exact=True, que exige un índice con block_size 1. Si se indican las
+    detecciones, se comprueba que el índice se construyó a partir de ellas y se lanza un error si está
+    desactualizado.
+
+    Parameters:
+    index_dir (str): Directorio del índice acumulado de cobertura.
+    min_level (int, optional): Nivel mínimo. Si es None, desde el primer nivel.
+    max_level (int, optional): Nivel máximo. Si es None, hasta el último nivel.
+    json_dir (str, optional): Detecciones con las que debe coincidir el índice (ver build_coverage_index).
+    exact (bool): Si True, lanza un error si el índice no es de resolución completa (block_size 1).
+    output_path (str, optional): Ruta .npy donde se crea el grid como memmap. Si es None, se crea en memoria.
+
+    Returns:
+    numpy.ndarray: Grid de cobertura del rango de niveles (numpy.memmap si se indicó output_path).
+    """
+    prefix, index = load_coverage_index(index_dir)
+    block_size = index["block_size"]
+    if exact and block_size != 1:
+        raise ValueError(f"El índice de cobertura {index_dir} tiene block_size {block_size} y solo sirve para "
+                         f"visualización. Para identificar árboles, reconstrúyelo con block_size=1.")
+
+    # Comprobar que el índice corresponde a las detecciones actuales
+    if json_dir is not None and index.get("source_key") != get_heatmap_key(json_dir, tuple(index["image_shape"])):
+        raise ValueError(f"El índice de cobertura {index_dir} no corresponde a las detecciones actuales de {json_dir}. "
+                         f"Reconstrúyelo con build_coverage_index.")
+
+    # Localizar las capas que delimitan el rango de niveles
+    levels = np.array(index["levels"])
+    start = 0 if min_level is None else int(np.searchsorted(levels, min_level, side='left'))
+    stop = len(levels) if max_level is None else int(np.searchsorted(levels, max_level, side='right'))
+    stop = max(start, stop)
+
+    # Tipo de dato del resultado: el mismo que build_coverage_grid con block_size 1, la media en otro caso
+    dtype = get_coverage_dtype(stop - start) if block_size == 1 else np.float32
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        coverage = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=prefix.shape[1:])
+    else:
+        coverage = np.empty(prefix.shape[1:], dtype=dtype)
+
+    # La diferencia de dos capas cabe en el tipo del resultado, así que se escribe directamente en él
+    np.subtract(prefix[stop], prefix[start], out=coverage, casting='unsafe')
+    if block_size > 1:
+        coverage /= block_size ** 2
+    return coverage
+
+# Ejemplo de uso
+# build_coverage_index("data/P28/detections/remapped_detections.npz", "data/P28/volume", "data/P28/coverage_index", block_size=4)
+# coverage_grid = query_coverage_index("data/P28/coverage_index", min_level=75, max_level=185, json_dir="data/P28/detections/remapped_detections.npz")
@@ -1,9 +1,126 @@
 import os
 from PIL import Image
 import math
+import numpy as np
 from tqdm import tqdm
+from procesamiento.level_volume import is_level_volume, load_level_volume
 
-def crop_images(input_dir, output_dir, image_size=640):
+# Canal de las imágenes RGB de nivel con la intensidad máxima (R=density, G=maxint, B=meanint)
+MAXINT_CHANNEL = 1
+
+def compute_crop_stride(img_width, img_height, image_size=640):
+    """
+    Calcula el solapamiento y el stride (avance) para cortar una imagen en crops uniformes de tamaño image_size.
+
+    Parameters:
+    img_width (int): Ancho de la imagen.
+    img_height (int): Alto de la imagen.
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+
+    Returns:
+    tuple: (stride_x, stride_y, overlap_x, overlap_y).
+    """
+    # Calcular el número de recortes necesario para ancho y alto
+    num_crops_x = math.ceil(img_width / image_size)
+    num_crops_y = math.ceil(img_height / image_size)
+
+    # Calcular el solapamiento necesario para asegurar que los recortes sean uniformes
+    overlap_x = (num_crops_x * image_size - img_width) / num_crops_x
+    overlap_y = (num_crops_y * image_size - img_height) / num_crops_y
+
+    # Calcular el stride (avance) basado en el solapamiento
+    stride_x = int(image_size - overlap_x)
+    stride_y = int(image_size - overlap_y)
+    return stride_x, stride_y, overlap_x, overlap_y
+
+def compute_crop_offsets(img_width, img_height, image_size=640, stride_x=640, stride_y=640):
+    """
+    Devuelve las esquinas superiores izquierdas (x, y) de los crops en el mismo orden en que
+    crop_image_with_stride los genera, ajustando el último crop de cada eje al borde de la imagen.
+    Los crops repetidos por ese ajuste (que antes sobrescribían el mismo archivo) solo aparecen una vez.
+
+    Parameters:
+    img_width (int): Ancho de la imagen.
+    img_height (int): Alto de la imagen.
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    stride_x (int): Tamaño del avance entre los recortes en el eje X.
+    stride_y (int): Tamaño del avance entre los recortes en el eje Y.
+
+    Returns:
+    list: Lista de tuplas (x, y).
+    """
+    offsets = []
+    for y in range(0, img_height, stride_y):
+        for x in range(0, img_width, stride_x):
+            # Ajustar para que el último recorte tenga el tamaño correcto si nos pasamos del borde
+            if x + image_size > img_width:
+                x = img_width - image_size
+            if y + image_size > img_height:
+                y = img_height - image_size
+            offsets.append((x, y))
+    return list(dict.fromkeys(offsets))
+
+def compute_tile_statistics(image, offsets, image_size=640, channel=MAXINT_CHANNEL):
+    """
+    Calcula, para todos los crops de un nivel a la vez, la fracción de píxeles distintos de cero y la intensidad
+    máxima del canal maxint. Se recorre la imagen una vez por fila de crops: cada banda de filas se reduce por
+    columnas y las ventanas de cada crop se resuelven sobre esos perfiles 1D con sumas acumuladas y
+    sliding_window_view, sin recorrer cada crop por separado.
+
+    Parameters:
+    image (numpy.ndarray): Imagen RGB del nivel de forma (alto, ancho, 3), o vista del volumen de niveles.
+    offsets (list): Esquinas (x, y) de los crops (ver compute_crop_offsets).
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    channel (int): Canal sobre el que se calculan las estadísticas. Default: 1 (maxint).
+
+    Returns:
+    tuple: Arrays (fracción de píxeles distintos de cero, intensidad máxima), uno por crop en el orden de offsets.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    nonzero_fraction = np.zeros(len(offsets), dtype=np.float64)
+    max_intensity = np.zeros(len(offsets), dtype=image.dtype)
+
+    for y in np.unique(offsets[:, 1]).tolist():
+        band = image[y:y + image_size, :, channel]
+        in_band = np.flatnonzero(offsets[:, 1] == y)
+        xs = offsets[in_band, 0]
+
+        # Perfiles por columna de la banda: píxeles distintos de cero y máximo
+        column_counts = np.concatenate(([0], np.cumsum(np.count_nonzero(band, axis=0))))
+        column_max = band.max(axis=0)
+
+        nonzero_fraction[in_band] = (column_counts[xs + image_size] - column_counts[xs]) / (band.shape[0] * image_size)
+        max_intensity[in_band] = np.lib.stride_tricks.sliding_window_view(column_max, image_size)[xs].max(axis=1)
+
+    return nonzero_fraction, max_intensity
+
+def get_content_mask(image, offsets, image_size=640, min_nonzero_fraction=None, min_max_intensity=None):
+    """
+    Filtro de contenido de los crops de un nivel: descarta los crops vacíos o casi vacíos (fuera de la zona
+    escaneada o por encima de la copa) según sus estadísticas en el canal maxint.
+
+    Parameters:
+    image (numpy.ndarray): Imagen RGB del nivel de forma (alto, ancho, 3).
+    offsets (list): Esquinas (x, y) de los crops.
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    min_nonzero_fraction (float, optional): Fracción mínima de píxeles distintos de cero. Si es None, no se aplica.
+    min_max_intensity (int, optional): Intensidad máxima mínima del crop. Si es None, no se aplica.
+
+    Returns:
+    numpy.ndarray: Máscara booleana con True en los crops que se conservan.
+    """
+    keep = np.ones(len(offsets), dtype=bool)
+    if min_nonzero_fraction is None and min_max_intensity is None:
+        return keep
+
+    nonzero_fraction, max_intensity = compute_tile_statistics(image, offsets, image_size)
+    if min_nonzero_fraction is not None:
+        keep &= nonzero_fraction >= min_nonzero_fraction
+    if min_max_intensity is not None:
+        keep &= max_intensity >= min_max_intensity
+    return keep
+
+def crop_images(input_dir, output_dir, image_size=640, min_nonzero_fraction=None, min_max_intensity=None):
     """
     Corta todas las imágenes en un directorio en múltiples crops de tamaño image_size x image_size,
     con solapamiento calculado automáticamente para que los recortes sean uniformes.
@@ -12,6 +129,10 @@ def crop_images(input_dir, output_dir, image_size=640):
     input_dir (str): Directorio de entrada que contiene las imágenes RGB.
     output_dir (str): Directorio de salida donde se guardarán los crops.
     image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    min_nonzero_fraction (float, optional): Si se indica, se omiten los crops con una fracción menor de píxeles
+                                            distintos de cero en el canal maxint (ver get_content_mask).
+    min_max_intensity (int, optional): Si se indica, se omiten los crops cuya intensidad máxima en el canal
+                                       maxint sea menor.
     """
     # Listar todos los archivos en el directorio de entrada
     image_files = [f for f in os.listdir(input_dir) if f.endswith('.png')]
@@ -25,17 +146,7 @@ def crop_images(input_dir, output_dir, image_size=640):
         img = Image.open(sample_image_path)
         img_width, img_height = img.size
 
-        # Calcular el número de recortes necesario para ancho y alto
-        num_crops_x = math.ceil(img_width / image_size)
-        num_crops_y = math.ceil(img_height / image_size)
-
-        # Calcular el solapamiento necesario para asegurar que los recortes sean uniformes
-        overlap_x = (num_crops_x * image_size - img_width) / num_crops_x
-        overlap_y = (num_crops_y * image_size - img_height) / num_crops_y
-
-        # Calcular el stride (avance) basado en el solapamiento
-        stride_x = int(image_size - overlap_x)
-        stride_y = int(image_size - overlap_y)
+        stride_x, stride_y, overlap_x, overlap_y = compute_crop_stride(img_width, img_height, image_size)
 
         print(f"Calculado overlap X: {overlap_x}, Y: {overlap_y}")
         print(f"Calculado stride X: {stride_x}, Y: {stride_y}")
@@ -44,9 +155,11 @@ def crop_images(input_dir, output_dir, image_size=640):
         for image_file in tqdm(image_files, desc="Procesando imágenes", unit="imagen"):
             input_image_path = os.path.join(input_dir, image_file)
             image_base_name = os.path.splitext(image_file)[0]
-            crop_image_with_stride(input_image_path, output_dir, image_base_name, image_size, stride_x, stride_y)
+            crop_image_with_stride(input_image_path, output_dir, image_base_name, image_size, stride_x, stride_y,
+                                   min_nonzero_fraction, min_max_intensity)
 
-def crop_image_with_stride(input_image_path, output_dir, image_base_name, image_size=640, stride_x=640, stride_y=640):
+def crop_image_with_stride(input_image_path, output_dir, image_base_name, image_size=640, stride_x=640, stride_y=640,
+                           min_nonzero_fraction=None, min_max_intensity=None):
     """
     Corta una imagen grande en múltiples crops de tamaño image_size x image_size y los guarda
     con nombres secuenciales en el directorio de salida, con un avance de 'stride_x' y 'stride_y'.
@@ -58,33 +171,133 @@ def crop_image_with_stride(input_image_path, output_dir, image_base_name, image_
     image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
     stride_x (int): Tamaño del avance entre los recortes en el eje X.
     stride_y (int): Tamaño del avance entre los recortes en el eje Y.
+    min_nonzero_fraction (float, optional): Fracción mínima de píxeles distintos de cero (ver get_content_mask).
+    min_max_intensity (int, optional): Intensidad máxima mínima del crop (ver get_content_mask).
     """
     img = Image.open(input_image_path)
     img_width, img_height = img.size
+    offsets = compute_crop_offsets(img_width, img_height, image_size, stride_x, stride_y)
 
-    # Contador para los nombres de los crops
-    crop_count = 1
+    # Descartar los crops vacíos o casi vacíos
+    if min_nonzero_fraction is not None or min_max_intensity is not None:
+        keep = get_content_mask(np.asarray(img.convert('RGB')), offsets, image_size, min_nonzero_fraction, min_max_intensity)
+        print(f"{image_base_name}: {int((~keep).sum())} de {len(offsets)} crops vacíos omitidos")
+        offsets = [offset for offset, kept in zip(offsets, keep.tolist()) if kept]
 
     # Iterar sobre la imagen y generar crops con el stride calculado
-    for y in range(0, img_height, stride_y):
-        for x in range(0, img_width, stride_x):
-            # Ajustar para que el último recorte tenga el tamaño correcto si nos pasamos del borde
-            if x + image_size > img_width:
-                x = img_width - image_size
-            if y + image_size > img_height:
-                y = img_height - image_size
+    for x, y in offsets:
+        # Definir el área de recorte
+        crop = img.crop((x, y, x + image_size, y + image_size))
 
-            # Definir el área de recorte
-            crop = img.crop((x, y, x + image_size, y + image_size))
+        # Definir el nombre del archivo de salida
+        crop_file_name = f"{image_base_name}_{x}_{y}.png"
+        crop_output_path = os.path.join(output_dir, crop_file_name)
 
-            # Definir el nombre del archivo de salida
-            crop_file_name = f"{image_base_name}_{x}_{y}.png"
-            crop_output_path = os.path.join(output_dir, crop_file_name)
+        # Guardar el crop
+        crop.save(crop_output_path)
+        print(f"Guardado crop: {crop_output_path}")
 
-            # Guardar el crop
-            crop.save(crop_output_path)
-            crop_count += 1
-            print(f"Guardado crop: {crop_output_path}")
+class CropSource:
+    """
+    Fuente iterable de crops que evita escribir los PNG de los crops en disco. Recorre los niveles de la finca
+    y genera tuplas (nivel, x, y, crop) leyendo ventanas de las imágenes de nivel, con el mismo stride y
+    solapamiento que crop_images. 'nivel' es el nombre base de la imagen del nivel (ejemplo: 'P28_323_rgb'),
+    de modo que el nombre del crop equivalente es f"{nivel}_{x}_{y}.png". Los crops son arrays uint8 RGB
+    de forma (image_size, image_size, 3).
+
+    Si source_dir es un volumen de niveles (ver level_volume), las ventanas son vistas del volumen mapeado
+    en memoria sin copias; si es un directorio de imágenes PNG RGB, cada nivel se decodifica una sola vez.
+
+    Parameters:
+    source_dir (str): Volumen de niveles o directorio con las imágenes RGB de cada nivel.
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    debug_output_dir (str, optional): Si se indica, guarda también cada crop en PNG en este directorio,
+                                      con los mismos nombres que crop_images.
+    min_nonzero_fraction (float, optional): Si se indica, se omiten los crops con una fracción menor de píxeles
+                                            distintos de cero en el canal maxint (ver get_content_mask).
+    min_max_intensity (int, optional): Si se indica, se omiten los crops cuya intensidad máxima en el canal
+                                       maxint sea menor.
+    """
+    def __init__(self, source_dir, image_size=640, debug_output_dir=None, min_nonzero_fraction=None, min_max_intensity=None):
+        self.source_dir = source_dir
+        self.image_size = image_size
+        self.debug_output_dir = debug_output_dir
+        self.min_nonzero_fraction = min_nonzero_fraction
+        self.min_max_intensity = min_max_intensity
+        # Número de crops omitidos por el filtro de contenido en cada nivel
+        self.skipped_crops = {}
+
+        if is_level_volume(source_dir):
+            self.volume, index = load_level_volume(source_dir)
+            self.level_names = list(index["level_names"])
+            img_height, img_width = index["shape"][1:3]
+        else:
+            self.volume = None
+            self.level_names = sorted(os.path.splitext(f)[0] for f in os.listdir(source_dir) if f.endswith('.png'))
+            if not self.level_names:
+                raise ValueError(f"No se encontraron imágenes .png en la carpeta: {source_dir}")
+            with Image.open(os.path.join(source_dir, f"{self.level_names[0]}.png")) as img:
+                img_width, img_height = img.size
+
+        # Mismo stride y solapamiento que crop_images
+        stride_x, stride_y, _, _ = compute_crop_stride(img_width, img_height, image_size)
+        self.offsets = compute_crop_offsets(img_width, img_height, image_size, stride_x, stride_y)
+
+        if debug_output_dir:
+            os.makedirs(debug_output_dir, exist_ok=True)
+
+    def __len__(self):
+        # Con el filtro de contenido es una cota superior: los crops omitidos se conocen al recorrer cada nivel
+        return len(self.level_names) * len(self.offsets)
+
+    def load_level(self, position, in_memory=False):
+        """
+        Devuelve la tupla (nivel, imagen) con la imagen RGB completa del nivel en la posición indicada.
+
+        Parameters:
+        position (int): Posición del nivel en self.level_names.
+        in_memory (bool): Si True y la fuente es un volumen, copia el nivel a memoria en lugar de devolver
+                          una vista, forzando la lectura de disco en el momento de la llamada. Default: False.
+        """
+        level_name = self.level_names[position]
+        if self.volume is not None:
+            image = np.array(self.volume[position]) if in_memory else self.volume[position]
+            return level_name, image
+        with Image.open(os.path.join(self.source_dir, f"{level_name}.png")) as img:
+            return level_name, np.asarray(img.convert('RGB'))
+
+    def iter_levels(self):
+        """
+        Genera tuplas (nivel, imagen) con la imagen RGB completa de cada nivel.
+        """
+        for position in range(len(self.level_names)):
+            yield self.load_level(position)
+
+    def iter_level_crops(self, level_name, image):
+        """
+        Genera las tuplas (nivel, x, y, crop) de la imagen de un nivel, omitiendo los crops vacíos si el filtro
+        de contenido está activo.
+
+        Parameters:
+        level_name (str): Nombre base del nivel.
+        image (numpy.ndarray): Imagen RGB del nivel de forma (alto, ancho, 3).
+        """
+        offsets = self.offsets
+        if self.min_nonzero_fraction is not None or self.min_max_intensity is not None:
+            keep = get_content_mask(image, offsets, self.image_size, self.min_nonzero_fraction, self.min_max_intensity)
+            self.skipped_crops[level_name] = int((~keep).sum())
+            print(f"{level_name}: {self.skipped_crops[level_name]} de {len(offsets)} crops vacíos omitidos")
+            offsets = [offset for offset, kept in zip(offsets, keep.tolist()) if kept]
+
+        for x, y in offsets:
+            crop = image[y:y + self.image_size, x:x + self.image_size]
+            if self.debug_output_dir:
+                Image.fromarray(np.ascontiguousarray(crop)).save(os.path.join(self.debug_output_dir, f"{level_name}_{x}_{y}.png"))
+            yield level_name, x, y, crop
+
+    def __iter__(self):
+        for level_name, image in self.iter_levels():
+            yield from self.iter_level_crops(level_name, image)
 
 def crop_images_with_labels(input_dir, label_dir, output_image_dir, output_label_dir, image_size=640):
     """
@@ -197,4 +410,6 @@ def adjust_labels_for_crop(labels, x_offset, y_offset, crop_size, img_width, img
 
 
 # Ejemplo de uso:
-# crop_images("data/P28/rgb_images", "data/P28/crop_images", image_size=640)
\ No newline at end of file
+# crop_images("data/P28/rgb_images", "data/P28/crop_images", image_size=640)
+# for level, x, y, crop in CropSource("data/P28/volume"): ...
+# crop_source = CropSource("data/P28/volume", min_nonzero_fraction=0.01, min_max_intensity=10)
\ No newline at end of file
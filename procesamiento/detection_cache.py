@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    Calcula el hash SHA-256 del contenido de un archivo (por ejemplo, los pesos .pt del modelo).
+
+    Parameters:
+    path (str): Ruta del archivo.
+    chunk_size (int): Tamaño de los bloques de lectura en bytes.
+
+    Returns:
+    str: Hash hexadecimal.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_crop_pixels(crop):
+    """
+    Calcula un hash del contenido en píxeles de un crop, incluyendo su forma y tipo de dato.
+
+    Parameters:
+    crop (numpy.ndarray): Imagen del crop.
+
+    Returns:
+    str: Hash hexadecimal.
+    """
+    crop = np.ascontiguousarray(crop)
+    digest = hashlib.sha1()
+    digest.update(f"{crop.shape}{crop.dtype}".encode())
+    digest.update(crop.data)
+    return digest.hexdigest()
+
+class DetectionCache:
+    """
+    Caché persistente en disco de las detecciones de YOLO por crop, direccionada por contenido.
+    La clave de cada entrada es el hash de los píxeles del crop; el archivo de caché depende además del hash
+    de los pesos del modelo y de los parámetros de inferencia, de modo que cambiar cualquiera de ellos
+    invalida la caché. Las entradas se añaden a un archivo JSON Lines y se vuelcan a disco cada
+    'checkpoint_every' crops, por lo que una ejecución interrumpida se reanuda desde el último volcado.
+    Puede usarse desde varios hilos a la vez.
+
+    Parameters:
+    cache_dir (str): Directorio donde se guardan los archivos de caché.
+    model_path (str): Ruta al archivo del modelo YOLO entrenado (.pt).
+    inference_settings (dict, optional): Parámetros de inferencia que afectan a las detecciones (conf, iou, imgsz...).
+    checkpoint_every (int): Número de entradas nuevas tras el que se vuelca la caché a disco. Default: 500.
+    """
+    def __init__(self, cache_dir, model_path, inference_settings=None, checkpoint_every=500):
+        os.makedirs(cache_dir, exist_ok=True)
+        settings = json.dumps(inference_settings or {}, sort_keys=True)
+        namespace = hashlib.sha256(f"{hash_file(model_path)}{settings}".encode()).hexdigest()[:16]
+        self.cache_path = os.path.join(cache_dir, f"detections_{namespace}.jsonl")
+        self.checkpoint_every = checkpoint_every
+        self.entries = {}
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        # Final de la última línea completa y válida: lo que haya detrás se descarta
+        valid_end = 0
+        with open(self.cache_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Línea incompleta tras una interrupción
+                    continue
+                if not line.endswith(b"\n"):
+                    continue
+                self.entries[entry["key"]] = entry["boxes"]
+                valid_end = f.tell()
+
+        # Truncar la cola incompleta para que las nuevas entradas empiecen en una línea propia
+        if valid_end < os.path.getsize(self.cache_path):
+            with open(self.cache_path, 'r+b') as f:
+                f.truncate(valid_end)
+        print(f"Caché de detecciones cargada: {len(self.entries)} crops en {self.cache_path}")
+
+    def get(self, key):
+        """
+        Devuelve las cajas guardadas para un crop, o None si no está en la caché.
+
+        Parameters:
+        key (str): Hash de los píxeles del crop (ver hash_crop_pixels).
+
+        Returns:
+        list or None: Lista de cajas [x_center, y_center, width, height, confidence, class].
+        """
+        with self._lock:
+            boxes = self.entries.get(key)
+            if boxes is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return boxes
+
+    def put(self, key, boxes):
+        """
+        Añade las cajas de un crop a la caché. Se vuelcan a disco cada 'checkpoint_every' entradas.
+
+        Parameters:
+        key (str): Hash de los píxeles del crop.
+        boxes (list): Lista de cajas [x_center, y_center, width, height, confidence, class].
+        """
+        with self._lock:
+            self.entries[key] = boxes
+            self.pending.append({"key": key, "boxes": boxes})
+            if len(self.pending) >= self.checkpoint_every:
+                self._flush()
+
+    def flush(self):
+        """
+        Escribe en disco las entradas pendientes.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        with open(self.cache_path, 'a') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def close(self):
+        """
+        Vuelca las entradas pendientes y muestra un resumen de aciertos y fallos.
+        """
+        self.flush()
+        print(f"Caché de detecciones: {self.hits} aciertos, {self.misses} fallos.")
+
+# Ejemplo de uso
+# cache = DetectionCache("data/P28/detections/cache", "path/to/your/model.pt")
+# boxes = cache.get(hash_crop_pixels(crop))
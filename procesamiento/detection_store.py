@@ -0,0 +1,226 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from procesamiento.detections_io import iter_detections, list_detection_files
+from procesamiento.level_volume import parse_level_number
+from procesamiento.merge_detections import merge_duplicate_boxes
+
+STORE_COLUMNS = {
+    "level": np.int32,
+    "crop_x": np.int32,
+    "crop_y": np.int32,
+    "x_center": np.float64,
+    "y_center": np.float64,
+    "width": np.float32,
+    "height": np.float32,
+    "confidence": np.float32,
+    "class": np.int16,
+}
+
+def parse_crop_name(crop_file):
+    """
+    Extrae el nombre del nivel y el offset del crop a partir de su nombre (ejemplo: 'P28_323_rgb_640_0.png').
+
+    Parameters:
+    crop_file (str): Nombre del archivo del crop.
+
+    Returns:
+    tuple: (nombre_nivel, x_offset, y_offset).
+    """
+    parts = crop_file.replace(".png", "").split("_")
+    return "_".join(parts[:-2]), int(parts[-2]), int(parts[-1])
+
+def is_detection_store(path):
+    """
+    Indica si una ruta es un almacén columnar de detecciones (.npz).
+
+    Parameters:
+    path (str): Ruta a comprobar.
+    """
+    return path.endswith('.npz') and os.path.isfile(path)
+
+def _iter_store_rows(source):
+    """
+    Genera las filas (nombre_nivel, crop_x, crop_y, x_center, y_center, width, height, confidence, class) con
+    coordenadas en la imagen original, a partir de un archivo global de detecciones por crop o de un directorio
+    de detecciones ya remapeadas por nivel.
+    """
+    if os.path.isdir(source):
+        for json_file in tqdm(list_detection_files(source), desc="Leyendo detecciones remapeadas", unit="nivel"):
+            level_name = os.path.splitext(json_file)[0]
+            for detection in iter_detections(os.path.join(source, json_file)):
+                _, crop_x, crop_y = parse_crop_name(detection["original_crop"])
+                yield (level_name, crop_x, crop_y, detection["x_center"], detection["y_center"], detection["width"],
+                       detection["height"], detection["confidence"], detection["class"])
+    else:
+        for detection in tqdm(iter_detections(source), desc="Remapeando detecciones", unit="detección"):
+            level_name, crop_x, crop_y = parse_crop_name(detection["image"])
+            yield (level_name, crop_x, crop_y, detection["x_center"] + crop_x, detection["y_center"] + crop_y,
+                   detection["width"], detection["height"], detection["confidence"], detection["class"])
+
+def build_detection_store(source, store_path, chunk_size=100000, merge=None, iou_threshold=0.5):
+    """
+    Construye el almacén columnar de detecciones remapeadas: un archivo .npz con un array NumPy por columna
+    (level, crop_x, crop_y, x_center, y_center, width, height, confidence, class), ordenado por nivel, más la
+    tabla 'level_numbers'/'level_names' para recuperar el nombre de la imagen de cada nivel. Las coordenadas
+    x_center e y_center están en la imagen original y crop_x/crop_y guardan el offset del crop de origen.
+
+    Parameters:
+    source (str): Archivo global de detecciones por crop (.json o .jsonl, como el de apply_yolo_to_crops),
+                  que se remapea al vuelo, o directorio de detecciones ya remapeadas por nivel.
+    store_path (str): Ruta del archivo .npz de salida.
+    chunk_size (int): Número de filas que se acumulan antes de convertirlas a arrays. Default: 100000.
+    merge (str, optional): Fusión por nivel de los duplicados del mismo tronco detectado en crops solapados,
+                           'nms' o 'wbf' (ver merge_duplicate_boxes). Si es None, se conservan todas.
+    iou_threshold (float): IoU mínimo para considerar dos detecciones duplicadas. Default: 0.5.
+
+    Returns:
+    dict: Almacén de detecciones (ver load_detection_store).
+    """
+    os.makedirs(os.path.dirname(store_path) or ".", exist_ok=True)
+
+    level_names = {}
+    chunks = {column: [] for column in STORE_COLUMNS}
+    rows = []
+
+    def flush_rows():
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        chunks["level"].append(np.array([level_names[name] for name in columns[0]], dtype=STORE_COLUMNS["level"]))
+        for column, values in zip(list(STORE_COLUMNS)[1:], columns[1:]):
+            chunks[column].append(np.array(values, dtype=STORE_COLUMNS[column]))
+        rows.clear()
+
+    # Leer las detecciones por bloques y convertirlas a columnas
+    for row in _iter_store_rows(source):
+        if row[0] not in level_names:
+            level_names[row[0]] = parse_level_number(row[0])
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            flush_rows()
+    flush_rows()
+
+    store = {
+        column: np.concatenate(chunks[column]) if chunks[column] else np.zeros(0, dtype=dtype)
+        for column, dtype in STORE_COLUMNS.items()
+    }
+
+    # Ordenar por nivel para poder seleccionar niveles consecutivos con slices
+    order = np.argsort(store["level"], kind='stable')
+    store = {column: values[order] for column, values in store.items()}
+
+    if merge is not None:
+        store = merge_store_duplicates(store, merge, iou_threshold)
+
+    sorted_levels = sorted(level_names.items(), key=lambda item: item[1])
+    store["level_names"] = np.array([name for name, _ in sorted_levels], dtype=str)
+    store["level_numbers"] = np.array([number for _, number in sorted_levels], dtype=np.int32)
+
+    np.savez(store_path, **store)
+    print(f"Almacén de detecciones guardado en: {store_path} ({len(store['level'])} detecciones, {len(sorted_levels)} niveles)")
+    return store
+
+def merge_store_duplicates(store, merge='nms', iou_threshold=0.5):
+    """
+    Fusiona, nivel a nivel, los duplicados entre crops de las columnas de un almacén ordenado por nivel.
+    Solo se consideran duplicadas las detecciones de crops distintos.
+
+    Parameters:
+    store (dict): Columnas del almacén, ordenadas por nivel.
+    merge (str): 'nms' o 'wbf' (ver merge_duplicate_boxes).
+    iou_threshold (float): IoU mínimo para considerar dos detecciones duplicadas.
+
+    Returns:
+    dict: Columnas del almacén sin duplicados, en el mismo orden.
+    """
+    num_detections = len(store["level"])
+    level_numbers, starts = np.unique(store["level"], return_index=True)
+    stops = np.append(starts[1:], num_detections)
+
+    merged_levels = []
+    for start, stop in tqdm(zip(starts, stops), total=len(starts), desc="Fusionando duplicados", unit="nivel"):
+        level_columns = {column: values[start:stop] for column, values in store.items()}
+        crop_ids = level_columns["crop_x"].astype(np.int64) * (int(level_columns["crop_y"].max()) + 1) + level_columns["crop_y"]
+        merged_levels.append(merge_duplicate_boxes(level_columns, iou_threshold, merge, groups=crop_ids)[1])
+
+    store = {
+        column: np.concatenate([level[column] for level in merged_levels]) if merged_levels else values
+        for column, values in store.items()
+    }
+    print(f"Duplicados entre crops fusionados: {num_detections - len(store['level'])} de {num_detections} detecciones")
+    return store
+
+def load_detection_store(store_path):
+    """
+    Carga el almacén columnar de detecciones.
+
+    Parameters:
+    store_path (str): Ruta del archivo .npz.
+
+    Returns:
+    dict: Diccionario {columna: numpy.ndarray}.
+    """
+    with np.load(store_path) as data:
+        return {key: data[key] for key in data.files}
+
+def select_levels(store, min_level=None, max_level=None):
+    """
+    Devuelve la máscara booleana de las detecciones dentro del rango de niveles [min_level, max_level].
+
+    Parameters:
+    store (dict): Almacén de detecciones.
+    min_level (int, optional): Nivel mínimo. Si es None, sin límite inferior.
+    max_level (int, optional): Nivel máximo. Si es None, sin límite superior.
+    """
+    mask = np.ones(len(store["level"]), dtype=bool)
+    if min_level is not None:
+        mask &= store["level"] >= min_level
+    if max_level is not None:
+        mask &= store["level"] <= max_level
+    return mask
+
+def iter_level_boxes(source, min_level=None, max_level=None):
+    """
+    Recorre las detecciones remapeadas nivel a nivel, como columnas NumPy, a partir del almacén columnar
+    o de un directorio de JSON por nivel. Es el punto de lectura común de las etapas de visualización y evaluación.
+
+    Parameters:
+    source (str): Ruta del almacén .npz o directorio de detecciones remapeadas por nivel.
+    min_level (int, optional): Nivel mínimo a procesar.
+    max_level (int, optional): Nivel máximo a procesar.
+
+    Yields:
+    tuple: (nombre_nivel, dict con las columnas x_center, y_center, width, height, confidence y class del nivel).
+    """
+    if is_detection_store(source):
+        store = load_detection_store(source)
+        level_lookup = dict(zip(store["level_numbers"].tolist(), store["level_names"].tolist()))
+
+        # Seleccionar el rango de niveles con una máscara y separar los niveles (el almacén está ordenado por nivel)
+        mask = select_levels(store, min_level, max_level)
+        columns = {column: store[column][mask] for column in STORE_COLUMNS}
+        level_numbers, starts = np.unique(columns["level"], return_index=True)
+        stops = np.append(starts[1:], len(columns["level"]))
+        for level_number, start, stop in zip(level_numbers.tolist(), starts, stops):
+            yield level_lookup[level_number], {column: values[start:stop] for column, values in columns.items()}
+        return
+
+    for json_file in list_detection_files(source):
+        try:
+            level_number = parse_level_number(json_file)
+        except (ValueError, IndexError):
+            continue
+        if (min_level is not None and level_number < min_level) or (max_level is not None and level_number > max_level):
+            continue
+        detections = list(iter_detections(os.path.join(source, json_file)))
+        yield os.path.splitext(json_file)[0], {
+            column: np.array([d[column] for d in detections], dtype=STORE_COLUMNS[column])
+            for column in ("x_center", "y_center", "width", "height", "confidence", "class")
+        }
+
+# Ejemplo de uso
+# build_detection_store("data/P28/detections/detections.jsonl", "data/P28/detections/remapped_detections.npz")
+# build_detection_store("data/P28/detections/detections.jsonl", "data/P28/detections/remapped_detections.npz", merge='nms')
+# store = load_detection_store("data/P28/detections/remapped_detections.npz")
+# mask = select_levels(store, min_level=100, max_level=250)
@@ -0,0 +1,145 @@
+import os
+import json
+
+DETECTION_EXTENSIONS = ('.json', '.jsonl')
+
+def is_jsonl(path):
+    """
+    Indica si una ruta de detecciones usa el formato JSON Lines (una detección por línea).
+
+    Parameters:
+    path (str): Ruta del archivo de detecciones.
+    """
+    return path.endswith('.jsonl')
+
+def iter_detections(path):
+    """
+    Recorre las detecciones de un archivo. Los archivos JSON Lines se leen línea a línea con memoria constante;
+    los JSON clásicos (una lista con indent) se cargan completos por compatibilidad.
+
+    Parameters:
+    path (str): Ruta del archivo de detecciones (.json o .jsonl).
+    """
+    if is_jsonl(path):
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Última línea incompleta tras una interrupción
+                    print(f"Línea {line_number} incompleta en {path}, se omite.")
+    else:
+        with open(path, 'r') as f:
+            yield from json.load(f)
+
+def load_detections(path):
+    """
+    Carga todas las detecciones de un archivo .json o .jsonl en una lista.
+
+    Parameters:
+    path (str): Ruta del archivo de detecciones.
+    """
+    return list(iter_detections(path))
+
+def _newest_detection_file(paths):
+    """
+    Elige, entre los archivos de detecciones de un mismo nivel, el modificado más recientemente (el .jsonl si
+    empatan), para ignorar los restos de una ejecución anterior en el otro formato.
+    """
+    return max(paths, key=lambda path: (os.path.getmtime(path), is_jsonl(path)))
+
+def list_detection_files(json_dir):
+    """
+    Lista los archivos de detecciones (.json o .jsonl) de un directorio, uno por nivel. Si un nivel tiene los
+    dos formatos (por ejemplo, un .json de una ejecución anterior junto al .jsonl nuevo), solo se devuelve el
+    más reciente, para no contar el nivel dos veces.
+
+    Parameters:
+    json_dir (str): Directorio de detecciones.
+    """
+    files_by_level = {}
+    for f in os.listdir(json_dir):
+        if f.endswith(DETECTION_EXTENSIONS):
+            files_by_level.setdefault(os.path.splitext(f)[0], []).append(f)
+
+    detection_files = []
+    duplicated_levels = 0
+    for files in files_by_level.values():
+        if len(files) > 1:
+            duplicated_levels += 1
+            files = [os.path.basename(_newest_detection_file([os.path.join(json_dir, f) for f in files]))]
+        detection_files.append(files[0])
+
+    if duplicated_levels:
+        print(f"{duplicated_levels} niveles con detecciones en .json y .jsonl en {json_dir}: se usa el archivo más reciente.")
+    return detection_files
+
+def find_level_detections(json_dir, level_name):
+    """
+    Devuelve la ruta del archivo de detecciones de un nivel (.json o .jsonl), o None si no existe. Si existen
+    los dos formatos, devuelve el más reciente (ver list_detection_files).
+
+    Parameters:
+    json_dir (str): Directorio de detecciones por nivel.
+    level_name (str): Nombre base del nivel (ejemplo: 'P28_323_rgb').
+    """
+    paths = [os.path.join(json_dir, f"{level_name}{extension}") for extension in DETECTION_EXTENSIONS]
+    paths = [path for path in paths if os.path.exists(path)]
+    return _newest_detection_file(paths) if paths else None
+
+class DetectionWriter:
+    """
+    Escritor de detecciones. Con una ruta .jsonl escribe cada detección como una línea a medida que llega
+    y vuelca a disco cada 'flush_every' detecciones, sin acumularlas en memoria. Con una ruta .json mantiene el
+    formato clásico: acumula las detecciones y las guarda como una lista con indent al cerrar.
+
+    Parameters:
+    path (str): Ruta del archivo de salida (.json o .jsonl).
+    flush_every (int): Número de detecciones tras el que se vuelca el archivo JSON Lines. Default: 1000.
+    """
+    def __init__(self, path, flush_every=1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.count = 0
+        self._buffer = []
+        self._file = open(path, 'w') if is_jsonl(path) else None
+
+    def write(self, detections):
+        """
+        Añade una lista de detecciones al archivo.
+
+        Parameters:
+        detections (list): Lista de diccionarios de detección.
+        """
+        if self._file is None:
+            self._buffer.extend(detections)
+        else:
+            for detection in detections:
+                self._file.write(json.dumps(detection) + "\n")
+            if (self.count + len(detections)) // self.flush_every > self.count // self.flush_every:
+                self._file.flush()
+        self.count += len(detections)
+
+    def close(self):
+        """
+        Cierra el archivo. En formato .json escribe en este momento la lista completa.
+        """
+        if self._file is None:
+            with open(self.path, 'w') as f:
+                json.dump(self._buffer, f, indent=4)
+            self._buffer = []
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Ejemplo de uso
+# with DetectionWriter("data/P28/detections/detections.jsonl") as writer:
+#     writer.write(detections)
+# for detection in iter_detections("data/P28/detections/detections.jsonl"): ...
@@ -0,0 +1,135 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+import numpy as np
+import tifffile
+from tqdm import tqdm
+from procesamiento.convert_tiff_to_png import get_source_signature, load_manifest, save_manifest, is_up_to_date
+
+def read_level_channels(meanint_path, maxint_path, density_path=None, density_value=0, density_range=(0, 2)):
+    """
+    Lee los TIFF de un nivel y devuelve directamente la imagen RGB en uint8 (R=Density, G=Maxint, B=Meanint),
+    sin pasar por PNG intermedios. Si no hay TIFF de density, el canal R es una constante que no se lee de disco.
+
+    Parameters:
+    meanint_path (str): Ruta del TIFF del canal 'meanint'.
+    maxint_path (str): Ruta del TIFF del canal 'maxint'.
+    density_path (str, optional): Ruta del TIFF del canal 'density'. Si es None, se usa density_value.
+    density_value (int): Valor constante del canal 'density' cuando no hay TIFF. Default: 0 (negro).
+    density_range (tuple): Rango (mínimo, máximo) de density que se escala a 0-255. Default: (0, 2).
+
+    Returns:
+    numpy.ndarray: Imagen RGB de forma (alto, ancho, 3) y tipo uint8.
+    """
+    meanint = tifffile.imread(meanint_path)
+    maxint = tifffile.imread(maxint_path)
+    if meanint.shape != maxint.shape:
+        raise ValueError(f"Tamaños distintos entre {meanint_path} {meanint.shape} y {maxint_path} {maxint.shape}")
+
+    rgb = np.empty(meanint.shape + (3,), dtype=np.uint8)
+
+    # Canal R: density (escalado como en convert_density_tiff_to_png) o constante
+    if density_path is not None:
+        desired_min, desired_max = density_range
+        density = np.clip(tifffile.imread(density_path), desired_min, desired_max)
+        rgb[..., 0] = ((density - desired_min) / (desired_max - desired_min) * 255.0).astype(np.uint8)
+    else:
+        rgb[..., 0] = density_value
+
+    # Canales G y B: maxint y meanint con el mismo cast a uint8 que convert_tiff_to_png
+    rgb[..., 1] = maxint.astype(np.uint8)
+    rgb[..., 2] = meanint.astype(np.uint8)
+    return rgb
+
+def ingest_level_to_rgb(meanint_path, maxint_path, output_path, density_path=None, density_value=0, density_range=(0, 2)):
+    """
+    Genera la imagen RGB de un nivel a partir de sus TIFF y la guarda en PNG.
+
+    Parameters:
+    meanint_path (str): Ruta del TIFF del canal 'meanint'.
+    maxint_path (str): Ruta del TIFF del canal 'maxint'.
+    output_path (str): Ruta de la imagen PNG RGB de salida.
+    density_path (str, optional): Ruta del TIFF del canal 'density'. Si es None, se usa density_value.
+    density_value (int): Valor constante del canal 'density' cuando no hay TIFF. Default: 0.
+    density_range (tuple): Rango (mínimo, máximo) de density que se escala a 0-255. Default: (0, 2).
+    """
+    rgb = read_level_channels(meanint_path, maxint_path, density_path, density_value, density_range)
+    Image.fromarray(rgb).save(output_path, "PNG")
+
+def ingest_levels_to_rgb(meanint_dir, maxint_dir, output_dir, density_dir=None, density_value=0, density_range=(0, 2),
+                         num_workers=1, skip_up_to_date=True, checkpoint_every=20):
+    """
+    Etapa de ingesta fusionada: lee los TIFF 'meanint', 'maxint' y opcionalmente 'density' de cada nivel
+    en una sola pasada y escribe directamente la imagen RGB. Sustituye a la secuencia
+    convert_tiff_to_png + create_blank_density_image + combine_channels_to_rgb_batch, evitando los PNG
+    intermedios por canal. Las salidas se nombran igual que en combine_channels_to_rgb_batch ('<nivel>_rgb.png').
+
+    Parameters:
+    meanint_dir (str): Directorio con los TIFF del canal 'meanint'.
+    maxint_dir (str): Directorio con los TIFF del canal 'maxint'.
+    output_dir (str): Directorio donde se guardarán las imágenes PNG RGB.
+    density_dir (str, optional): Directorio con los TIFF del canal 'density'. Si es None, el canal es constante.
+    density_value (int): Valor constante del canal 'density' cuando no hay TIFF. Default: 0 (negro).
+    density_range (tuple): Rango (mínimo, máximo) de density que se escala a 0-255. Default: (0, 2).
+    num_workers (int): Número de procesos para la ingesta. Si es 1, se procesa en serie. Default: 1.
+    skip_up_to_date (bool): Si True, omite los niveles cuyos TIFF de origen no han cambiado. Default: True.
+    checkpoint_every (int): Cada cuántos niveles se guarda el manifiesto. Default: 20.
+    """
+    # Crear el directorio de salida si no existe
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Listar archivos en cada directorio y verificar que coincidan
+    meanint_files = sorted([f for f in os.listdir(meanint_dir) if f.endswith('.tif')])
+    maxint_files = sorted([f for f in os.listdir(maxint_dir) if f.endswith('.tif')])
+    if meanint_files != maxint_files:
+        raise ValueError("Las carpetas 'meanint' y 'maxint' deben contener los mismos archivos .tif.")
+
+    if density_dir is not None:
+        missing = [f for f in meanint_files if not os.path.exists(os.path.join(density_dir, f))]
+        if missing:
+            raise ValueError(f"Faltan {len(missing)} archivos en la carpeta 'density', por ejemplo: {missing[0]}")
+
+    manifest = load_manifest(output_dir) if skip_up_to_date else {}
+
+    # Determinar qué niveles necesitan ingesta
+    pending = []
+    for tiff_file in meanint_files:
+        meanint_path = os.path.join(meanint_dir, tiff_file)
+        maxint_path = os.path.join(maxint_dir, tiff_file)
+        density_path = os.path.join(density_dir, tiff_file) if density_dir is not None else None
+        output_file = os.path.splitext(tiff_file)[0] + "_rgb.png"
+
+        source_paths = [meanint_path, maxint_path] + ([density_path] if density_path else [])
+        # La firma incluye los parámetros de density para regenerar si cambian
+        signature = get_source_signature(*source_paths) + [[density_value, list(density_range)]]
+        if skip_up_to_date and is_up_to_date(manifest, output_dir, output_file, signature):
+            continue
+        pending.append(((meanint_path, maxint_path, os.path.join(output_dir, output_file), density_path), output_file, signature))
+
+    skipped = len(meanint_files) - len(pending)
+    if skipped:
+        print(f"Omitidos {skipped} niveles ya procesados y sin cambios.")
+
+    if num_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                executor.submit(ingest_level_to_rgb, *args, density_value=density_value, density_range=density_range): (output_file, signature)
+                for args, output_file, signature in pending
+            }
+            for done, future in enumerate(tqdm(as_completed(futures), total=len(futures), desc="Generando imágenes RGB", unit="nivel"), start=1):
+                future.result()
+                output_file, signature = futures[future]
+                manifest[output_file] = signature
+                if done % checkpoint_every == 0:
+                    save_manifest(output_dir, manifest)
+    else:
+        for done, (args, output_file, signature) in enumerate(tqdm(pending, desc="Generando imágenes RGB", unit="nivel"), start=1):
+            ingest_level_to_rgb(*args, density_value=density_value, density_range=density_range)
+            manifest[output_file] = signature
+            if done % checkpoint_every == 0:
+                save_manifest(output_dir, manifest)
+
+    save_manifest(output_dir, manifest)
+
+# Ejemplo de uso
+# ingest_levels_to_rgb("data/P28/1cm_meanint", "data/P28/1cm_maxint", "data/P28/rgb_images", num_workers=4)
@@ -0,0 +1,195 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio
+import tifffile
+from tqdm import tqdm
+from procesamiento.convert_tiff_to_png import get_source_signature
+from procesamiento.ingest_levels import read_level_channels
+
+VOLUME_FILENAME = "volume.npy"
+INDEX_FILENAME = "volume_index.json"
+CHANNEL_NAMES = ["density", "maxint", "meanint"]
+
+def parse_level_number(name):
+    """
+    Extrae el número de nivel de un nombre de archivo de la finca (ejemplo: 'P28_323_rgb.png' -> 323).
+
+    Parameters:
+    name (str): Nombre del archivo o nombre base del nivel.
+
+    Returns:
+    int: Número de nivel.
+    """
+    return int(os.path.basename(name).split('_')[1].split('.')[0])
+
+def _fill_volume_level(volume_path, position, meanint_path, maxint_path, density_path, density_value, density_range):
+    """
+    Escribe un nivel en el volumen mapeado en memoria. Se ejecuta en los procesos del pool.
+    """
+    volume = np.load(volume_path, mmap_mode='r+')
+    volume[position] = read_level_channels(meanint_path, maxint_path, density_path, density_value, density_range)
+    volume.flush()
+    del volume
+
+def build_level_volume(meanint_dir, maxint_dir, output_dir, density_dir=None, density_value=0, density_range=(0, 2), num_workers=1):
+    """
+    Construye el volumen de niveles de una finca: un único array uint8 de forma (niveles, alto, ancho, 3)
+    mapeado en memoria ('volume.npy'), con los canales en el mismo orden que las imágenes RGB
+    (R=Density, G=Maxint, B=Meanint), y un índice JSON ('volume_index.json') con los números de nivel,
+    la geotransformación y los nombres de canal. Si el índice ya existe y los TIFF de origen no han cambiado,
+    no se reconstruye.
+
+    Parameters:
+    meanint_dir (str): Directorio con los TIFF del canal 'meanint'.
+    maxint_dir (str): Directorio con los TIFF del canal 'maxint'.
+    output_dir (str): Directorio donde se guardarán el volumen y su índice.
+    density_dir (str, optional): Directorio con los TIFF del canal 'density'. Si es None, el canal es constante.
+    density_value (int): Valor constante del canal 'density' cuando no hay TIFF. Default: 0 (negro).
+    density_range (tuple): Rango (mínimo, máximo) de density que se escala a 0-255. Default: (0, 2).
+    num_workers (int): Número de procesos para rellenar el volumen. Default: 1.
+
+    Returns:
+    dict: Índice del volumen.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Listar los niveles ordenados por número de nivel
+    tiff_files = sorted([f for f in os.listdir(meanint_dir) if f.endswith('.tif')], key=parse_level_number)
+    if not tiff_files:
+        raise ValueError(f"No se encontraron archivos .tif en la carpeta: {meanint_dir}")
+
+    sources = []
+    for tiff_file in tiff_files:
+        maxint_path = os.path.join(maxint_dir, tiff_file)
+        if not os.path.exists(maxint_path):
+            raise ValueError(f"Falta el archivo {tiff_file} en la carpeta 'maxint'.")
+        density_path = os.path.join(density_dir, tiff_file) if density_dir is not None else None
+        sources.append((os.path.join(meanint_dir, tiff_file), maxint_path, density_path))
+
+    signature = [get_source_signature(*[p for p in paths if p]) for paths in sources] + [[density_value, list(density_range)]]
+
+    # Reutilizar el volumen existente si se construyó con los mismos TIFF
+    volume_path = os.path.join(output_dir, VOLUME_FILENAME)
+    index_path = os.path.join(output_dir, INDEX_FILENAME)
+    if os.path.exists(index_path) and os.path.exists(volume_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get("source_signature") == signature:
+            print(f"Volumen de niveles actualizado, se reutiliza: {volume_path}")
+            return index
+
+    # Tomar el tamaño y la georreferenciación del primer TIFF
+    with tifffile.TiffFile(sources[0][0]) as tiff:
+        height, width = tiff.pages[0].shape[:2]
+    with rasterio.open(sources[0][0]) as dataset:
+        geotransform = list(dataset.transform.to_gdal())
+        crs = dataset.crs.to_wkt() if dataset.crs else None
+
+    # Crear el volumen vacío en disco
+    shape = (len(tiff_files), height, width, len(CHANNEL_NAMES))
+    volume = np.lib.format.open_memmap(volume_path, mode='w+', dtype=np.uint8, shape=shape)
+    del volume
+
+    # Rellenar cada nivel del volumen
+    if num_workers > 1 and len(sources) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(_fill_volume_level, volume_path, position, *paths, density_value, density_range)
+                for position, paths in enumerate(sources)
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Construyendo volumen de niveles", unit="nivel"):
+                future.result()
+    else:
+        for position, paths in enumerate(tqdm(sources, desc="Construyendo volumen de niveles", unit="nivel")):
+            _fill_volume_level(volume_path, position, *paths, density_value, density_range)
+
+    # Guardar el índice del volumen
+    index = {
+        "levels": [parse_level_number(f) for f in tiff_files],
+        "level_names": [os.path.splitext(f)[0] + "_rgb" for f in tiff_files],
+        "shape": list(shape),
+        "channels": CHANNEL_NAMES,
+        "geotransform": geotransform,
+        "crs": crs,
+        "source_signature": signature
+    }
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=4)
+
+    print(f"Volumen de niveles guardado en: {volume_path}")
+    return index
+
+def load_level_volume(volume_dir):
+    """
+    Abre el volumen de niveles de una finca en modo solo lectura, mapeado en memoria.
+
+    Parameters:
+    volume_dir (str): Directorio que contiene 'volume.npy' y 'volume_index.json'.
+
+    Returns:
+    tuple: (volumen numpy.memmap de forma (niveles, alto, ancho, 3), índice dict).
+    """
+    with open(os.path.join(volume_dir, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    volume = np.load(os.path.join(volume_dir, VOLUME_FILENAME), mmap_mode='r')
+    return volume, index
+
+def is_level_volume(path):
+    """
+    Indica si un directorio contiene un volumen de niveles.
+
+    Parameters:
+    path (str): Ruta a comprobar.
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_FILENAME))
+
+def get_volume_image_shape(volume_dir):
+    """
+    Devuelve el tamaño (alto, ancho) de las imágenes de la finca leyendo solo el índice del volumen.
+
+    Parameters:
+    volume_dir (str): Directorio del volumen de niveles.
+    """
+    with open(os.path.join(volume_dir, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    return tuple(index["shape"][1:3])
+
+def get_level(volume, index, level):
+    """
+    Devuelve la imagen (alto, ancho, 3) de un nivel como vista del volumen, sin copias.
+
+    Parameters:
+    volume (numpy.memmap): Volumen de niveles.
+    index (dict): Índice del volumen.
+    level (int): Número de nivel.
+    """
+    try:
+        position = index["levels"].index(level)
+    except ValueError:
+        raise ValueError(f"El nivel {level} no existe en el volumen.")
+    return volume[position]
+
+def get_level_range(volume, index, min_level=None, max_level=None):
+    """
+    Devuelve los niveles dentro del rango [min_level, max_level] como vista contigua del volumen, sin copias.
+
+    Parameters:
+    volume (numpy.memmap): Volumen de niveles.
+    index (dict): Índice del volumen.
+    min_level (int, optional): Nivel mínimo. Si es None, desde el primer nivel.
+    max_level (int, optional): Nivel máximo. Si es None, hasta el último nivel.
+
+    Returns:
+    tuple: (vista del volumen de forma (n, alto, ancho, 3), lista de números de nivel incluidos).
+    """
+    levels = np.asarray(index["levels"])
+    start = 0 if min_level is None else int(np.searchsorted(levels, min_level, side='left'))
+    stop = len(levels) if max_level is None else int(np.searchsorted(levels, max_level, side='right'))
+    return volume[start:stop], index["levels"][start:stop]
+
+# Ejemplo de uso
+# build_level_volume("data/P28/1cm_meanint", "data/P28/1cm_maxint", "data/P28/volume", num_workers=4)
+# volume, index = load_level_volume("data/P28/volume")
+# levels_100_250, level_numbers = get_level_range(volume, index, min_level=100, max_level=250)
@@ -0,0 +1,203 @@
+import numpy as np
+from scipy import sparse
+
+MERGE_METHODS = ('nms', 'wbf')
+
+# Celdas vecinas que se comparan con cada celda dentro de una misma rejilla (media vecindad: cada par de celdas
+# se visita una sola vez) y entre rejillas distintas (vecindad completa)
+NEIGHBOR_OFFSETS = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+FULL_NEIGHBOR_OFFSETS = tuple((dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+
+# Percentil del tamaño de las cajas que fija la celda de la rejilla más fina
+CELL_SIZE_PERCENTILE = 90
+
+def _expand_neighbor_cells(query_keys, target_keys, rows, offsets, same_boxes=False):
+    """
+    Empareja cada caja de consulta con todas las cajas destino de sus celdas vecinas en una rejilla.
+
+    Parameters:
+    query_keys (numpy.ndarray): Clave de celda de cada caja de consulta.
+    target_keys (numpy.ndarray): Clave de celda de cada caja destino.
+    rows (int): Número de filas de la rejilla (la clave de una celda es columna * rows + fila).
+    offsets (tuple): Desplazamientos (columna, fila) de las celdas vecinas que se comparan.
+    same_boxes (bool): Si True, consulta y destino son las mismas cajas y cada par de la misma celda se
+                       devuelve una sola vez (con i < j).
+
+    Returns:
+    tuple: Arrays (i, j) con los índices de consulta y destino de cada par candidato.
+    """
+    # Cajas destino ordenadas por celda y rango de cada celda en ese orden
+    order = np.argsort(target_keys, kind='stable')
+    cell_keys, cell_starts, cell_counts = np.unique(target_keys[order], return_index=True, return_counts=True)
+
+    pairs_i, pairs_j = [], []
+    for dx, dy in offsets:
+        # Localizar la celda vecina de cada caja
+        neighbor_keys = query_keys + dx * rows + dy
+        positions = np.clip(np.searchsorted(cell_keys, neighbor_keys), 0, len(cell_keys) - 1)
+        counts = np.where(cell_keys[positions] == neighbor_keys, cell_counts[positions], 0)
+        if counts.sum() == 0:
+            continue
+
+        # Expandir cada caja con todas las cajas de su celda vecina
+        i = np.repeat(np.arange(len(query_keys)), counts)
+        offsets_in_cell = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(cell_starts[positions], counts) + offsets_in_cell]
+        if same_boxes and (dx, dy) == (0, 0):
+            i, j = i[i < j], j[i < j]
+        pairs_i.append(i)
+        pairs_j.append(j)
+
+    if not pairs_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+def find_overlapping_pairs(x_center, y_center, width, height, iou_threshold=0.5, groups=None):
+    """
+    Encuentra los pares de cajas de un nivel con IoU >= iou_threshold sin comparar todas contra todas. Las cajas
+    se reparten en rejillas jerárquicas: la más fina tiene celdas del tamaño del percentil CELL_SIZE_PERCENTILE
+    de las cajas y cada rejilla siguiente duplica el tamaño de celda, y cada caja va a la primera rejilla cuya
+    celda no es menor que ella. Dos cajas que se solapan están en la misma celda o en celdas vecinas de la
+    rejilla más gruesa de las dos, y solo se comparan esas. Así una caja atípica muy grande no agranda las celdas
+    de todo el nivel y el coste es casi lineal en el número de cajas.
+
+    Parameters:
+    x_center, y_center, width, height (numpy.ndarray): Columnas de las cajas del nivel.
+    iou_threshold (float): IoU mínimo para considerar dos cajas duplicadas. Default: 0.5.
+    groups (numpy.ndarray, optional): Identificador entero del crop de origen de cada caja. Si se indica, solo
+                                      se emparejan cajas de crops distintos (YOLO ya aplica NMS dentro de cada crop).
+
+    Returns:
+    tuple: Arrays (i, j) con los índices de las cajas de cada par, con i != j.
+    """
+    x_center, y_center = np.asarray(x_center, dtype=np.float64), np.asarray(y_center, dtype=np.float64)
+    width, height = np.asarray(width, dtype=np.float64), np.asarray(height, dtype=np.float64)
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(x_center) < 2:
+        return empty
+
+    # Rejilla de cada caja: la primera cuya celda (base * 2^k) no es menor que el lado mayor de la caja
+    box_size = np.maximum(width, height)
+    base_size = max(float(np.percentile(box_size, CELL_SIZE_PERCENTILE)), 1e-6)
+    box_grid = np.ceil(np.log2(np.maximum(box_size / base_size, 1.0))).astype(np.int64)
+    grid_ids = np.unique(box_grid)
+    members = {grid_id: np.flatnonzero(box_grid == grid_id) for grid_id in grid_ids.tolist()}
+    origin_x, origin_y = x_center.min(), y_center.min()
+
+    def cell_keys(boxes, cell_size, rows):
+        cell_x = np.floor((x_center[boxes] - origin_x) / cell_size).astype(np.int64)
+        cell_y = np.floor((y_center[boxes] - origin_y) / cell_size).astype(np.int64) + 1
+        return cell_x * rows + cell_y
+
+    pairs_i, pairs_j = [], []
+    for grid_id in grid_ids.tolist():
+        # Celdas de la rejilla, con una fila de margen a cada lado para las vecinas
+        cell_size = base_size * 2.0 ** grid_id
+        rows = int(np.floor((y_center.max() - origin_y) / cell_size)) + 3
+        grid_boxes = members[grid_id]
+        grid_keys = cell_keys(grid_boxes, cell_size, rows)
+
+        # Pares dentro de la rejilla
+        i, j = _expand_neighbor_cells(grid_keys, grid_keys, rows, NEIGHBOR_OFFSETS, same_boxes=True)
+        pairs_i.append(grid_boxes[i])
+        pairs_j.append(grid_boxes[j])
+
+        # Pares con las cajas de las rejillas más finas, buscadas en las celdas de esta rejilla
+        finer_boxes = np.flatnonzero(box_grid < grid_id)
+        if len(finer_boxes):
+            i, j = _expand_neighbor_cells(cell_keys(finer_boxes, cell_size, rows), grid_keys, rows, FULL_NEIGHBOR_OFFSETS)
+            pairs_i.append(finer_boxes[i])
+            pairs_j.append(grid_boxes[j])
+
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    if groups is not None:
+        groups = np.asarray(groups)
+        different = groups[i] != groups[j]
+        i, j = i[different], j[different]
+
+    # IoU de los pares candidatos
+    half_w, half_h = width / 2, height / 2
+    overlap_w = np.minimum(x_center[i] + half_w[i], x_center[j] + half_w[j]) - np.maximum(x_center[i] - half_w[i], x_center[j] - half_w[j])
+    overlap_h = np.minimum(y_center[i] + half_h[i], y_center[j] + half_h[j]) - np.maximum(y_center[i] - half_h[i], y_center[j] - half_h[j])
+    intersection = np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None)
+    union = width[i] * height[i] + width[j] * height[j] - intersection
+    iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    duplicated = iou >= iou_threshold
+    return i[duplicated], j[duplicated]
+
+def assign_duplicates(confidence, pairs_i, pairs_j):
+    """
+    NMS voraz sobre el grafo de pares solapados: recorre las cajas por confianza descendente y cada caja que
+    se conserva absorbe a sus vecinas aún sin asignar. Solo se recorren las cajas que tienen algún par.
+
+    Parameters:
+    confidence (numpy.ndarray): Confianza de cada caja.
+    pairs_i, pairs_j (numpy.ndarray): Pares de cajas duplicadas (ver find_overlapping_pairs).
+
+    Returns:
+    numpy.ndarray: Para cada caja, el índice de la caja conservada a la que pertenece (ella misma si se conserva).
+    """
+    num_boxes = len(confidence)
+    representative = np.arange(num_boxes)
+    if len(pairs_i) == 0:
+        return representative
+
+    # Grafo de solapes en formato CSR (simétrico)
+    graph = sparse.csr_matrix((np.ones(2 * len(pairs_i), dtype=bool), (np.concatenate([pairs_i, pairs_j]), np.concatenate([pairs_j, pairs_i]))),
+                              shape=(num_boxes, num_boxes))
+    indptr, indices = graph.indptr, graph.indices
+
+    assigned = np.zeros(num_boxes, dtype=bool)
+    connected = np.flatnonzero(np.diff(indptr) > 0)
+    for box in connected[np.argsort(-np.asarray(confidence)[connected], kind='stable')].tolist():
+        if assigned[box]:
+            continue
+        assigned[box] = True
+        neighbors = indices[indptr[box]:indptr[box + 1]]
+        neighbors = neighbors[~assigned[neighbors]]
+        representative[neighbors] = box
+        assigned[neighbors] = True
+    return representative
+
+def merge_duplicate_boxes(columns, iou_threshold=0.5, method='nms', groups=None):
+    """
+    Elimina las detecciones duplicadas de un nivel (el mismo tronco detectado en varios crops solapados).
+    Con 'nms' se conserva la caja de mayor confianza de cada grupo de duplicados; con 'wbf' (weighted box
+    fusion) la caja conservada toma la media de las coordenadas del grupo ponderada por confianza y la
+    confianza media del grupo.
+
+    Parameters:
+    columns (dict): Columnas del nivel (al menos x_center, y_center, width, height y confidence).
+    iou_threshold (float): IoU mínimo para considerar dos cajas duplicadas. Default: 0.5.
+    method (str): 'nms' o 'wbf'. Default: 'nms'.
+    groups (numpy.ndarray, optional): Identificador del crop de origen de cada caja (ver find_overlapping_pairs).
+
+    Returns:
+    tuple: (índices de las cajas conservadas en el orden original, columnas del nivel sin duplicados).
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Método de fusión no soportado: {method}. Opciones: {MERGE_METHODS}")
+
+    confidence = np.asarray(columns["confidence"], dtype=np.float64)
+    pairs_i, pairs_j = find_overlapping_pairs(columns["x_center"], columns["y_center"], columns["width"], columns["height"],
+                                              iou_threshold, groups)
+    representative = assign_duplicates(confidence, pairs_i, pairs_j)
+    keep = np.flatnonzero(representative == np.arange(len(representative)))
+    merged = {column: np.asarray(values)[keep] for column, values in columns.items()}
+
+    if method == 'wbf' and len(keep) < len(representative):
+        # Media ponderada por confianza de cada grupo de duplicados, indexada por la caja conservada
+        group_weight = np.bincount(representative, weights=confidence, minlength=len(representative))[keep]
+        group_size = np.bincount(representative, minlength=len(representative))[keep]
+        for column in ("x_center", "y_center", "width", "height"):
+            values = np.asarray(columns[column], dtype=np.float64)
+            fused = np.bincount(representative, weights=values * confidence, minlength=len(representative))[keep]
+            fused = np.divide(fused, group_weight, out=values[keep].copy(), where=group_weight > 0)
+            merged[column] = fused.astype(np.asarray(columns[column]).dtype)
+        merged["confidence"] = (group_weight / group_size).astype(np.asarray(columns["confidence"]).dtype)
+
+    return keep, merged
+
+# Ejemplo de uso
+# keep, level_columns = merge_duplicate_boxes(level_columns, iou_threshold=0.5, method='wbf', groups=crop_ids)
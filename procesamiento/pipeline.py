@@ -0,0 +1,207 @@
+import os
+import queue
+import threading
+import numpy as np
+from tqdm import tqdm
+from procesamiento.crop_images import CropSource
+from procesamiento.apply_yolo import load_yolo_model, infer_batch
+from procesamiento.detection_cache import DetectionCache
+from procesamiento.detections_io import DetectionWriter
+
+# Marca de fin de etapa que se envía por las colas
+_END = object()
+
+def _put(stage_queue, item, stop_event):
+    """
+    Inserta un elemento en una cola acotada, abandonando si otra etapa ha fallado.
+    """
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(stage_queue, stop_event):
+    """
+    Extrae un elemento de una cola, devolviendo _END si otra etapa ha fallado.
+    """
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+def _get_nowait(stage_queue):
+    """
+    Extrae un elemento de una cola sin esperar, o devuelve None si está vacía.
+    """
+    try:
+        return stage_queue.get_nowait()
+    except queue.Empty:
+        return None
+
+def _acquire(semaphore, stop_event):
+    """
+    Reserva un hueco de un semáforo, abandonando si otra etapa ha fallado.
+    """
+    while not stop_event.is_set():
+        if semaphore.acquire(timeout=0.1):
+            return True
+    return False
+
+def _run_stage(target, errors, stop_event, *args):
+    """
+    Ejecuta una etapa registrando su excepción y deteniendo el resto de etapas si falla.
+    """
+    try:
+        target(*args)
+    except BaseException as e:
+        errors.append(e)
+        stop_event.set()
+
+def _loader_stage(crop_source, positions, level_queue, level_slots, stop_event):
+    # Decodificar los niveles asignados a este hilo, reservando antes un hueco para el nivel decodificado
+    for position in positions:
+        if not _acquire(level_slots, stop_event):
+            return
+        if not _put(level_queue, crop_source.load_level(position, in_memory=True), stop_event):
+            return
+    _put(level_queue, _END, stop_event)
+
+def _tiler_stage(crop_source, num_loaders, num_inference_workers, level_queue, level_slots, crop_queue, stop_event):
+    # Generar los crops de cada nivel a medida que los cargadores los entregan
+    finished_loaders = 0
+    while finished_loaders < num_loaders:
+        item = _get(level_queue, stop_event)
+        if item is _END:
+            if stop_event.is_set():
+                return
+            finished_loaders += 1
+            continue
+        level_name, image = item
+        for _, x, y, crop in crop_source.iter_level_crops(level_name, image):
+            # YOLO espera arrays en orden BGR, como los devuelve cv2.imread
+            if not _put(crop_queue, (f"{level_name}_{x}_{y}.png", np.ascontiguousarray(crop[..., ::-1])), stop_event):
+                return
+        # Liberar el hueco del nivel una vez recortado por completo
+        item = image = None
+        level_slots.release()
+    for _ in range(num_inference_workers):
+        _put(crop_queue, _END, stop_event)
+
+def _inference_stage(model_path, batch_size, cache, inference_settings, crop_queue, result_queue, stop_event):
+    # Cada trabajador de inferencia carga su propio modelo
+    model = load_yolo_model(model_path)
+    finished = False
+    while not finished:
+        batch = []
+        while len(batch) < batch_size:
+            item = _get(crop_queue, stop_event) if not batch else _get_nowait(crop_queue)
+            if item is None:
+                break
+            if item is _END:
+                finished = True
+                break
+            batch.append(item)
+        if stop_event.is_set():
+            return
+        if batch:
+            detections = infer_batch(model, batch, cache, inference_settings)
+            if not _put(result_queue, (len(batch), detections), stop_event):
+                return
+    _put(result_queue, _END, stop_event)
+
+def _writer_stage(output_json_path, num_inference_workers, total_crops, result_queue, stop_event):
+    # Recoger las detecciones de los trabajadores de inferencia y guardarlas a medida que llegan
+    finished_workers = 0
+    with DetectionWriter(output_json_path) as writer, tqdm(total=total_crops, desc="Pipeline de detección", unit="imagen") as progress:
+        while finished_workers < num_inference_workers:
+            item = _get(result_queue, stop_event)
+            if item is _END:
+                if stop_event.is_set():
+                    return
+                finished_workers += 1
+                continue
+            num_crops, detections = item
+            writer.write(detections)
+            progress.update(num_crops)
+
+def run_streaming_pipeline(source_dir, output_json_path, model_path, image_size=640, batch_size=16, num_loaders=2,
+                           num_inference_workers=1, level_queue_size=2, crop_queue_size=256, cache_dir=None,
+                           inference_settings=None, checkpoint_every=500, min_nonzero_fraction=None, min_max_intensity=None):
+    """
+    Ejecuta la carga de niveles, el recorte, la inferencia con YOLO y la escritura de detecciones como
+    etapas concurrentes conectadas por colas acotadas, de forma que la E/S y el cálculo se solapan.
+    La memoria está acotada: los cargadores reservan un hueco antes de decodificar cada nivel y el recorte lo
+    libera al terminarlo, de modo que como máximo hay level_queue_size niveles decodificados (en decodificación,
+    en espera o recortándose) y crop_queue_size crops esperando inferencia. Las etapas reutilizan CropSource (carga y recorte), infer_batch (inferencia
+    por lotes con caché opcional) y producen el mismo JSON (o JSON Lines) que apply_yolo_to_crops.
+
+    Parameters:
+    source_dir (str): Volumen de niveles o directorio con las imágenes RGB de cada nivel.
+    output_json_path (str): Ruta donde se guardará el archivo JSON (.json o .jsonl) con los resultados.
+    model_path (str): Ruta al archivo del modelo YOLO entrenado (.pt).
+    image_size (int): Tamaño de los crops (ancho y alto). Default: 640.
+    batch_size (int): Número de crops por llamada al modelo. Default: 16.
+    num_loaders (int): Número de hilos que decodifican niveles. Default: 2.
+    num_inference_workers (int): Número de hilos de inferencia, cada uno con su propio modelo. Default: 1.
+    level_queue_size (int): Máximo de niveles decodificados a la vez, incluido el que se está recortando. Default: 2.
+    crop_queue_size (int): Máximo de crops en espera de inferencia. Default: 256.
+    cache_dir (str, optional): Directorio de la caché de detecciones. Si es None, no se usa caché.
+    inference_settings (dict, optional): Parámetros adicionales para la llamada al modelo (conf, iou, imgsz...).
+    checkpoint_every (int): Cada cuántos crops nuevos se vuelca la caché a disco. Default: 500.
+    min_nonzero_fraction (float, optional): Si se indica, el recorte omite los crops con una fracción menor de
+                                            píxeles distintos de cero en el canal maxint (ver get_content_mask).
+    min_max_intensity (int, optional): Si se indica, el recorte omite los crops cuya intensidad máxima en el
+                                       canal maxint sea menor.
+    """
+    # Crear la carpeta de salida si no existe
+    os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
+
+    crop_source = CropSource(source_dir, image_size=image_size, min_nonzero_fraction=min_nonzero_fraction,
+                             min_max_intensity=min_max_intensity)
+    cache = DetectionCache(cache_dir, model_path, inference_settings, checkpoint_every) if cache_dir else None
+    num_loaders = max(1, min(num_loaders, len(crop_source.level_names)))
+
+    level_queue = queue.Queue(maxsize=level_queue_size)
+    level_slots = threading.Semaphore(max(1, level_queue_size))
+    crop_queue = queue.Queue(maxsize=crop_queue_size)
+    result_queue = queue.Queue(maxsize=num_inference_workers * 4)
+    stop_event = threading.Event()
+    errors = []
+
+    # Repartir los niveles entre los cargadores de forma intercalada
+    positions = list(range(len(crop_source.level_names)))
+    threads = [
+        threading.Thread(target=_run_stage, args=(_loader_stage, errors, stop_event, crop_source, positions[i::num_loaders], level_queue, level_slots, stop_event))
+        for i in range(num_loaders)
+    ]
+    threads.append(threading.Thread(target=_run_stage, args=(_tiler_stage, errors, stop_event, crop_source, num_loaders, num_inference_workers, level_queue, level_slots, crop_queue, stop_event)))
+    threads += [
+        threading.Thread(target=_run_stage, args=(_inference_stage, errors, stop_event, model_path, batch_size, cache, inference_settings, crop_queue, result_queue, stop_event))
+        for _ in range(num_inference_workers)
+    ]
+    threads.append(threading.Thread(target=_run_stage, args=(_writer_stage, errors, stop_event, output_json_path, num_inference_workers, len(crop_source), result_queue, stop_event)))
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if cache is not None:
+        cache.close()
+
+    if errors:
+        raise errors[0]
+
+    if crop_source.skipped_crops:
+        print(f"Crops vacíos omitidos: {sum(crop_source.skipped_crops.values())} de {len(crop_source)}")
+    print(f"Resultados guardados en {output_json_path}")
+
+# Ejemplo de uso
+# run_streaming_pipeline("data/P28/volume", "data/P28/detections/detections.json", "path/to/your/model.pt",
+#                        batch_size=16, num_loaders=2, num_inference_workers=1, cache_dir="data/P28/detections/cache")
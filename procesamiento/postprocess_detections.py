@@ -1,102 +1,164 @@
 import os
 import json
+import numpy as np
 from collections import defaultdict
 from tqdm import tqdm
+from procesamiento.detections_io import DetectionWriter, iter_detections, is_jsonl, list_detection_files
+from procesamiento.merge_detections import merge_duplicate_boxes
 
-def split_detections_by_level(global_json_path, output_dir):
+def split_detections_by_level(global_json_path, output_dir, output_format=None, flush_every=1000):
     """
     Divide un archivo JSON de detecciones globales en archivos JSON separados por nivel.
     Cada nivel corresponde a una imagen original de la que se derivaron los crops.
+    Las detecciones se leen en streaming; con salida 'jsonl' se escriben por nivel en bloques de
+    flush_every, de modo que la memoria usada no depende del tamaño del archivo global.
 
     Parameters:
-    global_json_path (str): Ruta al archivo JSON que contiene todas las detecciones.
+    global_json_path (str): Ruta al archivo JSON (.json o .jsonl) que contiene todas las detecciones.
     output_dir (str): Directorio donde se guardarán los JSONs por nivel.
+    output_format (str, optional): 'json' o 'jsonl'. Si es None, se usa el mismo formato que el archivo global.
+    flush_every (int): Detecciones acumuladas por nivel antes de escribirlas en salida 'jsonl'. Default: 1000.
     """
     # Crear el directorio de salida si no existe
     os.makedirs(output_dir, exist_ok=True)
 
-    # Cargar el JSON global
-    with open(global_json_path, 'r') as f:
-        global_detections = json.load(f)
+    if output_format is None:
+        output_format = 'jsonl' if is_jsonl(global_json_path) else 'json'
 
     # Usar un diccionario para agrupar detecciones por nivel
     detections_by_level = defaultdict(list)
+    started_levels = set()
+
+    def write_level_chunk(base_name):
+        # Añadir las detecciones pendientes del nivel a su archivo JSON Lines
+        mode = 'a' if base_name in started_levels else 'w'
+        with open(os.path.join(output_dir, f"{base_name}.jsonl"), mode) as f:
+            for detection in detections_by_level[base_name]:
+                f.write(json.dumps(detection) + "\n")
+        started_levels.add(base_name)
+        detections_by_level[base_name] = []
 
     # Agrupar las detecciones por el nombre base de la imagen original
-    for detection in global_detections:
+    for detection in iter_detections(global_json_path):
         # Extraer el nombre base, eliminando las coordenadas del crop (ejemplo: "P28_323_rgb")
         crop_image_name = detection["image"]
         base_name = "_".join(crop_image_name.split("_")[:-2])  # Elimina las últimas dos partes que son las coordenadas
 
         # Añadir la detección a la lista correspondiente a ese nivel
         detections_by_level[base_name].append(detection)
-
-    # Guardar cada grupo de detecciones en un archivo JSON separado
-    for base_name, detections in detections_by_level.items():
-        output_path = os.path.join(output_dir, f"{base_name}.json")
-        with open(output_path, 'w') as f:
-            json.dump(detections, f, indent=4)
+        if output_format == 'jsonl' and len(detections_by_level[base_name]) >= flush_every:
+            write_level_chunk(base_name)
+
+    # Guardar cada grupo de detecciones en un archivo separado
+    for base_name in list(detections_by_level):
+        if output_format == 'jsonl':
+            write_level_chunk(base_name)
+            output_path = os.path.join(output_dir, f"{base_name}.jsonl")
+        else:
+            output_path = os.path.join(output_dir, f"{base_name}.json")
+            with open(output_path, 'w') as f:
+                json.dump(detections_by_level[base_name], f, indent=4)
         print(f"Guardado: {output_path}")
 
-def remap_detections_to_original(json_dir, output_dir):
+def remap_detections_to_original(json_dir, output_dir, merge=None, iou_threshold=0.5):
     """
     Ajusta las coordenadas de las detecciones en los crops para mapearlas de vuelta a la imagen original,
     manteniendo una referencia al crop original en el campo 'original_crop'.
+    Los archivos por nivel pueden ser .json o .jsonl; cada salida mantiene el formato de su entrada y los
+    .jsonl se procesan en streaming, detección a detección.
+    Con merge, los duplicados del mismo tronco detectado en crops solapados se fusionan por nivel (ver
+    merge_duplicate_boxes); en ese caso las detecciones de cada nivel se remapean completas antes de escribirlas.
     
     Parameters:
     json_dir (str): Directorio que contiene los archivos JSON de detecciones por nivel.
     output_dir (str): Directorio donde se guardarán los JSONs con las coordenadas remapeadas.
-    image_size (int): Tamaño de los crops utilizados para las detecciones. Default: 640.
+    merge (str, optional): Fusión de duplicados entre crops, 'nms' o 'wbf'. Si es None, se conservan todas.
+    iou_threshold (float): IoU mínimo para considerar dos detecciones duplicadas. Default: 0.5.
     """
     # Crear el directorio de salida si no existe
     os.makedirs(output_dir, exist_ok=True)
 
-    # Listar todos los archivos JSON en el directorio de detecciones por nivel
-    json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
+    # Listar todos los archivos de detecciones en el directorio de detecciones por nivel
+    json_files = list_detection_files(json_dir)
 
-    # Procesar cada archivo JSON con una barra de progreso
+    # Procesar cada archivo con una barra de progreso
     for json_file in tqdm(json_files, desc="Remapeando detecciones", unit="archivo"):
         json_path = os.path.join(json_dir, json_file)
-
-        # Cargar las detecciones desde el archivo JSON
-        with open(json_path, 'r') as f:
-            detections = json.load(f)
-        
-        remapped_detections = []
-
-        # Remapear cada detección a la imagen original
-        for detection in detections:
-            # Extraer el nombre del archivo del crop para obtener las coordenadas del offset
-            crop_file = detection["image"]
-            parts = crop_file.split("_")
-            x_offset = int(parts[-2])  # Segundo último elemento del nombre es el offset X
-            y_offset = int(parts[-1].replace(".png", ""))  # Último elemento es el offset Y
-
-            # Recuperar las coordenadas originales
-            x_center_original = detection["x_center"] + x_offset
-            y_center_original = detection["y_center"] + y_offset
-
-            # Guardar las coordenadas remapeadas junto con los demás detalles de la detección
-            remapped_detection = {
-                "image": json_file.replace(".json", ""),  # Nombre de la imagen original (sin el crop)
-                "original_crop": crop_file,  # Referencia al archivo del crop original
-                "x_center": x_center_original,
-                "y_center": y_center_original,
-                "width": detection["width"],
-                "height": detection["height"],
-                "confidence": detection["confidence"],
-                "class": detection["class"]
-            }
-            remapped_detections.append(remapped_detection)
-
-        # Guardar el archivo JSON con las coordenadas remapeadas
         output_json_path = os.path.join(output_dir, json_file)
-        with open(output_json_path, 'w') as f:
-            json.dump(remapped_detections, f, indent=4)
+        level_name = os.path.splitext(json_file)[0]  # Nombre de la imagen original (sin el crop)
+
+        with DetectionWriter(output_json_path) as writer:
+            # Remapear cada detección a la imagen original
+            remapped_detections = (remap_detection(detection, level_name) for detection in iter_detections(json_path))
+            if merge is None:
+                for remapped_detection in remapped_detections:
+                    writer.write([remapped_detection])
+            else:
+                writer.write(merge_level_detections(list(remapped_detections), merge, iou_threshold))
+
         print(f"Guardado: {output_json_path}")
 
+def remap_detection(detection, level_name):
+    """
+    Remapea una detección de un crop a las coordenadas de la imagen original de su nivel.
+
+    Parameters:
+    detection (dict): Detección del crop (con el nombre del crop en 'image').
+    level_name (str): Nombre de la imagen original (sin el crop).
+    """
+    # Extraer el nombre del archivo del crop para obtener las coordenadas del offset
+    crop_file = detection["image"]
+    parts = crop_file.split("_")
+    x_offset = int(parts[-2])  # Segundo último elemento del nombre es el offset X
+    y_offset = int(parts[-1].replace(".png", ""))  # Último elemento es el offset Y
+
+    # Recuperar las coordenadas originales
+    x_center_original = detection["x_center"] + x_offset
+    y_center_original = detection["y_center"] + y_offset
+
+    # Guardar las coordenadas remapeadas junto con los demás detalles de la detección
+    return {
+        "image": level_name,
+        "original_crop": crop_file,  # Referencia al archivo del crop original
+        "x_center": x_center_original,
+        "y_center": y_center_original,
+        "width": detection["width"],
+        "height": detection["height"],
+        "confidence": detection["confidence"],
+        "class": detection["class"]
+    }
+
+def merge_level_detections(detections, merge='nms', iou_threshold=0.5):
+    """
+    Fusiona los duplicados entre crops de las detecciones remapeadas de un nivel.
+
+    Parameters:
+    detections (list): Detecciones remapeadas del nivel.
+    merge (str): 'nms' o 'wbf' (ver merge_duplicate_boxes).
+    iou_threshold (float): IoU mínimo para considerar dos detecciones duplicadas.
+
+    Returns:
+    list: Detecciones del nivel sin duplicados.
+    """
+    if not detections:
+        return detections
+
+    columns = {column: np.array([d[column] for d in detections], dtype=np.float64)
+               for column in ("x_center", "y_center", "width", "height", "confidence")}
+    _, crop_ids = np.unique([d["original_crop"] for d in detections], return_inverse=True)
+    keep, merged = merge_duplicate_boxes(columns, iou_threshold, merge, groups=crop_ids)
+
+    merged_detections = []
+    for position, index in enumerate(keep.tolist()):
+        detection = dict(detections[index])
+        for column in columns:
+            detection[column] = float(merged[column][position])
+        merged_detections.append(detection)
+    return merged_detections
+
 # Ejemplo de uso
 # split_detections_by_level("data/P28/detections.json", "data/P28/level_detections")
 
 # Ejemplo de uso
-# remap_detections_to_original("data/P28/level_detections", "data/P28/remapped_detections")
\ No newline at end of file
+# remap_detections_to_original("data/P28/level_detections", "data/P28/remapped_detections")
+# remap_detections_to_original("data/P28/level_detections", "data/P28/remapped_detections", merge='nms')
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import rasterio
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+from procesamiento.convert_tiff_to_png import get_source_signature, load_manifest, save_manifest, is_up_to_date
+
+def read_georeference(tiff_path):
+    """
+    Lee la georreferenciación (transformación afín y CRS) de un GeoTIFF. Todos los niveles de una finca
+    comparten la misma georreferenciación, por lo que basta con leerla una vez por finca.
+
+    Parameters:
+    tiff_path (str): Ruta a una imagen GeoTIFF de la finca.
+
+    Returns:
+    tuple: (transform, crs).
+    """
+    with rasterio.open(tiff_path) as dataset:
+        return dataset.transform, dataset.crs
+
+def shapefile_to_pixel_coords(shapefile_path, transform, crs):
+    """
+    Convierte todos los puntos de un shapefile a coordenadas de píxel con una sola llamada vectorizada
+    a la transformación afín (rasterio.transform.rowcol), reproyectando antes si el CRS es distinto.
+
+    Parameters:
+    shapefile_path (str): Ruta al archivo .shp que contiene los puntos.
+    transform (affine.Affine): Transformación afín del GeoTIFF.
+    crs (rasterio.crs.CRS): Sistema de coordenadas del GeoTIFF.
+
+    Returns:
+    numpy.ndarray: Array de forma (n, 2) con las coordenadas (x, y) de píxel de cada punto.
+    """
+    gdf = gpd.read_file(shapefile_path)
+    if gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+
+    if len(gdf) == 0:
+        return np.zeros((0, 2), dtype=int)
+    rows, cols = rasterio.transform.rowcol(transform, gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy())
+    return np.column_stack([np.asarray(cols, dtype=int), np.asarray(rows, dtype=int)])
+
+def convert_shapefiles_to_pixel_coords(shapefile_paths, tiff_path, cache_dir=None, num_workers=1):
+    """
+    Convierte los puntos de varios shapefiles de una finca a coordenadas de píxel, leyendo la georreferenciación
+    una sola vez. Con cache_dir, las coordenadas de cada shapefile se guardan en un .npy y se reutilizan mientras
+    el shapefile (y su .prj) y la georreferenciación no cambien (firma mtime/tamaño en el manifiesto del directorio).
+
+    Parameters:
+    shapefile_paths (list): Rutas de los archivos .shp.
+    tiff_path (str): Ruta a una imagen GeoTIFF de la finca para la georreferenciación.
+    cache_dir (str, optional): Directorio de la caché de coordenadas. Si es None, no se usa caché.
+    num_workers (int): Número de procesos para leer y convertir los shapefiles que no están en caché. Default: 1.
+
+    Returns:
+    dict: Diccionario {ruta_shapefile: numpy.ndarray (n, 2) de coordenadas (x, y)}.
+    """
+    transform, crs = read_georeference(tiff_path)
+    georeference = [list(transform.to_gdal()), crs.to_wkt() if crs else None]
+
+    manifest = {}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest = load_manifest(cache_dir)
+
+    points = {}
+    pending = {}
+    for shapefile_path in shapefile_paths:
+        cache_file = f"{os.path.splitext(os.path.basename(shapefile_path))[0]}.npy"
+        sources = [p for p in (shapefile_path, os.path.splitext(shapefile_path)[0] + ".prj") if os.path.exists(p)]
+        signature = get_source_signature(*sources) + georeference
+
+        # Reutilizar las coordenadas en caché si el shapefile no ha cambiado
+        if cache_dir is not None and is_up_to_date(manifest, cache_dir, cache_file, signature):
+            points[shapefile_path] = np.load(os.path.join(cache_dir, cache_file))
+        else:
+            pending[shapefile_path] = (cache_file, signature)
+
+    # Leer y convertir los shapefiles pendientes, en paralelo si se indica
+    if num_workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            converted = executor.map(shapefile_to_pixel_coords, pending, [transform] * len(pending), [crs] * len(pending))
+            points.update(zip(pending, converted))
+    else:
+        points.update((path, shapefile_to_pixel_coords(path, transform, crs)) for path in pending)
+
+    # Guardar en caché las coordenadas nuevas
+    if cache_dir is not None and pending:
+        for shapefile_path, (cache_file, signature) in pending.items():
+            np.save(os.path.join(cache_dir, cache_file), points[shapefile_path])
+            manifest[cache_file] = signature
+        save_manifest(cache_dir, manifest)
+    return {shapefile_path: points[shapefile_path] for shapefile_path in shapefile_paths}
+
+# Ejemplo de uso
+# transform, crs = read_georeference("data/P9/1cm_maxint/P9_150.tif")
+# points = shapefile_to_pixel_coords("data/manual_selection/P9/P9_150.shp", transform, crs)
+# points_by_level = convert_shapefiles_to_pixel_coords(shapefile_paths, "data/P9/1cm_maxint/P9_150.tif", cache_dir="data/manual_selection/P9/.pixel_cache", num_workers=4)
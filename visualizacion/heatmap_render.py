@@ -0,0 +1,138 @@
+import os
+import cv2
+import numpy as np
+import matplotlib
+
+# Filas del grid que se colorean en cada pasada, para no crear arrays intermedios del tamaño de la finca
+BAND_ROWS = 1024
+
+_lut_cache = {}
+
+def get_colormap_lut(colormap='hot'):
+    """
+    Devuelve la tabla de color (LUT) de 256 entradas de un colormap de matplotlib, en orden BGR para OpenCV.
+    Solo se usa la definición del colormap, sin figuras.
+
+    Parameters:
+    colormap (str): Nombre del colormap de matplotlib. Default: 'hot'.
+
+    Returns:
+    numpy.ndarray: Array (256, 3) de tipo uint8.
+    """
+    if colormap not in _lut_cache:
+        rgba = matplotlib.colormaps[colormap](np.linspace(0, 1, 256))
+        _lut_cache[colormap] = np.round(rgba[:, 2::-1] * 255).astype(np.uint8)
+    return _lut_cache[colormap]
+
+def colorize_grid(grid, vmax=None, colormap='hot'):
+    """
+    Convierte un grid de cobertura en una imagen BGR uint8 a través de la LUT del colormap. Los valores se
+    escalan linealmente de [0, vmax] a los 256 índices de la LUT, por bandas de filas.
+
+    Parameters:
+    grid (numpy.ndarray): Grid de cobertura 2D.
+    vmax (float, optional): Valor que corresponde al último color. Si es None, el máximo del grid.
+    colormap (str): Nombre del colormap de matplotlib. Default: 'hot'.
+
+    Returns:
+    numpy.ndarray: Imagen (alto, ancho, 3) BGR de tipo uint8.
+    """
+    lut = get_colormap_lut(colormap)
+    vmax = float(grid.max()) if vmax is None else float(vmax)
+    scale = 255.0 / vmax if vmax > 0 else 0.0
+
+    image = np.empty(grid.shape + (3,), dtype=np.uint8)
+    for start in range(0, grid.shape[0], BAND_ROWS):
+        band = grid[start:start + BAND_ROWS]
+        indices = np.clip(np.multiply(band, scale, dtype=np.float32), 0, 255).astype(np.uint8)
+        np.take(lut, indices, axis=0, out=image[start:start + BAND_ROWS])
+    return image
+
+def max_pool_grid(grid, factor):
+    """
+    Reduce un grid por bloques de factor x factor quedándose con el máximo de cada bloque, para que los picos
+    aislados sigan siendo visibles en la vista previa.
+
+    Parameters:
+    grid (numpy.ndarray): Grid de cobertura 2D.
+    factor (int): Lado del bloque de reducción.
+
+    Returns:
+    numpy.ndarray: Grid reducido de tamaño (ceil(alto / factor), ceil(ancho / factor)).
+    """
+    if factor <= 1:
+        return grid
+    row_starts = np.arange(0, grid.shape[0], factor)
+    col_starts = np.arange(0, grid.shape[1], factor)
+    return np.maximum.reduceat(np.maximum.reduceat(grid, row_starts, axis=0), col_starts, axis=1)
+
+def get_preview_grid(grid, max_size=2048):
+    """
+    Devuelve el grid reducido por máximos para que su lado mayor no supere max_size, y el extent en píxeles
+    de la finca para representarlo con las coordenadas originales.
+
+    Parameters:
+    grid (numpy.ndarray): Grid de cobertura 2D.
+    max_size (int): Lado mayor máximo de la vista previa. Default: 2048.
+
+    Returns:
+    tuple: (grid reducido, factor de reducción, extent (izquierda, derecha, abajo, arriba)).
+    """
+    factor = max(1, -(-max(grid.shape) // max_size))
+    extent = (0, grid.shape[1], grid.shape[0], 0)
+    return max_pool_grid(grid, factor), factor, extent
+
+def stamp_centers(image, centers, scale=1, radius=6, color=(255, 0, 0)):
+    """
+    Marca los centros de los árboles sobre una imagen BGR (en el sitio) con una cruz.
+
+    Parameters:
+    image (numpy.ndarray): Imagen BGR sobre la que dibujar.
+    centers (list): Coordenadas (x, y) de los centros en píxeles de la finca.
+    scale (float): Factor de reducción de la imagen respecto a la finca. Default: 1.
+    radius (int): Semilado de la cruz en píxeles de la imagen. Default: 6.
+    color (tuple): Color BGR de la cruz. Default: azul.
+    """
+    for x, y in centers:
+        center = (int(round(x / scale)), int(round(y / scale)))
+        cv2.drawMarker(image, center, color, markerType=cv2.MARKER_CROSS, markerSize=2 * radius + 1,
+                       thickness=max(1, radius // 3))
+
+def render_heatmap(grid, output_path, preview_path=None, preview_max_size=2048, centers=None, colormap='hot', vmax=None):
+    """
+    Guarda el heatmap de cobertura como imagen a resolución nativa (un píxel por píxel de la finca, fila 0 arriba
+    como en las imágenes de la finca) y, opcionalmente, una vista previa reducida por máximos. Los colores se
+    obtienen de la LUT del colormap en una sola pasada vectorizada, sin figuras de matplotlib.
+
+    Parameters:
+    grid (numpy.ndarray): Grid de cobertura 2D.
+    output_path (str): Ruta de la imagen a resolución nativa. Si es None, solo se guarda la vista previa.
+    preview_path (str, optional): Ruta de la vista previa. Si es None, no se genera.
+    preview_max_size (int): Lado mayor máximo de la vista previa. Default: 2048.
+    centers (list, optional): Centros (x, y) de los árboles a marcar sobre las imágenes.
+    colormap (str): Nombre del colormap de matplotlib. Default: 'hot'.
+    vmax (float, optional): Valor que corresponde al último color. Si es None, el máximo del grid.
+    """
+    vmax = float(grid.max()) if vmax is None else vmax
+
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        image = colorize_grid(grid, vmax, colormap)
+        if centers is not None:
+            stamp_centers(image, centers)
+        cv2.imwrite(output_path, image)
+        del image
+        print(f"Heatmap guardado en: {output_path}")
+
+    if preview_path:
+        os.makedirs(os.path.dirname(preview_path) or ".", exist_ok=True)
+        preview, factor, _ = get_preview_grid(grid, preview_max_size)
+        preview_image = colorize_grid(preview, vmax, colormap)
+        if centers is not None:
+            stamp_centers(preview_image, centers, scale=factor, radius=3)
+        cv2.imwrite(preview_path, preview_image)
+        print(f"Vista previa del heatmap guardada en: {preview_path}")
+
+# Ejemplo de uso:
+# render_heatmap(heatmap, "data/P28/visualization/detections_heatmap.png", "data/P28/visualization/detections_heatmap_preview.png")
+# render_heatmap(heatmap, None, "data/P28/visualization/tree_centers_preview.png", centers=centers)
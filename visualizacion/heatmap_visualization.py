@@ -1,89 +1,38 @@
-import json
 import os
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from tqdm import tqdm
-from PIL import Image
+from procesamiento.coverage_heatmap import get_image_shape, build_coverage_grid
+from procesamiento.coverage_index import load_coverage_index, query_coverage_index
+from visualizacion.heatmap_render import render_heatmap
 
-def draw_coverage_heatmap(json_dir, image_dir, output_dir=None, min_level=None, max_level=None):
+def draw_coverage_heatmap(json_dir, image_dir, output_dir=None, min_level=None, max_level=None, memory_budget_mb=None, heatmap=None, coverage_index=None, renderer='matplotlib'):
     """
-    Crea y guarda (o muestra) un heatmap de cobertura de detecciones de BBoxes a partir de archivos JSON.
+    Crea y guarda (o muestra) un heatmap de cobertura de detecciones de BBoxes a partir de archivos JSON
+    o del almacén columnar de detecciones.
     Utiliza la primera imagen del directorio de imágenes para determinar el tamaño de la finca.
     Opcionalmente, limita el rango de niveles a procesar y ajusta el nombre del archivo de salida.
     
     Parameters:
-    json_dir (str): Directorio que contiene los archivos JSON de detecciones.
-    image_dir (str): Directorio que contiene las imágenes para determinar el tamaño de la finca.
+    json_dir (str): Directorio que contiene los archivos JSON de detecciones, o ruta del almacén columnar (.npz).
+    image_dir (str): Directorio que contiene las imágenes (o el volumen de niveles) para determinar el tamaño de la finca.
     output_dir (str, optional): Directorio donde se guardará la visualización del heatmap.
                                 Si es None, se mostrará en pantalla.
     min_level (int, optional): Número mínimo de nivel a procesar. Si es None, se procesan todos los niveles desde el principio.
     max_level (int, optional): Número máximo de nivel a procesar. Si es None, se procesan todos los niveles hasta el final.
+    memory_budget_mb (float, optional): Presupuesto de memoria en MB para crear el grid por bandas.
+    heatmap (numpy.ndarray, optional): Grid de cobertura ya calculado para el mismo rango de niveles
+                                       (ver get_or_create_heatmap). Si se indica, no se leen las detecciones.
+    coverage_index (str, optional): Directorio del índice acumulado de cobertura (ver build_coverage_index).
+                                    Si se indica, el grid del rango de niveles se obtiene con una sola resta.
+    renderer (str): 'matplotlib' para la figura con barra de color, o 'native' para guardar el heatmap a
+                    resolución nativa y una vista previa '_preview' sin figuras (ver render_heatmap).
+                    'native' requiere output_dir. Default: 'matplotlib'.
     """
-    def get_image_shape(image_dir):
-        image_files = [f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
-        if not image_files:
-            raise ValueError("No se encontraron imágenes en el directorio proporcionado.")
-        
-        # Cargar la primera imagen para obtener el tamaño
-        first_image_path = os.path.join(image_dir, image_files[0])
-        with Image.open(first_image_path) as img:
-            return img.size[::-1]  # PIL retorna (ancho, altura), pero lo invertimos a (altura, ancho)
-    
-    def create_coverage_grid(json_dir, image_shape, min_level=None, max_level=None):
-        coverage_grid = np.zeros(image_shape, dtype=int)
-        json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
-        
-        # Filtrar archivos por nivel si se han definido min_level y/o max_level
-        if min_level is not None or max_level is not None:
-            filtered_files = []
-            for json_file in json_files:
-                parts = json_file.split('_')
-                try:
-                    level_number = int(parts[1])  # Tomar el segundo elemento que corresponde al número
-                    if (min_level is None or level_number >= min_level) and (max_level is None or level_number <= max_level):
-                        filtered_files.append(json_file)
-                except ValueError:
-                    continue
-            json_files = filtered_files
-
-        # Procesar cada archivo JSON
-        for json_file in tqdm(json_files, desc="Procesando niveles", unit="nivel"):
-            json_path = os.path.join(json_dir, json_file)
-            with open(json_path, 'r') as f:
-                detections = json.load(f)
-            
-            # Crear un grid temporal para el nivel actual
-            temp_grid = np.zeros(image_shape, dtype=int)
-
-            # Marcar en el grid temporal los puntos cubiertos por BBoxes
-            for detection in detections:
-                x_center = detection['x_center']
-                y_center = detection['y_center']
-                width = detection['width']
-                height = detection['height']
-                
-                x_min = int(x_center - (width / 2))
-                y_min = int(y_center - (height / 2))
-                x_max = int(x_center + (width / 2))
-                y_max = int(y_center + (height / 2))
-                
-                # Asegurarse de que las coordenadas estén dentro de los límites de la imagen
-                x_min = max(0, x_min)
-                y_min = max(0, y_min)
-                x_max = min(image_shape[1], x_max)
-                y_max = min(image_shape[0], y_max)
-                
-                temp_grid[y_min:y_max, x_min:x_max] = 1
-
-            coverage_grid += temp_grid
-
-        return coverage_grid
-
-    def draw_coverage_grid(coverage_grid, output_path=None):
+    def draw_coverage_grid(coverage_grid, output_path=None, extent=None):
         plt.figure(figsize=(10, 8))
-        plt.imshow(coverage_grid, cmap='hot', interpolation='nearest')
+        plt.imshow(coverage_grid, cmap='hot', interpolation='nearest', extent=extent)
         plt.colorbar(label='Frecuencia de Cobertura')
         plt.title('Heatmap de Cobertura de Detecciones')
         plt.xlabel('X')
@@ -99,11 +48,21 @@ def draw_coverage_heatmap(json_dir, image_dir, output_dir=None, min_level=None,
             plt.show()
             print("Heatmap mostrado en pantalla.")
 
-    # Obtener el tamaño de la imagen desde la primera imagen del directorio
-    image_shape = get_image_shape(image_dir)
-    
-    # Crear el grid de cobertura
-    coverage_grid = create_coverage_grid(json_dir, image_shape, min_level, max_level)
+    extent = None
+    if heatmap is not None:
+        coverage_grid = heatmap
+    elif coverage_index is not None:
+        # Consultar el rango de niveles en el índice acumulado (a la resolución de sus bloques)
+        coverage_grid = query_coverage_index(coverage_index, min_level, max_level, json_dir=json_dir)
+        _, index = load_coverage_index(coverage_index)
+        if index["block_size"] > 1:
+            extent = (0, index["image_shape"][1], index["image_shape"][0], 0)
+    else:
+        # Obtener el tamaño de la imagen desde la primera imagen del directorio
+        image_shape = get_image_shape(image_dir)
+
+        # Crear el grid de cobertura con el motor de rasterizado vectorizado
+        coverage_grid = build_coverage_grid(json_dir, image_shape, min_level, max_level, memory_budget_mb=memory_budget_mb)
     
     # Crear el nombre del archivo de salida según el rango de niveles
     if min_level is not None or max_level is not None:
@@ -114,9 +73,13 @@ def draw_coverage_heatmap(json_dir, image_dir, output_dir=None, min_level=None,
     output_path = os.path.join(output_dir, f"detections_heatmap{level_info}.png") if output_dir else None
     
     # Guardar o representar la visualización del heatmap
-    draw_coverage_grid(coverage_grid, output_path)
+    if renderer == 'native' and output_path:
+        render_heatmap(coverage_grid, output_path, preview_path=output_path.replace(".png", "_preview.png"))
+    else:
+        draw_coverage_grid(coverage_grid, output_path, extent)
 
 # Ejemplo de uso:
 # draw_coverage_heatmap("data/P28/detections/remapped_detections", "data/P28/rgb_images", "data/P28/visualization/", min_level=75, max_level=185)
+# draw_coverage_heatmap("data/P28/detections/remapped_detections.npz", "data/P28/volume", "data/P28/visualization/", renderer='native')
 # O sin output_dir para mostrar el heatmap
 # draw_coverage_heatmap("data/P28/detections/remapped_detections", "data/P28/rgb_images", min_level=75, max_level=185)
\ No newline at end of file
@@ -0,0 +1,263 @@
+import os
+import json
+import cv2
+import numpy as np
+from tqdm import tqdm
+from procesamiento.detections_io import find_level_detections
+from procesamiento.detection_store import is_detection_store, iter_level_boxes
+from procesamiento.level_volume import is_level_volume, load_level_volume
+from visualizacion.visualize_detections import load_detection_columns, draw_detection_boxes
+from visualizacion.heatmap_render import colorize_grid
+
+TILE_SIZE = 256
+BLANK_TILE = "blank.png"
+MANIFEST_FILENAME = "tiles.json"
+
+# Tamaño de la etiqueta de confianza que se dibuja sobre cada BBox (ver draw_detection_boxes)
+(LABEL_WIDTH, LABEL_HEIGHT), _ = cv2.getTextSize("Conf: 0.00", cv2.FONT_HERSHEY_SIMPLEX, 0.5, 2)
+
+def get_max_zoom(image_shape, tile_size=TILE_SIZE):
+    """
+    Devuelve el zoom de resolución completa de la pirámide: el menor z tal que 2^z teselas cubren el lado
+    mayor de la imagen. En el zoom 0 toda la finca cabe en una tesela.
+
+    Parameters:
+    image_shape (tuple): Tamaño (alto, ancho) de la imagen.
+    tile_size (int): Lado de las teselas en píxeles. Default: 256.
+    """
+    max_zoom = 0
+    while tile_size << max_zoom < max(image_shape):
+        max_zoom += 1
+    return max_zoom
+
+def get_tile_path(layer_dir, zoom, x, y):
+    """
+    Devuelve la ruta de una tesela en el esquema XYZ (<capa>/<z>/<x>/<y>.png).
+    """
+    return os.path.join(layer_dir, str(zoom), str(x), f"{y}.png")
+
+def write_tile(path, tile):
+    """
+    Guarda una tesela creando su directorio si no existe.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, tile)
+
+def get_detection_tiles(detections, image_shape, tile_size=TILE_SIZE):
+    """
+    Agrupa las detecciones de un nivel por las teselas de resolución completa que tocan, incluyendo el
+    grosor del rectángulo y la etiqueta de confianza dibujada encima.
+
+    Parameters:
+    detections (dict): Columnas de detecciones del nivel (ver load_detection_columns).
+    image_shape (tuple): Tamaño (alto, ancho) de la imagen.
+    tile_size (int): Lado de las teselas en píxeles.
+
+    Returns:
+    dict: Diccionario {(x, y) de la tesela: array de índices de las detecciones que dibujan en ella}.
+    """
+    x_min = np.trunc(detections['x_center'] - detections['width'] / 2).astype(np.int64)
+    y_min = np.trunc(detections['y_center'] - detections['height'] / 2).astype(np.int64)
+    x_max = np.trunc(detections['x_center'] + detections['width'] / 2).astype(np.int64)
+    y_max = np.trunc(detections['y_center'] + detections['height'] / 2).astype(np.int64)
+
+    # Región dibujada por cada detección (rectángulo y etiqueta), recortada a la imagen
+    left = np.clip(x_min - 2, 0, image_shape[1] - 1)
+    right = np.clip(np.maximum(x_max, x_min + LABEL_WIDTH) + 2, 0, image_shape[1] - 1)
+    top = np.clip(y_min - 10 - LABEL_HEIGHT - 2, 0, image_shape[0] - 1)
+    bottom = np.clip(y_max + 2, 0, image_shape[0] - 1)
+    visible = (np.maximum(x_max, x_min + LABEL_WIDTH) + 2 >= 0) & (x_min - 2 < image_shape[1]) & \
+              (y_max + 2 >= 0) & (y_min - 10 - LABEL_HEIGHT - 2 < image_shape[0])
+
+    tiles = {}
+    for index in np.flatnonzero(visible).tolist():
+        for tile_x in range(left[index] // tile_size, right[index] // tile_size + 1):
+            for tile_y in range(top[index] // tile_size, bottom[index] // tile_size + 1):
+                tiles.setdefault((tile_x, tile_y), []).append(index)
+    return {tile: np.array(indices) for tile, indices in tiles.items()}
+
+def build_lower_zooms(layer_dir, tiles, max_zoom, tile_size=TILE_SIZE):
+    """
+    Construye los zooms inferiores de una capa reduciendo a la mitad cada grupo de 2x2 teselas del zoom
+    superior. Solo se generan las teselas con algún hijo renderizado; los hijos que faltan son teselas vacías.
+
+    Parameters:
+    layer_dir (str): Directorio de la capa.
+    tiles (list): Teselas (x, y) renderizadas en el zoom de resolución completa.
+    max_zoom (int): Zoom de resolución completa.
+    tile_size (int): Lado de las teselas en píxeles.
+
+    Returns:
+    dict: Diccionario {zoom (str): lista de teselas [x, y]} con las teselas de todos los zooms.
+    """
+    tiles_by_zoom = {max_zoom: sorted(tiles)}
+    for zoom in range(max_zoom - 1, -1, -1):
+        children = set(tiles_by_zoom[zoom + 1])
+        parents = sorted({(x // 2, y // 2) for x, y in children})
+
+        for x, y in parents:
+            canvas = np.zeros((2 * tile_size, 2 * tile_size, 3), dtype=np.uint8)
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    if (2 * x + dx, 2 * y + dy) in children:
+                        child = cv2.imread(get_tile_path(layer_dir, zoom + 1, 2 * x + dx, 2 * y + dy))
+                        canvas[dy * tile_size:(dy + 1) * tile_size, dx * tile_size:(dx + 1) * tile_size] = child
+            write_tile(get_tile_path(layer_dir, zoom, x, y), cv2.resize(canvas, (tile_size, tile_size), interpolation=cv2.INTER_AREA))
+
+        tiles_by_zoom[zoom] = parents
+
+    return {str(zoom): [list(tile) for tile in tiles] for zoom, tiles in sorted(tiles_by_zoom.items())}
+
+def save_tile_manifest(output_dir, layers, image_shape, tile_size=TILE_SIZE):
+    """
+    Crea (o actualiza) el manifiesto 'tiles.json' de la pirámide y la tesela vacía compartida 'blank.png'.
+    El manifiesto lista, por capa y zoom, las teselas renderizadas; cualquier otra tesela es 'blank.png'.
+
+    Parameters:
+    output_dir (str): Directorio raíz de la pirámide.
+    layers (dict): Diccionario {nombre de capa: teselas por zoom (ver build_lower_zooms)}.
+    image_shape (tuple): Tamaño (alto, ancho) de la imagen.
+    tile_size (int): Lado de las teselas en píxeles.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    blank_path = os.path.join(output_dir, BLANK_TILE)
+    if not os.path.exists(blank_path):
+        cv2.imwrite(blank_path, np.zeros((tile_size, tile_size, 3), dtype=np.uint8))
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = {"layers": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    manifest.update({
+        "tile_size": tile_size,
+        "max_zoom": get_max_zoom(image_shape, tile_size),
+        "image_shape": [int(v) for v in image_shape],
+        "blank_tile": BLANK_TILE,
+        "url_template": "{layer}/{z}/{x}/{y}.png",
+    })
+    manifest["layers"].update(layers)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+def render_level_pyramid(img, detections, layer_dir, tile_size=TILE_SIZE, rgb=False):
+    """
+    Renderiza la pirámide de teselas de un nivel con sus BBoxes dibujadas. En el zoom de resolución completa
+    solo se renderizan las teselas que contienen detecciones; los zooms inferiores se obtienen de ellas.
+
+    Parameters:
+    img (numpy.ndarray): Imagen del nivel (BGR, o RGB si rgb=True). Puede ser una vista del volumen de niveles,
+                         de la que solo se leen las teselas renderizadas.
+    detections (dict): Columnas de detecciones del nivel (ver load_detection_columns).
+    layer_dir (str): Directorio de la capa del nivel.
+    tile_size (int): Lado de las teselas en píxeles. Default: 256.
+    rgb (bool): Si True, la imagen está en orden RGB y se convierte a BGR para OpenCV.
+
+    Returns:
+    dict: Teselas renderizadas por zoom (ver build_lower_zooms).
+    """
+    image_shape = img.shape[:2]
+    max_zoom = get_max_zoom(image_shape, tile_size)
+    tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+
+    detection_tiles = get_detection_tiles(detections, image_shape, tile_size)
+    for (x, y), indices in detection_tiles.items():
+        # Copiar la región de la tesela (rellenando con negro en los bordes de la imagen)
+        region = img[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+        tile[...] = 0
+        tile[:region.shape[0], :region.shape[1]] = region[..., ::-1] if rgb else region
+
+        # Dibujar solo las detecciones que tocan la tesela, desplazadas a su origen
+        draw_detection_boxes(tile, {column: values[indices] for column, values in detections.items()},
+                             x_offset=x * tile_size, y_offset=y * tile_size)
+        write_tile(get_tile_path(layer_dir, max_zoom, x, y), tile)
+
+    return build_lower_zooms(layer_dir, detection_tiles, max_zoom, tile_size)
+
+def render_detection_pyramids(image_dir, json_dir, output_dir, tile_size=TILE_SIZE):
+    """
+    Alternativa a draw_all_detections para fincas grandes: renderiza cada nivel con sus BBoxes como una pirámide
+    de teselas XYZ de tile_size píxeles (<output_dir>/<nivel>/<z>/<x>/<y>.png) en lugar de una imagen completa.
+    Solo se codifican las teselas con detecciones; las demás comparten 'blank.png'. El manifiesto 'tiles.json'
+    lista las teselas de cada nivel para el visor.
+
+    Parameters:
+    image_dir (str): Directorio que contiene las imágenes RGB o el volumen de niveles.
+    json_dir (str): Directorio que contiene los archivos JSON de detecciones, o ruta del almacén columnar (.npz).
+    output_dir (str): Directorio raíz de la pirámide.
+    tile_size (int): Lado de las teselas en píxeles. Default: 256.
+    """
+    # Localizar las detecciones de cada nivel en el almacén o en el directorio de JSONs
+    if is_detection_store(json_dir):
+        store_boxes = dict(iter_level_boxes(json_dir))
+        find_detections = store_boxes.get
+    else:
+        find_detections = lambda level_name: find_level_detections(json_dir, level_name)
+
+    layers = {}
+    image_shape = None
+
+    # Caso volumen de niveles: las teselas se leen directamente de la vista de cada nivel
+    if is_level_volume(image_dir):
+        volume, index = load_level_volume(image_dir)
+        image_shape = volume.shape[1:3]
+        for position, level_name in enumerate(tqdm(index["level_names"], desc="Renderizando pirámides", unit="nivel")):
+            json_path = find_detections(level_name)
+            if json_path is not None:
+                layers[level_name] = render_level_pyramid(volume[position], load_detection_columns(json_path),
+                                                          os.path.join(output_dir, level_name), tile_size, rgb=True)
+    else:
+        image_files = [f for f in os.listdir(image_dir) if f.endswith('.png')]
+        for image_file in tqdm(image_files, desc="Renderizando pirámides", unit="imagen"):
+            level_name = os.path.splitext(image_file)[0]
+            json_path = find_detections(level_name)
+            if json_path is not None:
+                img = cv2.imread(os.path.join(image_dir, image_file))
+                image_shape = img.shape[:2]
+                layers[level_name] = render_level_pyramid(img, load_detection_columns(json_path),
+                                                          os.path.join(output_dir, level_name), tile_size)
+
+    if image_shape is not None:
+        save_tile_manifest(output_dir, layers, image_shape, tile_size)
+    print(f"Pirámides de teselas guardadas en: {output_dir} ({len(layers)} niveles)")
+
+def render_heatmap_pyramid(heatmap, output_dir, layer_name="heatmap", tile_size=TILE_SIZE, colormap='hot', vmax=None):
+    """
+    Renderiza el heatmap de cobertura como una capa más de la pirámide de teselas, con la misma LUT de color que
+    render_heatmap (ver colorize_grid) normalizada a vmax. Solo se renderizan las teselas con cobertura.
+
+    Parameters:
+    heatmap (numpy.ndarray): Grid de cobertura (ver get_or_create_heatmap).
+    output_dir (str): Directorio raíz de la pirámide.
+    layer_name (str): Nombre de la capa del heatmap. Default: 'heatmap'.
+    tile_size (int): Lado de las teselas en píxeles. Default: 256.
+    colormap (str): Nombre del colormap de matplotlib. Default: 'hot'.
+    vmax (float, optional): Valor que corresponde al último color. Si es None, el máximo del heatmap.
+    """
+    image_shape = heatmap.shape
+    max_zoom = get_max_zoom(image_shape, tile_size)
+    layer_dir = os.path.join(output_dir, layer_name)
+    vmax = float(heatmap.max()) if vmax is None else vmax
+
+    # Teselas con cobertura: máximo de cada bloque de tile_size x tile_size
+    row_starts = np.arange(0, image_shape[0], tile_size)
+    col_starts = np.arange(0, image_shape[1], tile_size)
+    occupied = np.maximum.reduceat(np.maximum.reduceat(heatmap, row_starts, axis=0), col_starts, axis=1) > 0
+
+    tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+    tiles = [(int(x), int(y)) for y, x in zip(*np.nonzero(occupied))]
+    for x, y in tqdm(tiles, desc="Renderizando heatmap", unit="tesela"):
+        # Colorear la región de la tesela (rellenando con negro fuera de la imagen, como las demás capas)
+        region = heatmap[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+        tile[...] = 0
+        tile[:region.shape[0], :region.shape[1]] = colorize_grid(region, vmax, colormap)
+        write_tile(get_tile_path(layer_dir, max_zoom, x, y), tile)
+
+    save_tile_manifest(output_dir, {layer_name: build_lower_zooms(layer_dir, tiles, max_zoom, tile_size)}, image_shape, tile_size)
+    print(f"Pirámide del heatmap guardada en: {layer_dir}")
+
+# Ejemplo de uso:
+# render_detection_pyramids("data/P28/volume", "data/P28/detections/remapped_detections.npz", "data/P28/visualization/tiles")
+# render_heatmap_pyramid(heatmap, "data/P28/visualization/tiles")
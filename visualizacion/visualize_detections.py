@@ -1,69 +1,175 @@
-import json
 import cv2
 import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+from procesamiento.detections_io import find_level_detections, iter_detections
+from procesamiento.detection_store import is_detection_store, iter_level_boxes
+from procesamiento.level_volume import is_level_volume, load_level_volume
 
-def draw_all_detections(image_dir, json_dir, output_dir):
+# Extensión y parámetro de compresión de OpenCV de cada códec de salida
+CODECS = {
+    'png': (".png", cv2.IMWRITE_PNG_COMPRESSION),
+    'jpg': (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    'webp': (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# Factores de reducción que OpenCV puede aplicar al decodificar un PNG
+REDUCED_READ_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# Volúmenes de niveles ya abiertos en cada proceso del pool, por directorio
+_volume_cache = {}
+
+def draw_all_detections(image_dir, json_dir, output_dir, num_workers=1, codec='png', compression=None, min_confidence=0.0, downscale=1):
     """
     Itera sobre todas las imágenes y sus JSON correspondientes para dibujar las BBoxes.
+    Si image_dir es un volumen de niveles, cada nivel se toma como vista del volumen sin decodificar PNG.
+    Si json_dir es el almacén columnar de detecciones, las BBoxes de cada nivel se leen de sus columnas.
+    Con num_workers > 1 los niveles se reparten entre un pool de procesos.
     
     Parameters:
-    image_dir (str): Directorio que contiene las imágenes RGB.
-    json_dir (str): Directorio que contiene los archivos JSON de detecciones.
+    image_dir (str): Directorio que contiene las imágenes RGB o el volumen de niveles.
+    json_dir (str): Directorio que contiene los archivos JSON de detecciones, o ruta del almacén columnar (.npz).
     output_dir (str): Directorio donde se guardarán las imágenes con BBoxes dibujadas.
+    num_workers (int): Número de procesos para renderizar los niveles. Default: 1.
+    codec (str): Formato de salida, 'png', 'jpg' o 'webp'. Default: 'png'.
+    compression (int, optional): Compresión del códec: nivel 0-9 para PNG (1 es rápido) o calidad 0-100 para
+                                 JPEG y WebP. Si es None, el valor por defecto de OpenCV.
+    min_confidence (float): Confianza mínima de las detecciones que se dibujan. Default: 0.0.
+    downscale (int): Factor de reducción de las imágenes de salida, para vistas previas. Default: 1.
     """
+    if codec not in CODECS:
+        raise ValueError(f"Códec no soportado: {codec}. Opciones: {list(CODECS)}")
+    extension = CODECS[codec][0]
+
     # Crear el directorio de salida si no existe
     os.makedirs(output_dir, exist_ok=True)
 
-    # Listar todas las imágenes en el directorio de imágenes
-    image_files = [f for f in os.listdir(image_dir) if f.endswith('.png')]
-
-    # Procesar cada imagen con una barra de progreso
-    for image_file in tqdm(image_files, desc="Procesando imágenes y JSONs", unit="imagen"):
-        # Construir la ruta completa de la imagen y el archivo JSON correspondiente
-        image_path = os.path.join(image_dir, image_file)
-        json_file = image_file.replace('.png', '.json')
-        json_path = os.path.join(json_dir, json_file)
-        
-        # Verificar que el archivo JSON correspondiente exista
-        if os.path.exists(json_path):
-            # Construir la ruta de salida para la imagen con BBoxes dibujadas
-            output_path = os.path.join(output_dir, image_file)
-            
-            # Dibujar las BBoxes y guardar la imagen
-            plot_detections_with_opencv(image_path, json_path, output_path)
-        else:
-            print(f"Archivo JSON no encontrado para la imagen: {image_file}")
+    # Localizar las detecciones de cada nivel en el almacén o en el directorio de JSONs
+    if is_detection_store(json_dir):
+        store_boxes = dict(iter_level_boxes(json_dir))
+        find_detections = store_boxes.get
+    else:
+        find_detections = lambda level_name: find_level_detections(json_dir, level_name)
 
-def plot_detections_with_opencv(image_path, json_path, output_path):
+    # Reunir los niveles a renderizar: (imagen, detecciones, salida)
+    tasks = []
+    if is_level_volume(image_dir):
+        # Caso volumen de niveles: cada proceso abre el volumen y lee su nivel como vista
+        _, index = load_level_volume(image_dir)
+        for position, level_name in enumerate(index["level_names"]):
+            json_path = find_detections(level_name)
+            if json_path is not None:
+                tasks.append(((image_dir, position), json_path, os.path.join(output_dir, f"{level_name}{extension}")))
+            else:
+                print(f"Archivo JSON no encontrado para el nivel: {level_name}")
+    else:
+        # Listar todas las imágenes en el directorio de imágenes
+        image_files = [f for f in os.listdir(image_dir) if f.endswith('.png')]
+        for image_file in image_files:
+            level_name = os.path.splitext(image_file)[0]
+            json_path = find_detections(level_name)
+            if json_path is not None:
+                tasks.append((os.path.join(image_dir, image_file), json_path, os.path.join(output_dir, f"{level_name}{extension}")))
+            else:
+                print(f"Archivo JSON no encontrado para la imagen: {image_file}")
+
+    # Renderizar los niveles, en paralelo si se indica
+    options = (codec, compression, min_confidence, downscale)
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(render_level_detections, *task, *options) for task in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Procesando niveles y JSONs", unit="nivel"):
+                future.result()
+    else:
+        for task in tqdm(tasks, desc="Procesando niveles y JSONs", unit="nivel"):
+            render_level_detections(*task, *options)
+
+def read_level_image(image_source, downscale=1):
     """
-    Muestra una imagen RGB y dibuja todas las bounding boxes (BBoxes) a partir de un archivo JSON utilizando OpenCV.
-    
+    Lee la imagen BGR de un nivel, reducida por downscale. Los PNG se decodifican ya reducidos cuando OpenCV
+    lo permite (factores 2, 4 y 8) y los niveles del volumen se leen con paso downscale, sin leer el resto.
+
     Parameters:
-    image_path (str): Ruta de la imagen RGB.
-    json_path (str): Ruta del archivo JSON que contiene las detecciones.
-    output_path (str): Ruta para guardar la imagen con las BBoxes dibujadas.
+    image_source (str or tuple): Ruta de la imagen PNG, o (directorio del volumen, posición del nivel).
+    downscale (int): Factor de reducción. Default: 1.
     """
-    # Cargar la imagen con OpenCV
-    img = cv2.imread(image_path)
-    
-    # Cargar las detecciones desde el archivo JSON
-    with open(json_path, 'r') as f:
-        detections = json.load(f)
+    if isinstance(image_source, str):
+        img = cv2.imread(image_source, REDUCED_READ_FLAGS.get(downscale, cv2.IMREAD_COLOR))
+        if downscale > 1 and downscale not in REDUCED_READ_FLAGS:
+            img = cv2.resize(img, (-(-img.shape[1] // downscale), -(-img.shape[0] // downscale)), interpolation=cv2.INTER_AREA)
+        return img
 
-    # Dibujar cada BBox
-    for detection in detections:
-        x_center = detection['x_center']
-        y_center = detection['y_center']
-        width = detection['width']
-        height = detection['height']
-        confidence = detection['confidence']
+    volume_dir, position = image_source
+    if volume_dir not in _volume_cache:
+        _volume_cache[volume_dir] = load_level_volume(volume_dir)[0]
+    # El volumen está en orden RGB y OpenCV trabaja en BGR
+    return np.ascontiguousarray(_volume_cache[volume_dir][position, ::downscale, ::downscale, ::-1])
+
+def render_level_detections(image_source, json_path, output_path, codec='png', compression=None, min_confidence=0.0, downscale=1):
+    """
+    Dibuja las BBoxes de un nivel y guarda la imagen con el códec indicado. Se ejecuta en los procesos del pool.
 
+    Parameters:
+    image_source (str or tuple): Ruta de la imagen PNG, o (directorio del volumen, posición del nivel).
+    json_path (str or dict): Ruta del archivo de detecciones del nivel o columnas del almacén columnar.
+    output_path (str): Ruta de la imagen de salida.
+    codec (str): Formato de salida, 'png', 'jpg' o 'webp'. Default: 'png'.
+    compression (int, optional): Compresión o calidad del códec. Si es None, el valor por defecto de OpenCV.
+    min_confidence (float): Confianza mínima de las detecciones que se dibujan. Default: 0.0.
+    downscale (int): Factor de reducción de la imagen de salida. Default: 1.
+    """
+    img = read_level_image(image_source, downscale)
+
+    # Filtrar por confianza y llevar las BBoxes a la escala de la imagen
+    detections = load_detection_columns(json_path)
+    keep = detections['confidence'] >= min_confidence
+    detections = {column: values[keep] for column, values in detections.items()}
+    if downscale > 1:
+        for column in ('x_center', 'y_center', 'width', 'height'):
+            detections[column] = detections[column] / downscale
+
+    draw_detection_boxes(img, detections)
+
+    params = [CODECS[codec][1], compression] if compression is not None else []
+    cv2.imwrite(output_path, img, params)
+    return output_path
+
+def load_detection_columns(json_path):
+    """
+    Devuelve las columnas de detecciones de un nivel como arrays numpy.
+
+    Parameters:
+    json_path (str or dict): Ruta del archivo JSON (.json o .jsonl) de detecciones, o columnas de detecciones
+                             de un nivel del almacén columnar (ver iter_level_boxes).
+
+    Returns:
+    dict: Arrays 'x_center', 'y_center', 'width', 'height' y 'confidence'.
+    """
+    columns = ('x_center', 'y_center', 'width', 'height', 'confidence')
+    if not isinstance(json_path, str):
+        return {column: np.asarray(json_path[column], dtype=np.float64) for column in columns}
+
+    detections = list(iter_detections(json_path))
+    return {column: np.array([d[column] for d in detections], dtype=np.float64) for column in columns}
+
+def draw_detection_boxes(img, detections, x_offset=0, y_offset=0):
+    """
+    Dibuja las BBoxes y su confianza sobre una imagen BGR (en el sitio).
+
+    Parameters:
+    img (numpy.ndarray): Imagen BGR sobre la que dibujar.
+    detections (dict): Columnas de detecciones (ver load_detection_columns).
+    x_offset (int): Columna de la finca que corresponde a la columna 0 de img (para dibujar sobre teselas).
+    y_offset (int): Fila de la finca que corresponde a la fila 0 de img.
+    """
+    columns = (detections[column].tolist() for column in ('x_center', 'y_center', 'width', 'height', 'confidence'))
+    for x_center, y_center, width, height, confidence in zip(*columns):
         # Calcular las esquinas del BBox
-        x_min = int(x_center - (width / 2))
-        y_min = int(y_center - (height / 2))
-        x_max = int(x_center + (width / 2))
-        y_max = int(y_center + (height / 2))
+        x_min = int(x_center - (width / 2)) - x_offset
+        y_min = int(y_center - (height / 2)) - y_offset
+        x_max = int(x_center + (width / 2)) - x_offset
+        y_max = int(y_center + (height / 2)) - y_offset
 
         # Dibujar el rectángulo del BBox
         cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (0, 0, 255), 2)  # Rojo
@@ -72,9 +178,30 @@ def plot_detections_with_opencv(image_path, json_path, output_path):
         label = f"Conf: {confidence:.2f}"
         cv2.putText(img, label, (x_min, y_min - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 2, cv2.LINE_AA)
 
+def plot_detections_with_opencv(image_path, json_path, output_path):
+    """
+    Muestra una imagen RGB y dibuja todas las bounding boxes (BBoxes) a partir de un archivo JSON utilizando OpenCV.
+    
+    Parameters:
+    image_path (str or numpy.ndarray): Ruta de la imagen RGB, o la imagen ya cargada en formato BGR.
+    json_path (str or dict): Ruta del archivo JSON (.json o .jsonl) que contiene las detecciones, o columnas
+                             de detecciones de un nivel del almacén columnar (ver iter_level_boxes).
+    output_path (str): Ruta para guardar la imagen con las BBoxes dibujadas.
+    """
+    # Cargar la imagen con OpenCV (o usar directamente la imagen ya cargada)
+    img = cv2.imread(image_path) if isinstance(image_path, str) else image_path
+    
+    # Cargar las detecciones desde el archivo JSON (.json o .jsonl) o desde las columnas del almacén
+    detections = load_detection_columns(json_path)
+
+    # Dibujar cada BBox
+    draw_detection_boxes(img, detections)
+
     # Guardar la imagen con las BBoxes dibujadas
     cv2.imwrite(output_path, img)
     print(f"Imagen con BBoxes guardada en: {output_path}")
 
 # Ejemplo de uso:
-# draw_all_detections("data/P28/rgb_images", "data/P28/remapped_detections", "data/P28/output")
\ No newline at end of file
+# draw_all_detections("data/P28/rgb_images", "data/P28/remapped_detections", "data/P28/output")
+# draw_all_detections("data/P28/volume", "data/P28/detections/remapped_detections.npz", "data/P28/output")
+# draw_all_detections("data/P28/volume", "data/P28/detections/remapped_detections.npz", "data/P28/preview", num_workers=4, codec='jpg', compression=85, min_confidence=0.5, downscale=4)
\ No newline at end of file